@@ -6,18 +6,49 @@ log = logging.getLogger("babysitter")
 import subprocess
 import os
 import smtplib
+import mailbox
 from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
-from email.utils import formatdate
+from email.utils import formatdate, make_msgid
+from email.header import Header
+import mimetypes
+import base64
+import StringIO
 from abc import ABCMeta, abstractmethod
 import xml.etree.ElementTree as ET # for XML parsing
 import HTMLParser
 import signal
+import select
+import errno
+import fcntl
 import re
 import sys
 import socket
 import cgi
+import threading
+import urllib2
+import BaseHTTPServer
+import SocketServer
+import httplib
+import urlparse
+import collections
+import Queue
+import operator
+import itertools
+import copy
+import hmac
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import fnmatch
+import json
+import inspect
+import random
+from array import array
+import tempfile
+import traceback
+try:
+    from PIL import Image # optional; used to thumbnail large attachments
+except ImportError:
+    Image = None
 
 """
 ***********************************
@@ -41,7 +72,12 @@ EMAIL_TO    = ["me@me.com", "someone-else@them.com"]
 USERNAME    = "smtp-username"
 PASSWORD    = "let-me-in"
 
-    
+By default email is sent using SMTP over SSL.  To use a different
+transport, set Manager.transport to an SMTPTransport (plain SMTP or
+STARTTLS), MaildirTransport or MemoryTransport.  local_smtpd.py
+provides a local SMTP server for testing and benchmarking.
+
+
 ----------------------------------
 If you want to be able to re-start the Network Time Protocol Daemon
 if it fails then follow these steps:
@@ -64,14 +100,26 @@ OK   = 1
 
 UPDATE_PERIOD = 10 # seconds
 
+STATE_HTML = ['<span style=\"color:red\">FAIL</span>',
+              '<span style=\"color:green\">OK</span>']
+
 class Checker:
     """Abstract base class (ABC) for classes which check on the state of
-    a particular part of the system. """    
+    a particular part of the system. 
+
+    Attributes:
+        depends_on (list of Checkers): Manager skips this checker while
+            any of these is FAIL (see Manager._tick).
+        critical (bool): if False then Manager checks this checker less
+            often while the system is under pressure (see SystemPressure).
+    """    
     
     __metaclass__ = ABCMeta
+    critical = True
 
     def __init__(self, name):
         self.name = name
+        self.depends_on = []
         self.update_last_state()
 
     @abstractmethod
@@ -85,17 +133,16 @@ class Checker:
         return html_to_text(self.state_as_html)
     
     def state_as_html(self):
-        return ['<span style=\"color:red\">FAIL</span>',
-                '<span style=\"color:green\">OK</span>'][self.state()]
+        return STATE_HTML[self.state()]
     
     def just_changed_state(self):
         state = self.state() # cache to avoid probs if this changes under us        
         if state == self.last_state:
             return False
         elif state == FAIL:
-            log.warning('state change to FAIL: {}'.format(self))            
+            log.warning('state change to FAIL: %s', self)            
         elif state == OK:
-            log.info('state change: {}'.format(self))
+            log.info('state change: %s', self)
         
         self.last_state = state
         return True
@@ -106,19 +153,103 @@ class Checker:
     def __str__(self):
         return html_to_text(self.html())
 
+    def short_name(self):
+        return self.name.rpartition('/')[2] # remove path
+
     def html(self):
-        html = '{}={}{}'.format(escape(self.name.rpartition('/')[2]), # remove path
+        html = '{}={}{}'.format(escape(self.short_name()),
                                 self.state_as_html(),
                                 escape(self.extra_text()))
         return html
 
+    def changed_html(self):
+        """Called by Manager once per tick.  Returns HTML list items
+        describing whatever has just changed state, or an empty string."""
+        if not self.just_changed_state():
+            return ""
+        log.warn("Checker %s has changed state.", self.name)
+        return "<li>" + self.html() + "</li>\n"
+
+    def rows_html(self):
+        """Returns the HTML list items which represent this checker in
+        Manager.html()."""
+        return '  <li>{}</li>\n'.format(self.html())
+
+    def skipped_html(self, root_cause):
+        """Returns HTML describing this checker while it's skipped because
+        root_cause (a Checker) is FAIL.  Doesn't check anything."""
+        return ('{}=<span style=\"color:gray\">SKIPPED</span>{}'
+                .format(escape(self.short_name()), 
+                        escape(", waiting for " + root_cause.short_name())))
+
+    def settle_time(self):
+        """Seconds to wait, after the checkers this one depends on have
+        recovered, before reporting this checker (see Manager._tick)."""
+        return 0
+
+    def snapshot(self):
+        """Returns a JSON-serialisable dict describing this checker as of
+        the last tick."""
+        return {'type': self.__class__.__name__,
+                'name': self.name,
+                'state': int(self.last_state),
+                'text': self.extra_text()}
+
 class MaxRetriesError(Exception):
-    """We have attempted to restart too many times."""
+    """We have attempted to restart too many times.  No longer raised by
+    Process; kept for backwards compatibility."""
     pass
 
+def find_pids(name, proc='/proc'):
+    """Returns a sorted list of the pids of processes called name, like
+    `pidof -x name` but without forking.  A process matches if the
+    basename of its argv[0] is name, or if its comm is name (the kernel
+    truncates comm to 15 chars so longer names must also match the
+    script, argv[1], of an interpreter).  Our own pid is never returned.
+    """
+    pids = []
+    own_pid = os.getpid()
+    for entry in os.listdir(proc):
+        if not entry.isdigit() or int(entry) == own_pid:
+            continue
+        try:
+            with open(os.path.join(proc, entry, 'comm')) as fh:
+                comm = fh.read().rstrip('\n')
+            with open(os.path.join(proc, entry, 'cmdline')) as fh:
+                argv = fh.read().split('\0')
+        except IOError:
+            continue # the process has exited, or it's not ours to read
+        if os.path.basename(argv[0]) == name:
+            pids.append(int(entry))
+        elif comm == name[:15] and (len(name) <= 15 or (
+             len(argv) > 1 and os.path.basename(argv[1]) == name)):
+            pids.append(int(entry))
+    return sorted(pids)
+
+
 class Process(Checker):
     """Class for monitoring a unix process.
     
+    Restarts are supervised: after issuing `restart_command` we keep the
+    Popen handle (so the command is reaped), and on subsequent calls to
+    supervise() we check whether the process has appeared in the process
+    table.  If it hasn't appeared within HEALTH_TIMEOUT seconds then the
+    restart has failed and the next attempt is scheduled after an
+    exponential backoff with jitter.  After MAX_RESTART_RETRIES failed
+    attempts we give up on this process (the rest of the Manager carries
+    on).
+
+    If `owns_child` is True then babysitter launches the process itself and
+    keeps its Popen handle.  The process's state then comes from the
+    handle rather than from forking `pidof`, and Manager is woken by
+    SIGCHLD the moment the child exits.  If the process is already running
+    (started externally) then we fall back to `pidof` until it dies.
+
+    Optionally, resource usage is sampled from /proc/<pid>/stat and
+    /proc/<pid>/fd (summed over all pids with this name).  If any limit
+    is exceeded then state() is FAIL even though the process is running.
+    A running process is never restarted because of its resource usage.
+
     Attributes:
         name (str): the process name as it appears in `ps -A`
         restart_command (str): the command used to restart this process
@@ -127,105 +258,355 @@ class Process(Checker):
         retries (int): numer of times we have tried to restart this process.
             Note that this will be reset to zero if RESET_RETRIES_AFTER seconds
             have passed since the last retry attempt.
+        next_restart_time (float): unix timecode before which we won't
+            attempt another restart.
+        restart_pending (bool): True if we're waiting for a restart to be
+            confirmed.
+        given_up (bool): True if MAX_RESTART_RETRIES has been reached.  Reset
+            if the process is later found running.
+        owns_child (bool): True if babysitter launches and owns the process.
+        child (subprocess.Popen): the process we launched, if owns_child.
+        max_rss_mb, max_cpu_percent, max_fds, max_threads (number or None):
+            resource limits.  None means no limit.
+        resources (dict): most recent sample, with keys 'rss_mb',
+            'cpu_percent' (None until there are two samples), 'fds' and
+            'threads'.  Empty if no limits are set.
+        fork_free (bool): if True then find our pids by reading /proc
+            (see find_pids) rather than forking `pidof`.  Manager sets this
+            while the system is under pressure.
         
     Static attributes:
         MAX_RESTART_RETRIES (int): Max number of times to try to restart
-            this process before giving up and quitting.
+            this process before giving up on it.
 
         RESET_RETRIES_AFTER (int): Seconds since the last retry after which
             the number of retries will be reset.
+
+        HEALTH_TIMEOUT (int): Seconds to wait for a restarted process to
+            appear in the process table.
+
+        BACKOFF_BASE, BACKOFF_MAX (int): the delay before retry n is
+            BACKOFF_BASE * 2**(n-1) seconds, capped at BACKOFF_MAX, and
+            multiplied by a random jitter factor between 0.5 and 1.5.
+
+        STOP_TIMEOUT (float): seconds stop_child() waits after SIGTERM
+            before it kills the child.
+
+        RESOURCE_SAMPLE_INTERVAL (float): minimum seconds between resource
+            samples.  state() is called several times per tick so this stops
+            CPU% being computed over tiny intervals.
     
     """
     
     MAX_RESTART_RETRIES = 5
     RESET_RETRIES_AFTER = 60 * 60 # seconds 
+    HEALTH_TIMEOUT = 30 # seconds
+    BACKOFF_BASE = 5 # seconds
+    BACKOFF_MAX = 60 * 10 # seconds
+    STOP_TIMEOUT = 10 # seconds
+    RESOURCE_SAMPLE_INTERVAL = 1 # seconds
+    CLK_TCK = os.sysconf('SC_CLK_TCK')
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
 
-    def __init__(self, name, restart_command=None):
+    def __init__(self, name, restart_command=None, owns_child=False,
+                 max_rss_mb=None, max_cpu_percent=None, max_fds=None,
+                 max_threads=None):
         """
         Args:
             name (str): the process name as it appears in `ps -A`
+            restart_command (str)
+            owns_child (bool): see class docstring.
+            max_rss_mb, max_cpu_percent, max_fds, max_threads (number):
+                optional resource limits.
         """
         self.restart_command = restart_command
+        self.owns_child = owns_child
+        self.child = None
+        self.max_rss_mb = max_rss_mb
+        self.max_cpu_percent = max_cpu_percent
+        self.max_fds = max_fds
+        self.max_threads = max_threads
+        self.resources = {}
+        self._pids = []
+        self._prev_sample_time = 0
+        self._prev_jiffies = {} # pid: utime + stime
         self.prev_restart_time = 0
         self.retries = 0
+        self.next_restart_time = 0
+        self.restart_pending = False
+        self.given_up = False
+        self._popens = [] # (Popen, stderr file) of restart commands not yet reaped
+        self.fork_free = False
         super(Process, self).__init__(name)
 
     def pid(self):
-        MAX_RETRIES = 5
-        for _ in range(MAX_RETRIES):
-            try:
-                pid_string = subprocess.check_output(['pidof', '-x', self.name])
-            except OSError as e:
-                # Very occasionally we get a [Errno 12] Cannot allocate memory
-                log.warn(str(e))
-                time.sleep(1)
-            else:
-                break
+        """Returns the pids of this process as a space-separated str."""
+        if self.fork_free:
+            return " ".join(str(pid) for pid in find_pids(self.name))
+        try:
+            pid_string = subprocess.check_output(['pidof', '-x', self.name])
+        except OSError as e:
+            # e.g. [Errno 12] Cannot allocate memory when forking under
+            # memory pressure.  Reading /proc doesn't need to fork.
+            log.warn("pidof failed (%s); reading /proc instead", e)
+            return " ".join(str(pid) for pid in find_pids(self.name))
         return pid_string.strip()
 
+    def backoff(self):
+        """Returns the number of seconds to wait before the next retry."""
+        delay = min(self.BACKOFF_MAX, 
+                    self.BACKOFF_BASE * 2**max(self.retries - 1, 0))
+        return delay * random.uniform(0.5, 1.5)
+
     def restart(self):
-        """
-        Raises:
-            MaxRetriesError
-        """
+        """Issue restart_command without waiting for it to finish.
+        Use supervise() to confirm that the restart worked."""
         if self.restart_command is None:
-            log.info("No restart string for {}".format(self.name))
-            return
-        
-        if self.state() == OK:
+            log.info("No restart string for %s", self.name)
             return
         
-        if self.retries > Process.MAX_RESTART_RETRIES:
-            msg = "Max restart retries reached for " + self.name
-            log.warn(msg)
-            raise MaxRetriesError(msg)
-        
-        log.info("Attempting to restart {}. Retry {}/{}. Previous retry time = {}"
-                 .format(self.name, self.retries, 
-                         Process.MAX_RESTART_RETRIES,
-                         datetime.datetime.fromtimestamp(self.prev_restart_time)
-                           .strftime('%y-%m-%d %H:%M:%S')
-                           if self.prev_restart_time else "0"))
+        log.info("Attempting to restart %s. Retry %d/%d. Previous retry time = %s",
+                 self.name, self.retries, self.MAX_RESTART_RETRIES,
+                 datetime.datetime.fromtimestamp(self.prev_restart_time)
+                   .strftime('%y-%m-%d %H:%M:%S')
+                   if self.prev_restart_time else "0")
         
         self.prev_restart_time = time.time()
         self.retries += 1
-                
+        self.next_restart_time = self.prev_restart_time + self.backoff()
+        self.restart_pending = self._launch()
+
+    def start(self):
+        """Launch a process we own, unless it is already running."""
+        if self.restart_command is None or self.running():
+            return
+        log.info("Starting %s", self.name)
+        self._launch()
+
+    def _launch(self):
+        """Run restart_command without waiting for it.
+        
+        Returns:
+            True if the command was launched.
+        """
+        if self.owns_child:
+            # The child's stderr is our stderr.
+            stderr = None
+        else:
+            # Send stderr to a file rather than a pipe so a chatty child
+            # can never block on a full pipe.
+            stderr = tempfile.TemporaryFile()
         try:
-            p = subprocess.Popen(self.restart_command.split(),
-                                 stderr=subprocess.PIPE)
+            p = subprocess.Popen(self.restart_command.split(), stderr=stderr)
         except Exception:
-            log.exception("Failed to restart. {}".format(self))
+            log.exception("Failed to restart. %s", self.name)
+            if stderr:
+                stderr.close()
+            return False
+        if self.owns_child:
+            self.child = p
         else:
-            if p.poll(): # process has already terminated
-                log.warn("Process {} has terminated already. stderr={}"
-                            .format(self, p.stderr.read()))
+            self._popens.append((p, stderr))
+        return True
+
+    def stop_child(self):
+        """Terminate the child we own and wait for it to exit.  It is
+        killed if it's still running after STOP_TIMEOUT seconds."""
+        if self.child is None or not self._poll_child():
+            return
+        log.info("Stopping %s (pid %d)", self.name, self.child.pid)
+        self.child.terminate()
+        deadline = time.time() + self.STOP_TIMEOUT
+        while self._poll_child():
+            if time.time() > deadline:
+                log.warn("%s (pid %d) didn't exit after SIGTERM. Killing it.",
+                         self.name, self.child.pid)
+                self.child.kill()
+                self.child.wait()
+                break
+            time.sleep(0.05)
+
+    def child_exited(self):
+        """Returns True if we own a child and it has exited.  Never blocks."""
+        return self.child is not None and not self._poll_child()
+
+    def _poll_child(self):
+        """Returns True if our child is still running.  Reaps it if not."""
+        if self.child.returncode is None and self.child.poll() is not None:
+            log.warn("%s (pid %d) exited with code %s",
+                     self.name, self.child.pid, self.child.returncode)
+        return self.child.returncode is None
+
+    def reap(self):
+        """Reap any restart commands which have finished.
+
+        Returns:
+            False if a restart command exited with a non-zero return code.
+        """
+        success = True
+        for p, stderr in list(self._popens):
+            if p.poll() is None:
+                continue
+            self._popens.remove((p, stderr))
+            stderr.seek(0)
+            err = stderr.read()
+            stderr.close()
+            if p.returncode:
+                success = False
+                log.warn("Restart command for %s exited with code %s."
+                         " stderr=%s", self.name, p.returncode, err)
+        return success
+
+    def supervise(self):
+        """Restart this process if necessary and confirm earlier restarts.
+        Never blocks.  Call once per tick.
+
+        Returns:
+            HTML list items describing any actions taken, or "".
+        """
+        command_ok = self.reap() and not self.child_exited()
+        state = OK if self.running() else FAIL
+        now = time.time()
+
+        if state == OK:
+            self.given_up = False
+
+        if self.restart_pending:
+            if state == OK:
+                self.restart_pending = False
+                log.info("Successfully restarted. %s", self)
+                return ("<li>Confirmed restart of " + escape(self.name) +
+                        "</li>\n")
+            elif not command_ok or now - self.prev_restart_time > self.HEALTH_TIMEOUT:
+                self.restart_pending = False
+                log.warn("Restart of %s failed. Next retry in %.0fs",
+                         self.name, max(self.next_restart_time - now, 0))
+                return ("<li>Failed to restart " + escape(self.name) + "</li>\n")
             else:
-                log.info("Successfully restarted. {}".format(self) )
+                return ""
 
-    def state(self):
-        try:
-            self.pid()
-        except subprocess.CalledProcessError:
-            state = FAIL
+        if (state == OK or self.given_up or self.restart_command is None or 
+            now < self.next_restart_time):
+            return ""
+
+        if self.retries >= self.MAX_RESTART_RETRIES:
+            self.given_up = True
+            msg = "Max restart retries reached for " + self.name + ". Giving up."
+            log.warn(msg)
+            return "<li>" + escape(msg) + "</li>\n"
+
+        log.warn("Process %s is not running.", self.name)
+        self.restart()
+        return ("<li>Attempting to restart " + escape(self.name) + 
+                "...</li>\n")
+
+    def running(self):
+        """Returns True if the process is running.  Also records its pids."""
+        if self.child is not None:
+            running = self._poll_child()
+            self._pids = [self.child.pid] if running else []
         else:
-            state = OK
+            try:
+                self._pids = [int(pid) for pid in self.pid().split()]
+            except subprocess.CalledProcessError:
+                self._pids = []
+            running = bool(self._pids)
+        return running
+
+    def state(self):
+        state = OK if self.running() else FAIL
+        if state == OK and self._has_limits():
+            self.sample_resources()
+            if self.exceeded_limits():
+                state = FAIL
             
         # Reset self.retries if more than RESET_RETRIES_AFTER seconds
         # have elapsed since the last restart.
-        if self.retries:
+        if self.retries and not self.given_up:
             secs_since_last_restart = time.time() - self.prev_restart_time
-            if secs_since_last_restart > Process.RESET_RETRIES_AFTER:
+            if secs_since_last_restart > self.RESET_RETRIES_AFTER:
                 log.info("Resetting retries count.")
                 self.retries = 0
                                 
         return state
     
+    def _has_limits(self):
+        return any(limit is not None for limit in 
+                   [self.max_rss_mb, self.max_cpu_percent, 
+                    self.max_fds, self.max_threads])
+
+    def sample_resources(self):
+        """Sample RSS, CPU%, open fds and threads of self._pids from /proc.
+        Doesn't fork.  Does nothing if the previous sample was taken less
+        than RESOURCE_SAMPLE_INTERVAL seconds ago."""
+        now = time.time()
+        dt = now - self._prev_sample_time
+        if dt < self.RESOURCE_SAMPLE_INTERVAL:
+            return
+        
+        rss = fds = threads = 0
+        jiffies = {}
+        for pid in self._pids:
+            try:
+                with open('/proc/{:d}/stat'.format(pid)) as fh:
+                    stat = fh.read()
+            except IOError: # process has gone
+                continue
+            # Field 2 (comm) may contain spaces so split after its ')'
+            fields = stat[stat.rindex(')') + 2:].split()
+            jiffies[pid] = int(fields[11]) + int(fields[12]) # utime + stime
+            threads += int(fields[17])
+            rss += int(fields[21]) * self.PAGE_SIZE
+            try:
+                fds += len(os.listdir('/proc/{:d}/fd'.format(pid)))
+            except OSError: # not our process, or it has gone
+                pass
+
+        cpu_percent = None
+        common = set(jiffies) & set(self._prev_jiffies)
+        if common and self._prev_sample_time:
+            used = sum(jiffies[pid] - self._prev_jiffies[pid] for pid in common)
+            cpu_percent = 100 * used / (self.CLK_TCK * dt)
+
+        self._prev_sample_time = now
+        self._prev_jiffies = jiffies
+        self.resources = {'rss_mb': rss / 1024**2, 'cpu_percent': cpu_percent,
+                          'fds': fds, 'threads': threads}
+
+    def exceeded_limits(self):
+        """Returns a list of strings describing each limit exceeded by the
+        latest resource sample."""
+        exceeded = []
+        for key, limit in [('rss_mb', self.max_rss_mb),
+                           ('cpu_percent', self.max_cpu_percent),
+                           ('fds', self.max_fds),
+                           ('threads', self.max_threads)]:
+            value = self.resources.get(key)
+            if limit is not None and value is not None and value > limit:
+                exceeded.append("{}={:.1f} > {}".format(key, value, limit))
+        return exceeded
+
     def extra_text(self):
         msg = ""
         
+        if self.resources:
+            cpu = self.resources['cpu_percent']
+            msg += (" rss={:.1f}MB cpu={} fds={:d} threads={:d}."
+                    .format(self.resources['rss_mb'],
+                            "?" if cpu is None else "{:.1f}%".format(cpu),
+                            self.resources['fds'], self.resources['threads']))
+            exceeded = self.exceeded_limits()
+            if exceeded:
+                msg += " Exceeded: " + ", ".join(exceeded) + "."
+
+        if self.given_up:
+            msg += " Given up restarting."
+        elif self.restart_pending:
+            msg += " Restart pending."
+        
         if self.retries:
-            msg += " Retry {}/{}.".format(self.retries-1, 
-                                         Process.MAX_RESTART_RETRIES)
+            msg += " Retry {}/{}.".format(self.retries, 
+                                         self.MAX_RESTART_RETRIES)
                
         if self.prev_restart_time:
             dt = datetime.datetime.fromtimestamp(self.prev_restart_time)
@@ -275,6 +656,9 @@ class File(Checker):
     def seconds_since_modified(self):
         return time.time() - self.last_modified()
 
+    def settle_time(self):
+        return self.timeout
+
     def last_modified(self):
         try:
             t = os.path.getmtime(self.name)
@@ -298,147 +682,1021 @@ class File(Checker):
         return msg
 
 
-class FileGrows(Checker):
-    def __init__(self, name):
-        """FileGrows constructor. If a file grows (such an an error log file)
-        then state goes to FAIL.
-        
+class FileGlob(Checker):
+    """Monitors all files in one directory whose names match a glob
+    pattern, e.g. '/data/high-freq-mains/mains-*.dat'.  Wildcards are only
+    allowed in the last path component.
+
+    In 'newest' mode, state is OK if the most recently modified match is
+    younger than timeout.  This automatically follows rotation to a new
+    file.  While the directory's mtime is unchanged (so no files have been
+    added or removed) only the current newest file is stat'd, unless it has
+    gone stale, in which case the whole directory is rescanned.
+
+    In 'all' mode, state is OK if no match is older than timeout.  Every
+    match is stat'd on each check, using one listing of the directory.
+
+    Attributes:
+        pattern (str)
+        timeout (int): seconds
+        mode (str): 'newest' or 'all'
+        appliance (str): label
+        index (list of (mtime, filename)): matches from the latest scan,
+            oldest first.
+    """
+
+    MODES = ['newest', 'all']
+
+    def __init__(self, pattern, timeout=120, mode='newest', label=""):
+        """
         Args:
-            name (str) : including full path
+            pattern (str): including full path
+            timeout (int): seconds
+            mode (str): 'newest' or 'all'
+            label (str)
         """
-        self.name = name
-        self.last_size = self.size()
-        super(FileGrows, self).__init__(name)
+        if mode not in FileGlob.MODES:
+            raise ValueError("mode must be one of {}".format(FileGlob.MODES))
+        self.pattern = pattern
+        self.directory, self.basename_pattern = os.path.split(pattern)
+        self.timeout = int(timeout)
+        self.mode = mode
+        self.appliance = label
+        self.index = []
+        self._dir_mtime = None
+        super(FileGlob, self).__init__(pattern)
+
+    def scan(self):
+        """List the directory once and stat every match.  Updates index."""
+        try:
+            self._dir_mtime = os.stat(self.directory).st_mtime
+            names = fnmatch.filter(os.listdir(self.directory), 
+                                   self.basename_pattern)
+        except OSError: # directory not found
+            names = []
+        index = []
+        for name in names:
+            filename = os.path.join(self.directory, name)
+            try:
+                index.append((os.stat(filename).st_mtime, filename))
+            except OSError: # deleted since listdir
+                pass
+        index.sort()
+        if (self.index and index and self.mode == 'newest' and 
+            index[-1][1] != self.index[-1][1]):
+            log.info("%s now following %s", self.pattern, index[-1][1])
+        self.index = index
+
+    def _refresh_newest(self):
+        """Re-stat just the newest file if nothing has been added to or
+        removed from the directory, else rescan."""
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            dir_mtime = None
+        if (not self.index or dir_mtime != self._dir_mtime or
+            dir_mtime > time.time() - 2): # coarse mtime resolution
+            self.scan()
+            return
+        filename = self.index[-1][1]
+        try:
+            self.index[-1] = (os.stat(filename).st_mtime, filename)
+        except OSError:
+            self.scan()
+            return
+        if time.time() - self.index[-1][0] >= self.timeout:
+            # Perhaps another file is being written to.
+            self.scan()
 
     def state(self):
-        if self.size() == self.last_size:
-            return OK
+        if self.mode == 'newest':
+            self._refresh_newest()
+            if not self.index:
+                return FAIL
+            return time.time() - self.index[-1][0] < self.timeout
         else:
-            self.last_size = self.size()
-            return FAIL 
-    
-    def size(self):
-        try:
-            s = os.path.getsize(self.name)
-        except OSError: # file doesn't exist
-            s = 0
-        return s 
-    
+            self.scan()
+            if not self.index:
+                return FAIL
+            return time.time() - self.index[0][0] < self.timeout
+
+    def settle_time(self):
+        return self.timeout
+
     def extra_text(self):
-        msg = ", size {} bytes.".format(self.size())
+        msg = ""
+        if self.appliance:
+            msg += ", {}".format(self.appliance)
+        if not self.index:
+            return msg + ", no matching files!"
+        mtime, filename = self.index[-1] if self.mode == 'newest' else self.index[0]
+        msg += (", {} {} last modified {:.1f}s ago, {:d} files."
+                .format("newest" if self.mode == 'newest' else "oldest",
+                        os.path.basename(filename), time.time() - mtime,
+                        len(self.index)))
         return msg
 
 
-class DiskSpaceRemaining(Checker):
-    
-    def __init__(self, threshold, path='/'):
+class FileSet(Checker):
+    """Monitors many files, each with its own timeout, as a single checker.
+    Per-file data is held in parallel arrays rather than in one File
+    object per file.  Each tick, the files which were overdue are
+    re-evaluated one by one, and the rest are only evaluated (in one pass)
+    if the oldest of them is older than the shortest timeout.
+
+    State is OK if no file is overdue.  Each file is still reported
+    individually, both when it changes state and in Manager.html().
+
+    Attributes:
+        timeout (int): default timeout in seconds for files added without
+            one.
+        names (list of str): full paths
+        labels (list of str)
+        timeouts (array of floats): seconds
+        mtimes (array of floats): as of the last update(); 0 if missing.
+        states (array of OK/FAIL): as of the last update()
+        n_failing (int)
+    """
+
+    def __init__(self, name="files", timeout=120, files=None):
         """
         Args:
-            threshold (int or str): number of MBytes of free space below which
-                state will change to FAIL.
+            name (str)
+            timeout (int): default timeout in seconds
+            files (list): filenames, or (filename, timeout, label) lists.
         """
-        self.threshold = int(threshold)
-        self.path = path
-        self.initial_space_remaining = self.available_space()
-        self.initial_time = datetime.datetime.utcnow()
-        super(DiskSpaceRemaining, self).__init__('disk space')
-        
+        self.timeout = int(timeout)
+        self.names = []
+        self.labels = []
+        self.timeouts = array('d')
+        self.mtimes = array('d')
+        self.states = array('b')
+        self.n_failing = 0
+        self._failing = [] # indices of overdue files, in order
+        self._min_timeout = float('inf')
+        self._unreported = set() # indices changed since changed_html()
+        self._recovered = {} # index: seconds dead, since changed_html()
+        self._dead_durations = {} # as _recovered, as of changed_html()
+        for f in files or []:
+            if isinstance(f, basestring):
+                self.add(f)
+            else:
+                self.add(*f)
+        super(FileSet, self).__init__(name)
+
+    def add(self, filename, timeout=None, label=""):
+        """Start monitoring filename.  Returns its index."""
+        timeout = self.timeout if timeout is None else int(timeout)
+        mtime = self._mtime(filename)
+        state = mtime + timeout > time.time()
+        self.names.append(filename)
+        self.labels.append(label)
+        self.timeouts.append(timeout)
+        self.mtimes.append(mtime)
+        self.states.append(state)
+        self._min_timeout = min(self._min_timeout, timeout)
+        if not state:
+            self._failing.append(len(self.names) - 1)
+            self.n_failing += 1
+        return len(self.names) - 1
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def _mtime(filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError: # file not found
+            return 0
+
+    def update(self, now=None):
+        """Stat every file and re-evaluate every timeout.
+
+        Returns:
+            list of indices of the files which have changed state.
+        """
+        now = time.time() if now is None else float(now)
+        old_mtimes = self.mtimes
+        mtimes = self.mtimes = array('d', map(self._mtime, self.names))
+        timeouts = self.timeouts
+
+        # Common case: even the oldest file which was OK is younger than
+        # the shortest timeout, so only the overdue files can change.
+        ok_mtimes = mtimes[:]
+        for i in self._failing:
+            ok_mtimes[i] = float('inf')
+        if not ok_mtimes or min(ok_mtimes) + self._min_timeout > now:
+            changed = [i for i in self._failing 
+                       if mtimes[i] + timeouts[i] > now]
+            for i in changed:
+                self.states[i] = OK
+            failing = ([i for i in self._failing if self.states[i] == FAIL]
+                       if changed else self._failing)
+        else:
+            deadlines = map(operator.add, mtimes, timeouts)
+            self.states = array('b', map(now.__lt__, deadlines))
+            failing = list(itertools.compress(xrange(len(self.states)), 
+                                              map(operator.not_, self.states)))
+            changed = sorted(set(failing).symmetric_difference(self._failing))
+
+        # Keep changes until changed_html() reports them, even if they
+        # were found by another caller (e.g. state()).
+        self._unreported.update(changed)
+        for i in changed:
+            if self.states[i] == FAIL:
+                self._recovered.pop(i, None)
+            elif old_mtimes[i]:
+                self._recovered[i] = now - old_mtimes[i]
+        self._failing = failing
+        self.n_failing = len(failing)
+        return changed
+
     def state(self):
-        return self.available_space() > self.threshold 
-        
-    def available_space(self):
-        """Returns available disk space in MBytes."""
-        # From http://stackoverflow.com/a/787832/732596
-        s = os.statvfs(self.path)
-        return (s.f_bavail * s.f_frsize) / 1024**2
-    
-    def space_decay_rate(self):
-        """Returns rate at which space is diminishing in MByte per second.
-        -ve denotes decreasing disk space."""
-        dt = (datetime.datetime.utcnow() - self.initial_time).total_seconds() # delta t
-        ds = self.available_space() - self.initial_space_remaining # delta space
-        return ds / dt
-    
-    def time_until_full(self):
-        """Returns time delta object for time until disk is full."""
-        if ((datetime.datetime.utcnow() - self.initial_time).total_seconds() 
-            > UPDATE_PERIOD
-            and self.space_decay_rate() < 0):
-            secs_until_full = self.available_space() / -self.space_decay_rate() 
-            return datetime.timedelta(seconds=secs_until_full)
-    
+        self.update()
+        return self.n_failing == 0
+
+    def settle_time(self):
+        return max(self.timeouts) if len(self) else self.timeout
+
     def extra_text(self):
-        msg = ", remaining={:.0f} MB".format(self.available_space())
-        time_until_full = self.time_until_full()
-        if time_until_full:
-            msg += (", time until full={:d}days {:d}hrs {:d}mins"
-                    .format(time_until_full.days,
-                            time_until_full.seconds // 3600, 
-                            time_until_full.seconds //   60))
-            msg += ", full on {}".format((datetime.datetime.now() + time_until_full)
-                                         .strftime("%d/%m/%y %H:%M"))
+        return ", {:d} files, {:d} overdue.".format(len(self), self.n_failing)
 
-        return msg    
+    def row_html(self, i, now=None):
+        """Returns HTML describing the i'th file, in the same format as
+        File.html()."""
+        if now is None:
+            now = time.time()
+        msg = ""
+        if self.labels[i]:
+            msg += ", {}".format(self.labels[i])
+        if self.mtimes[i]:
+            msg += ", last modified {:.1f}s ago.".format(now - self.mtimes[i])
+            if i in self._dead_durations:
+                msg += " Was dead for {:.1f}s.".format(self._dead_durations[i])
+        else:
+            msg += ", does not exist!"
+        return '{}={}{}'.format(escape(self.names[i].rpartition('/')[2]),
+                                STATE_HTML[self.states[i]], escape(msg))
 
+    def changed_html(self):
+        self.last_state = self.state()
+        changed = sorted(self._unreported)
+        self._unreported = set()
+        self._dead_durations, self._recovered = self._recovered, {}
+        html = ""
+        now = time.time()
+        for i in changed:
+            if self.states[i] == FAIL:
+                log.warning('state change to FAIL: %s', self.names[i])
+            else:
+                log.info('state change: %s', self.names[i])
+            html += "<li>" + self.row_html(i, now) + "</li>\n"
+        return html
 
-def html_to_text(html):
-    # We could use ElementTree to convert from HTML to text
-    # but ET doesn't format tables the way I'd
-    # like them to be formatted.
-    
-    if html is None:
-        return
-    
-    # Unescape HTML entities e.g. map '&lt;' to '<'
-    # from http://stackoverflow.com/a/12614706/732596
-    h = HTMLParser.HTMLParser()
-    html = h.unescape(html)
-    
-    # Remove all unwanted white space
-    html = re.sub(r'^( )*', '', html, flags=re.MULTILINE)
-    html = re.sub(r'( )*$', '', html, flags=re.MULTILINE)
-    html = html.replace("\n", "")
-    
-    # Add desired white space
-    html = html.replace("</p>", "\n")
-    html = html.replace("</li>", "\n") 
-    html = html.replace("</tr>", "\n")   
-    html = html.replace("</th>", " ")  
-    html = html.replace("</td>", " ")  
-    html = re.sub(r"</h[0-9]>", "\n", html)
-    
-    # Replace basic formatting
-    html = html.replace("<li>", "* ")
-    html = html.replace("<em>", "*")
-    html = html.replace("</em>", "*")
-    html = html.replace("<b>", "**")
-    html = html.replace("<b>", "**")
-    html = html.replace("<h1>", "# ")
-    html = html.replace("<h2>", "## ")
-    html = html.replace("<h3>", "### ")
-    html = html.replace("<h4>", "#### ")
-    html = html.replace("<h5>", "##### ")
-    html = html.replace("<h6>", "###### ")
-  
-    # use regex to remove any other HTML tags
-    html = re.sub("""</?[a-zA-Z0-9( =:'"_!.,+/;\(\))]*/?>""", "", html)
-    
-    return html
+    def rows_html(self):
+        now = time.time()
+        return ''.join('  <li>{}</li>\n'.format(self.row_html(i, now))
+                       for i in xrange(len(self)))
 
 
-def escape(text):
-    """Escape ascii characters for HTML. e.g. convert '<' to '&lt;'"""
-    if text is None:
-        return
-    else:
-        return cgi.escape(text).encode('ascii', 'xmlcharrefreplace')
+class NetworkProbe(Checker):
+    """Abstract base class (ABC) for checkers which probe a network
+    endpoint.  Manager runs probe() for every NetworkProbe concurrently at
+    the start of each tick; state() just reports the latest result.
 
+    Attributes:
+        timeout (float): seconds
+        latencies (deque of floats): seconds taken by recent successful
+            probes.
+        ok (bool): result of the latest probe, or None if not yet probed.
+        error (str): why the latest probe failed.
+    """
 
-def run_commands(commands):
-    """Attempts to run a list of shell commands and returns stderr 
-    and, optionally stdout.
-    
-    Args:
+    N_LATENCIES = 100 # number of latencies kept for percentiles
+
+    def __init__(self, name, timeout=5):
+        self.timeout = timeout
+        self.latencies = collections.deque(maxlen=self.N_LATENCIES)
+        self.ok = None
+        self.error = ""
+        super(NetworkProbe, self).__init__(name)
+
+    @abstractmethod
+    def _probe(self):
+        """Probe the endpoint once.
+
+        Raises:
+            Exception: describing why the endpoint is unhealthy.
+        """
+        pass
+
+    def probe(self):
+        """Probe the endpoint and record the result.  Never raises."""
+        t0 = time.time()
+        try:
+            self._probe()
+        except Exception as e:
+            self.ok = False
+            self.error = str(e) or e.__class__.__name__
+        else:
+            self.ok = True
+            self.error = ""
+            self.latencies.append(time.time() - t0)
+
+    def state(self):
+        if self.ok is None:
+            self.probe()
+        return OK if self.ok else FAIL
+
+    def short_name(self):
+        return self.name
+
+    def percentile(self, percent):
+        """Returns the given percentile of recent latencies in seconds."""
+        if not self.latencies:
+            return
+        latencies = sorted(self.latencies)
+        i = int(round((len(latencies) - 1) * percent / 100))
+        return latencies[i]
+
+    def extra_text(self):
+        msg = ""
+        if self.error:
+            msg += ", " + self.error
+        if self.latencies:
+            msg += (", latency p50={:.1f}ms p95={:.1f}ms max={:.1f}ms"
+                    .format(1000 * self.percentile(50), 
+                            1000 * self.percentile(95),
+                            1000 * max(self.latencies)))
+        return msg
+
+
+class TCPProbe(NetworkProbe):
+    """OK if we can open a TCP connection to host:port."""
+
+    def __init__(self, host, port, timeout=5):
+        self.host = host
+        self.port = int(port)
+        super(TCPProbe, self).__init__("{}:{:d}".format(host, self.port), 
+                                       timeout)
+
+    def _probe(self):
+        socket.create_connection((self.host, self.port), self.timeout).close()
+
+
+class HTTPProbe(NetworkProbe):
+    """OK if an HTTP(S) GET of url returns expected_status and, optionally,
+    a body containing expected_body.  The connection is kept alive and
+    reused between probes if the server allows it."""
+
+    def __init__(self, url, expected_status=200, expected_body=None, timeout=5):
+        self.url = url
+        self.expected_status = int(expected_status)
+        self.expected_body = expected_body
+        parsed = urlparse.urlsplit(url)
+        self._scheme = parsed.scheme
+        self._netloc = parsed.netloc
+        self._path = parsed.path or '/'
+        if parsed.query:
+            self._path += '?' + parsed.query
+        self._conn = None
+        super(HTTPProbe, self).__init__(url, timeout)
+
+    def _connection(self):
+        if self._conn is None:
+            if self._scheme == 'https':
+                conn_class = httplib.HTTPSConnection
+            else:
+                conn_class = httplib.HTTPConnection
+            self._conn = conn_class(self._netloc, timeout=self.timeout)
+        return self._conn
+
+    def _probe(self):
+        conn = self._connection()
+        reused = conn.sock is not None
+        try:
+            response, body = self._get(conn)
+        except (httplib.BadStatusLine, socket.error) as e:
+            # The server may have closed the idle connection since the
+            # previous probe (e.g. Apache's default KeepAliveTimeout is
+            # 5s, shorter than a tick).  Then the request fails before
+            # any response, so retry once on a new connection.
+            if not reused or (isinstance(e, socket.error) and 
+                              e.errno not in (errno.ECONNRESET, errno.EPIPE)):
+                raise
+            response, body = self._get(self._connection())
+        if response.status != self.expected_status:
+            raise Exception("HTTP status {:d} {}".format(response.status,
+                                                         response.reason))
+        if self.expected_body is not None and self.expected_body not in body:
+            raise Exception("Body does not contain '{}'"
+                            .format(self.expected_body))
+
+    def _get(self, conn):
+        """Returns the response and body of a GET on conn."""
+        try:
+            conn.request('GET', self._path)
+            response = conn.getresponse()
+            body = response.read() # must read everything to reuse conn
+        except (httplib.HTTPException, socket.error):
+            self.close()
+            raise
+        if response.will_close:
+            self.close()
+        return response, body
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class TailReader(object):
+    """Reads only the bytes appended to a file since the previous read.
+    If the file is truncated or replaced (e.g. rotated) then reading
+    starts again from the beginning of the new file.
+
+    If the file already exists when the TailReader is created then reading
+    starts from the beginning, or from the end (from_end), or from the
+    start of its last complete line (from_last_line).
+
+    Attributes:
+        filename (str)
+        offset (int): byte offset of the next read.
+        max_bytes (int): maximum number of bytes to read per call, so a
+            large backlog is consumed over several calls.
+    """
+
+    LAST_LINE_BLOCK_SIZE = 4096 # bytes read at a time to find the last line
+
+    def __init__(self, filename, from_end=False, max_bytes=4 * 1024**2,
+                 from_last_line=False):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.offset = 0
+        self._inode = None
+        self._partial = "" # incomplete last line from the previous read
+        if from_end or from_last_line:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                pass
+            else:
+                self._inode = st.st_ino
+                self.offset = st.st_size
+                if from_last_line:
+                    self.offset = self._last_line_offset(st.st_size)
+
+    def _last_line_offset(self, size):
+        """Returns the offset of the start of the last complete line in the
+        first size bytes of the file, reading backwards from size."""
+        block_size = TailReader.LAST_LINE_BLOCK_SIZE
+        try:
+            with open(self.filename, 'rb') as fh:
+                while True:
+                    start = max(size - block_size, 0)
+                    fh.seek(start)
+                    data = fh.read(size - start)
+                    end = data.rfind('\n') # end of the last complete line
+                    if end != -1:
+                        line_start = data.rfind('\n', 0, end) + 1
+                        if line_start or not start:
+                            return start + line_start
+                    elif not start:
+                        return 0 # no complete lines
+                    block_size *= 2 # the last lines are longer than block_size
+        except IOError:
+            return 0
+
+    def read_lines(self):
+        """Returns a string of the complete lines appended since the previous
+        call (or "" if there are none).  A trailing partial line is kept
+        back until it is completed."""
+        try:
+            st = os.stat(self.filename)
+        except OSError: # file not found
+            return ""
+
+        if st.st_ino != self._inode or st.st_size < self.offset:
+            if self._inode is not None:
+                log.info("%s has been truncated or replaced.", self.filename)
+            self._inode = st.st_ino
+            self.offset = 0
+            self._partial = ""
+
+        if st.st_size == self.offset:
+            return ""
+
+        try:
+            with open(self.filename, 'rb') as fh:
+                fh.seek(self.offset)
+                data = fh.read(min(st.st_size - self.offset, self.max_bytes))
+        except IOError:
+            return ""
+        self.offset += len(data)
+
+        data = self._partial + data
+        end = data.rfind('\n') + 1
+        self._partial = data[end:]
+        return data[:end]
+
+
+class LogPattern(Checker):
+    """Counts matches of several regular expressions in the lines appended
+    to a log file, e.g. "CRC error" in rfm_ecomanager_logger.log.  State is
+    FAIL while any pattern has matched more than its max_count times in
+    the last window seconds.
+
+    Only newly appended bytes are read (see TailReader, which also follows
+    rotation) and all the patterns are combined into one alternation, so
+    each check is a single regex pass over the new bytes.  At any position
+    in the log, only the first pattern which matches there is counted.
+    Patterns mustn't use numbered backreferences.
+
+    Attributes:
+        patterns (list of dicts): with keys 'name', 'regex', 'max_count'
+            (None means never FAIL) and 'window' (seconds).
+        appliance (str): label
+        reader (TailReader)
+        totals (list of ints): matches per pattern since we started.
+    """
+
+    PATTERN_KEYS = ['regex', 'name', 'max_count', 'window']
+    critical = False # unread lines wait in the log until we catch up
+
+    def __init__(self, filename, patterns, label="", from_end=True):
+        """
+        Args:
+            filename (str): including full path
+            patterns (list): regex strings, or dicts with key 'regex' and
+                optional keys 'name', 'max_count' and 'window' (default 60).
+            label (str)
+            from_end (bool): if True then ignore what's already in the file.
+
+        Raises:
+            ValueError if the patterns are invalid.
+        """
+        self.patterns, self._regex = LogPattern.compile(patterns)
+        # Maps the group number of each alternative to its pattern index
+        self._pattern_index = dict((self._regex.groupindex['_p{:d}'.format(i)], i)
+                                   for i in range(len(self.patterns)))
+        self.appliance = label
+        self.reader = TailReader(filename, from_end=from_end)
+        self.totals = [0] * len(self.patterns)
+        self._windows = [collections.deque() for _ in self.patterns] # (time, count)
+        self._window_counts = [0] * len(self.patterns)
+        super(LogPattern, self).__init__(filename)
+
+    @staticmethod
+    def compile(patterns):
+        """Returns (list of pattern dicts with defaults filled in, a single
+        compiled regex matching any pattern).
+
+        Raises:
+            ValueError
+        """
+        normalised = []
+        alternatives = []
+        for i, pattern in enumerate(patterns):
+            if isinstance(pattern, basestring):
+                pattern = {'regex': pattern}
+            if ('regex' not in pattern or 
+                set(pattern) - set(LogPattern.PATTERN_KEYS)):
+                raise ValueError("Each pattern must be a regex or a dict with "
+                                 "keys from {}".format(LogPattern.PATTERN_KEYS))
+            try:
+                re.compile(pattern['regex'])
+            except re.error as e:
+                raise ValueError("Invalid regex '{}': {}"
+                                 .format(pattern['regex'], e))
+            normalised.append({'regex': pattern['regex'],
+                               'name': pattern.get('name', pattern['regex']),
+                               'max_count': pattern.get('max_count'),
+                               'window': pattern.get('window', 60)})
+            alternatives.append("(?P<_p{:d}>{})".format(i, pattern['regex']))
+        if not normalised:
+            raise ValueError("LogPattern needs at least one pattern")
+        return normalised, re.compile("|".join(alternatives), re.MULTILINE)
+
+    def update(self, now=None):
+        """Count matches in the lines appended since the previous call and
+        forget matches older than each pattern's window."""
+        now = time.time() if now is None else now
+        data = self.reader.read_lines()
+        if data:
+            counts = [0] * len(self.patterns)
+            for match in self._regex.finditer(data):
+                counts[self._pattern_index[match.lastindex]] += 1
+            for i, count in enumerate(counts):
+                if count:
+                    self.totals[i] += count
+                    self._windows[i].append((now, count))
+                    self._window_counts[i] += count
+
+        for i, window in enumerate(self._windows):
+            oldest = now - self.patterns[i]['window']
+            while window and window[0][0] <= oldest:
+                self._window_counts[i] -= window.popleft()[1]
+
+    def window_count(self, i):
+        """Returns the number of matches of pattern i in its window."""
+        return self._window_counts[i]
+
+    def rate(self, i):
+        """Returns matches of pattern i per minute, over its window."""
+        return self._window_counts[i] * 60 / self.patterns[i]['window']
+
+    def state(self):
+        self.update()
+        for pattern, count in zip(self.patterns, self._window_counts):
+            if pattern['max_count'] is not None and count > pattern['max_count']:
+                return FAIL
+        return OK
+
+    def extra_text(self):
+        msg = ""
+        if self.appliance:
+            msg += ", {}".format(self.appliance)
+        for i, pattern in enumerate(self.patterns):
+            msg += (", '{}' {:d} times in last {:g}s"
+                    .format(pattern['name'], self._window_counts[i],
+                            pattern['window']))
+            if pattern['max_count'] is not None:
+                msg += " (max {:d})".format(pattern['max_count'])
+            msg += ", {:d} in total".format(self.totals[i])
+        return msg + "."
+
+
+class ChannelData(Checker):
+    """Validates the contents of a REDD-formatted channel_N.dat file,
+    in which each line is '<unix timestamp> <value>'.  Only lines appended
+    since the previous check are parsed, so the cost per tick is
+    proportional to the amount of new data.  If the file already exists
+    then parsing starts from its last complete line.
+
+    State is FAIL if the most recently parsed lines contained malformed
+    lines, non-monotonic timestamps, gaps longer than max_gap or values
+    outside [min_value, max_value], or if the same value has been repeated
+    more than max_repeats times in a row (i.e. the logger is writing frozen
+    values).  State stays the same while no new lines arrive; use File to
+    check that the file is still growing.
+
+    Running statistics (sample rate, longest gap, uptime) are kept up to
+    date from the same new lines, so heartbeats can report them without
+    re-reading the whole file.
+
+    Attributes:
+        appliance (str): label
+        sample_period (float): expected seconds between samples.
+        stats (dict): totals since we started: 'samples', 'malformed',
+            'non_monotonic', 'gaps', 'out_of_range'.
+        first_timestamp (float or None)
+        longest_gap (float): longest interval between samples, in seconds.
+        covered_secs (float): total of all intervals no longer than max_gap.
+        repeats (int): number of times the latest value has been repeated.
+        problems (list of str): what was wrong with the latest new lines.
+    """
+
+    STAT_KEYS = ['samples', 'malformed', 'non_monotonic', 'gaps', 
+                 'out_of_range']
+    critical = False # unparsed lines wait in the file until we catch up
+
+    def __init__(self, name, label="", max_gap=120, min_value=0,
+                 max_value=100000, max_repeats=None, sample_period=6):
+        """
+        Args:
+            name (str): including full path
+            label (str)
+            max_gap (float): seconds
+            sample_period (float): expected seconds between samples.
+            min_value, max_value (float)
+            max_repeats (int or None): None disables the frozen value check.
+        """
+        self.appliance = label
+        self.max_gap = max_gap
+        self.min_value = min_value
+        self.max_value = max_value
+        self.max_repeats = max_repeats
+        self.sample_period = sample_period
+        self.stats = dict((key, 0) for key in ChannelData.STAT_KEYS)
+        self.first_timestamp = None
+        self.longest_gap = 0.0
+        self.covered_secs = 0.0
+        self.repeats = 0
+        self.problems = []
+        self._last_timestamp = None
+        self._last_value = None
+        # Only the latest sample is needed, so don't parse an existing file
+        self._reader = TailReader(name, from_last_line=True)
+        super(ChannelData, self).__init__(name)
+
+    def state(self):
+        self.update()
+        return FAIL if self.problems else OK
+
+    def update(self):
+        """Parse and validate any newly appended lines."""
+        chunk = self._reader.read_lines()
+        if not chunk:
+            return
+        timestamps, values, malformed = parse_channel_data(chunk)
+        if len(timestamps) or malformed:
+            self.validate(timestamps, values, malformed)
+
+    def validate(self, timestamps, values, malformed=0):
+        """Validate a new block of samples and update stats and problems.
+
+        Args:
+            timestamps, values (sequences of floats)
+            malformed (int): number of lines which couldn't be parsed.
+        """
+        prev_t = self._last_timestamp
+        prev_v = self._last_value
+        if prev_t is None and len(timestamps):
+            prev_t = timestamps[0]
+            prev_v = values[0]
+            self.repeats = -1 # don't count the first sample as a repeat
+            self.first_timestamp = prev_t
+
+        non_monotonic = gaps = out_of_range = 0
+        repeats = self.repeats
+        longest_gap = self.longest_gap
+        covered = 0.0
+        min_value = self.min_value
+        max_value = self.max_value
+        max_gap = self.max_gap
+        for t, v in zip(timestamps, values):
+            dt = t - prev_t
+            if dt < 0:
+                non_monotonic += 1
+            elif dt > max_gap:
+                gaps += 1
+            else:
+                covered += dt
+            if dt > longest_gap:
+                longest_gap = dt
+            if v < min_value or v > max_value:
+                out_of_range += 1
+            if v == prev_v:
+                repeats += 1
+            else:
+                repeats = 0
+            prev_t = t
+            prev_v = v
+
+        self._last_timestamp = prev_t
+        self._last_value = prev_v
+        self.repeats = repeats
+        self.longest_gap = longest_gap
+        self.covered_secs += covered
+        counts = {'samples': len(timestamps), 'malformed': malformed,
+                  'non_monotonic': non_monotonic, 'gaps': gaps,
+                  'out_of_range': out_of_range}
+        self.problems = []
+        for key in ChannelData.STAT_KEYS:
+            self.stats[key] += counts[key]
+            if key != 'samples' and counts[key]:
+                self.problems.append("{}={:d}".format(key, counts[key]))
+        if self.max_repeats is not None and repeats > self.max_repeats:
+            self.problems.append("value {} repeated {:d} times"
+                                 .format(prev_v, repeats))
+
+    def settle_time(self):
+        return self.max_gap
+
+    def span(self):
+        """Returns seconds between the first and the latest sample."""
+        if self.first_timestamp is None:
+            return 0.0
+        return self._last_timestamp - self.first_timestamp
+
+    def sample_rate(self):
+        """Returns the actual number of samples per second, or None."""
+        span = self.span()
+        if span > 0:
+            return (self.stats['samples'] - 1) / span
+
+    def uptime_percent(self):
+        """Returns the percentage of time covered by samples no further
+        apart than max_gap, or None."""
+        span = self.span()
+        if span > 0:
+            return 100 * self.covered_secs / span
+
+    def stats_html(self):
+        """Returns an HTML table row of running statistics.  See
+        channel_stats_html()."""
+        rate = self.sample_rate()
+        uptime = self.uptime_percent()
+        cells = [escape(self.name.rpartition('/')[2]), escape(self.appliance),
+                 "{:d}".format(self.stats['samples']),
+                 "{:.3f}".format(1 / self.sample_period),
+                 "-" if rate is None else "{:.3f}".format(rate),
+                 "{:.0f}".format(self.longest_gap),
+                 "-" if uptime is None else "{:.1f}".format(uptime)]
+        return "<tr>" + "".join("<td>" + cell + "</td>" for cell in cells) + "</tr>\n"
+
+    def extra_text(self):
+        msg = ""
+        if self.appliance:
+            msg += ", {}".format(self.appliance)
+        msg += ", data: " + " ".join("{}={:d}".format(key, self.stats[key])
+                                     for key in ChannelData.STAT_KEYS)
+        if self.problems:
+            msg += ". Latest problems: " + ", ".join(self.problems)
+        return msg + "."
+
+
+def channel_stats_html(checkers):
+    """Returns an HTML table of running statistics for every ChannelData in
+    checkers, or "" if there are none."""
+    rows = [checker.stats_html() for checker in checkers
+            if isinstance(checker, ChannelData)]
+    if not rows:
+        return ""
+    return ("<h2>CHANNEL STATISTICS:</h2>\n<table>\n"
+            "<tr><th>file</th><th>label</th><th>samples</th>"
+            "<th>expected rate (Hz)</th><th>actual rate (Hz)</th>"
+            "<th>longest gap (s)</th><th>uptime (%)</th></tr>\n" +
+            "".join(rows) + "</table>\n")
+
+
+def parse_channel_data(chunk):
+    """Parse lines of '<timestamp> <value>'.
+
+    Returns:
+        timestamps (array of floats), values (array of floats),
+        number of malformed lines
+    """
+    # Fast path: if every line is exactly '<field> <field>\n' then every
+    # third token is a newline.  Anything else (blank lines, extra
+    # fields, other whitespace) is left to the slow path.
+    n_lines = chunk.count('\n')
+    tokens = chunk.replace('\n', ' \n ').split(' ')
+    if len(tokens) == 3 * n_lines + 1 and tokens[2::3].count('\n') == n_lines:
+        try:
+            return (array('d', map(float, tokens[0:-1:3])),
+                    array('d', map(float, tokens[1::3])), 0)
+        except ValueError:
+            pass
+
+    timestamps = array('d')
+    values = array('d')
+    malformed = 0
+    for line in chunk.splitlines():
+        try:
+            t, v = line.split()
+            t, v = float(t), float(v)
+        except ValueError:
+            malformed += 1
+        else:
+            timestamps.append(t)
+            values.append(v)
+    return timestamps, values, malformed
+
+
+class FileGrows(Checker):
+    def __init__(self, name):
+        """FileGrows constructor. If a file grows (such an an error log file)
+        then state goes to FAIL.
+        
+        Args:
+            name (str) : including full path
+        """
+        self.name = name
+        self.last_size = self.size()
+        super(FileGrows, self).__init__(name)
+
+    def state(self):
+        if self.size() == self.last_size:
+            return OK
+        else:
+            self.last_size = self.size()
+            return FAIL 
+    
+    def size(self):
+        try:
+            s = os.path.getsize(self.name)
+        except OSError: # file doesn't exist
+            s = 0
+        return s 
+    
+    def extra_text(self):
+        msg = ", size {} bytes.".format(self.size())
+        return msg
+
+
+class DiskSpaceRemaining(Checker):
+    
+    def __init__(self, threshold, path='/'):
+        """
+        Args:
+            threshold (int or str): number of MBytes of free space below which
+                state will change to FAIL.
+        """
+        self.threshold = int(threshold)
+        self.path = path
+        self.initial_space_remaining = self.available_space()
+        self.initial_time = datetime.datetime.utcnow()
+        super(DiskSpaceRemaining, self).__init__('disk space')
+        
+    def state(self):
+        return self.available_space() > self.threshold 
+        
+    def available_space(self):
+        """Returns available disk space in MBytes."""
+        # From http://stackoverflow.com/a/787832/732596
+        s = os.statvfs(self.path)
+        return (s.f_bavail * s.f_frsize) / 1024**2
+    
+    def space_decay_rate(self):
+        """Returns rate at which space is diminishing in MByte per second.
+        -ve denotes decreasing disk space."""
+        dt = (datetime.datetime.utcnow() - self.initial_time).total_seconds() # delta t
+        ds = self.available_space() - self.initial_space_remaining # delta space
+        return ds / dt
+    
+    def time_until_full(self):
+        """Returns time delta object for time until disk is full."""
+        if ((datetime.datetime.utcnow() - self.initial_time).total_seconds() 
+            > UPDATE_PERIOD
+            and self.space_decay_rate() < 0):
+            secs_until_full = self.available_space() / -self.space_decay_rate() 
+            return datetime.timedelta(seconds=secs_until_full)
+    
+    def extra_text(self):
+        msg = ", remaining={:.0f} MB".format(self.available_space())
+        time_until_full = self.time_until_full()
+        if time_until_full:
+            msg += (", time until full={:d}days {:d}hrs {:d}mins"
+                    .format(time_until_full.days,
+                            time_until_full.seconds // 3600, 
+                            time_until_full.seconds //   60))
+            msg += ", full on {}".format((datetime.datetime.now() + time_until_full)
+                                         .strftime("%d/%m/%y %H:%M"))
+
+        return msg    
+
+
+def html_to_text(html):
+    # We could use ElementTree to convert from HTML to text
+    # but ET doesn't format tables the way I'd
+    # like them to be formatted.
+    
+    if html is None:
+        return
+    
+    # Unescape HTML entities e.g. map '&lt;' to '<'
+    # from http://stackoverflow.com/a/12614706/732596
+    h = HTMLParser.HTMLParser()
+    html = h.unescape(html)
+    
+    # Remove all unwanted white space
+    html = re.sub(r'^( )*', '', html, flags=re.MULTILINE)
+    html = re.sub(r'( )*$', '', html, flags=re.MULTILINE)
+    html = html.replace("\n", "")
+    
+    # Add desired white space
+    html = html.replace("</p>", "\n")
+    html = html.replace("</li>", "\n") 
+    html = html.replace("</tr>", "\n")   
+    html = html.replace("</th>", " ")  
+    html = html.replace("</td>", " ")  
+    html = re.sub(r"</h[0-9]>", "\n", html)
+    
+    # Replace basic formatting
+    html = html.replace("<li>", "* ")
+    html = html.replace("<em>", "*")
+    html = html.replace("</em>", "*")
+    html = html.replace("<b>", "**")
+    html = html.replace("<b>", "**")
+    html = html.replace("<h1>", "# ")
+    html = html.replace("<h2>", "## ")
+    html = html.replace("<h3>", "### ")
+    html = html.replace("<h4>", "#### ")
+    html = html.replace("<h5>", "##### ")
+    html = html.replace("<h6>", "###### ")
+  
+    # use regex to remove any other HTML tags
+    html = re.sub("""</?[a-zA-Z0-9( =:'"_!.,+/;\(\))]*/?>""", "", html)
+    
+    return html
+
+
+def escape(text):
+    """Escape ascii characters for HTML. e.g. convert '<' to '&lt;'"""
+    if text is None:
+        return
+    else:
+        return cgi.escape(text).encode('ascii', 'xmlcharrefreplace')
+
+
+def run_commands(commands):
+    """Attempts to run a list of shell commands and returns stderr 
+    and, optionally stdout.
+    
+    Args:
         - commands (list of two-item tuples).
           The two fields in each tuple are: 
             1. cmd (string): A shell command e.g. 'tail -f logfile.log'
@@ -446,87 +1704,1518 @@ def run_commands(commands):
                returned string to include stdout output from the command.
     
     Returns:
-        An HTML-formatted string containing any stderr output the command
-        generated plus and stdout output the command generated.
-        stdout output is only output if 'send_stdout' is True
-        or if an error occurred when running the command.
+        An HTML-formatted string containing any stderr output the command
+        generated plus and stdout output the command generated.
+        stdout output is only output if 'send_stdout' is True
+        or if an error occurred when running the command.
+        
+    """
+    msg = ""
+    for cmd, send_stdout in commands:        
+        msg += "<hr/>\n"
+        log.info("Attempting to run command %s", cmd)
+        try:
+            p = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            p.wait()
+        except Exception:
+            m = ("<h2 style=\"color:red\">Failed to run <code>{}</code></h2>\n"
+                 .format(escape(cmd)))
+            msg += m
+            log.exception("Failed to run %s", cmd)
+        else:
+            if p.returncode == 0:
+                m = ("<h2>Successfully ran <code>{}</code></h2>\n"
+                     .format(escape(cmd)))
+                msg += m
+                log.info("Successfully ran %s", cmd)
+            else:
+                m = ("<h2 style=\"color:red\">Failed to run <code>{}</code>"
+                     "</h2>\n".format(escape(cmd)))
+                msg += m
+                log.warn("Failed to run %s", cmd)
+
+            stderr = p.stderr.read()
+            stdout = p.stdout.read()                
+            
+            if (send_stdout or stderr) and stdout:
+                msg += ("<h3>stdout</h3>\n <pre>{}</pre>\n"
+                        .format(escape(stdout)))
+                
+            if stderr:
+                msg += "<h3 style=\"color:red\">stderr</h3>\n"
+                msg += ("<pre style=\"color:red\">{}</pre>\n"
+                        .format(escape(stderr)))
+
+    return msg
+
+
+def load_html_file(filename):
+    """Parse an HTML file (e.g. powerstats' index.html) and prefix the
+    src of each <img> with "cid:" so the images can be attached to an email.
+
+    Returns:
+        (html, img_files)
+
+    Raises:
+        Any exception raised by ElementTree if the file can't be parsed.
+    """
+    tree = ET.parse(filename)
+    directory = os.path.dirname(filename)
+    img_files = []
+    for img in tree.getiterator('img'):
+        img_files.append(os.path.join(directory, img.get('src')))
+        img.set('src', "cid:"+img.get('src'))
+    return ET.tostring(tree.getroot()), img_files
+
+
+def prepare_report(cmds, html_file):
+    """Run the heartbeat commands and load the heartbeat HTML file.  This
+    is the slow part of a full heartbeat, so Manager runs it in a worker
+    process.
+
+    Returns:
+        dict with keys 'cmds_html' (see run_commands), 'html' and
+        'img_files' (see load_html_file; 'html' is None if html_file
+        couldn't be loaded), 'error' (str) and 'prepared' (unixtime).
+    """
+    report = {'cmds_html': run_commands(cmds), 'html': None,
+              'img_files': [], 'error': ""}
+    try:
+        report['html'], report['img_files'] = load_html_file(html_file)
+    except Exception as e:
+        report['error'] = ("Failed to open filename {}; exception = '{}'"
+                           .format(html_file, str(e)))
+        log.warn(report['error'])
+    report['prepared'] = time.time()
+    return report
+
+
+# Records logged in a report worker.  See _init_report_worker.
+_report_log = None
+
+
+def _init_report_worker():
+    """Runs in each report worker process.  Undo the signal setup we
+    inherited from the Manager and put the worker in its own process group
+    so that, if it is terminated, the commands it is running die too.
+
+    The inherited log handlers can't be used here (e.g. a QueueHandler's
+    listener thread isn't forked, and two processes mustn't rotate the
+    same log file) so every record is queued instead and returned with
+    the report for the Manager to log (see _worker_prepare_report)."""
+    global _report_log
+    _report_log = Queue.Queue(10000)
+    loggers = [logging.getLogger()] + [
+        logger for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)]
+    for logger in loggers:
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+    logging.getLogger().addHandler(QueueHandler(_report_log))
+    signal.set_wakeup_fd(-1)
+    for sig in (signal.SIGCHLD, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.setpgrp()
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: os.killpg(os.getpgrp(), signal.SIGKILL))
+
+
+def _worker_prepare_report(cmds, html_file):
+    """prepare_report() in a report worker.  The records it logged are
+    returned in the report under 'log_records'."""
+    report = prepare_report(cmds, html_file)
+    records = []
+    while True:
+        try:
+            record = _report_log.get_nowait()
+        except Queue.Empty:
+            break
+        if record.exc_info:
+            # Tracebacks can't be pickled, so format them here
+            record.exc_text = logging.Formatter().formatException(
+                                  record.exc_info)
+            record.exc_info = None
+        records.append(record)
+    report['log_records'] = records
+    return report
+
+
+def get_ip_address():
+    # from http://commandline.org.uk/python/how-to-find-out-ip-address-in-python/
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(('google.com', 0))
+    except:
+        log.exception("Failed to get IP address.")
+        ip_address = 0
+    else:
+        ip_address = s.getsockname()[0]
+        
+    return ip_address
+
+
+class QueueHandler(logging.Handler):
+    """A logging handler which puts records on a bounded queue, to be
+    written out by a QueueListener in another thread, so that logging
+    never blocks the monitoring thread on disk or console I/O.  If the
+    queue is full then the record is dropped and counted.  (Python 2 has
+    no logging.handlers.QueueHandler.)
+
+    Attributes:
+        queue (Queue.Queue)
+        dropped (int): number of records dropped because the queue was full.
+        listener (QueueListener or None): stopped (after it has handled
+            every queued record) when this handler is closed, e.g. by
+            logging.shutdown().
+    """
+
+    def __init__(self, queue, listener=None):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.listener = listener
+        self.dropped = 0
+        self._reported_dropped = 0
+
+    def prepare(self, record):
+        # Merge the args into the message here, as args may be live
+        # objects (e.g. Checkers) which mustn't be str()'d from another
+        # thread.  Full formatting is left to the listener's handlers.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            if self.dropped != self._reported_dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING, 
+                    'levelname': 'WARNING', 'funcName': 'emit',
+                    'msg': "Log queue full. Dropped %d records so far.",
+                    'args': (self.dropped,)}))
+                self._reported_dropped = self.dropped
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+        logging.Handler.close(self)
+
+
+class QueueListener(object):
+    """Takes records off a queue filled by a QueueHandler and passes them
+    to handlers in a background thread.  Records are handled in batches
+    of up to batch_size, and each handler is flushed once per batch
+    rather than once per record.
+
+    Attributes:
+        queue (Queue.Queue)
+        handlers (list of logging.Handlers)
+        batch_size (int)
+    """
+
+    _SENTINEL = None
+
+    def __init__(self, queue, *handlers, **kwargs):
+        """
+        Args:
+            queue (Queue.Queue)
+            *handlers (logging.Handlers)
+            batch_size (int): keyword only.  Max records per batch.
+        """
+        self.queue = queue
+        self.handlers = list(handlers)
+        self.batch_size = kwargs.pop('batch_size', 100)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments {}".format(kwargs.keys()))
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Handle every record already on the queue, then stop."""
+        if self._thread is not None:
+            self.queue.put(self._SENTINEL)
+            self._thread.join()
+            self._thread = None
+
+    def _monitor(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = self._SENTINEL in batch
+            self.handle([record for record in batch if record is not self._SENTINEL])
+            if stop:
+                return
+
+    def handle(self, records):
+        for handler in self.handlers:
+            handler.acquire()
+            try:
+                # StreamHandler.emit() flushes after every record.  Defer
+                # that until the end of the batch.
+                handler.flush = _no_flush
+                try:
+                    for record in records:
+                        if record.levelno >= handler.level:
+                            handler.handle(record)
+                finally:
+                    del handler.flush
+                handler.flush()
+            finally:
+                handler.release()
+
+
+def _no_flush():
+    pass
+
+
+class Attachment(object):
+    """An image attached to an email.  Unless `data` is given, the file
+    is only read, one block at a time, while the email is being sent.
+
+    Attributes:
+        filename (str): including full path.
+        basename (str): used as the attachment's filename and Content-ID.
+        data (str): optional in-memory contents (e.g. a thumbnail).
+        size (int): size in bytes before base64 encoding.
+    """
+
+    BLOCK_SIZE = 57 * 1024 # a multiple of 57 so each block encodes to whole lines
+
+    def __init__(self, filename, data=None):
+        self.filename = filename
+        self.basename = os.path.basename(filename)
+        self.data = data
+        if data is None:
+            self.size = os.path.getsize(filename)
+        else:
+            self.size = len(data)
+
+    def encoded_size(self):
+        """Number of bytes this attachment's MIME part (headers and base64
+        lines) will take up in the email."""
+        return len(self._part_headers()) + (self.size // 57 + 1) * 78
+
+    def max_size(self, encoded_bytes):
+        """Returns the largest size (before encoding) whose encoded_size()
+        is at most encoded_bytes."""
+        return (encoded_bytes - len(self._part_headers())) // 78 * 57 - 1
+
+    def content_type(self):
+        return mimetypes.guess_type(self.basename)[0] or 'image/png'
+
+    def _part_headers(self):
+        return ('Content-Type: {}\r\n'
+                'MIME-Version: 1.0\r\n'
+                'Content-Transfer-Encoding: base64\r\n'
+                'Content-Disposition: attachment; filename="{}"\r\n'
+                'Content-ID: <{}>\r\n\r\n'
+                .format(self.content_type(), self.basename, self.basename))
+
+    def chunks(self):
+        """Generator yielding the MIME part, base64 encoded with CRLF line
+        endings."""
+        yield self._part_headers()
+        if self.data is not None:
+            fp = StringIO.StringIO(self.data)
+        else:
+            try:
+                fp = open(self.filename, 'rb')
+            except IOError:
+                log.warn("Can't open image file %s", self.filename)
+                return
+        try:
+            while True:
+                block = fp.read(Attachment.BLOCK_SIZE)
+                if not block:
+                    break
+                yield base64.encodestring(block).replace('\n', '\r\n')
+        finally:
+            fp.close()
+
+
+def make_thumbnail(filename, max_bytes):
+    """Returns a PNG thumbnail of filename no larger than max_bytes, or None
+    if the Python Imaging Library is not installed or thumbnailing fails."""
+    if Image is None:
+        return
+    try:
+        img = Image.open(filename)
+        width, height = img.size
+        for _ in range(5):
+            width //= 2
+            height //= 2
+            thumb = img.copy()
+            thumb.thumbnail((max(width, 1), max(height, 1)))
+            buf = StringIO.StringIO()
+            thumb.save(buf, 'PNG')
+            if buf.tell() <= max_bytes:
+                return buf.getvalue()
+    except Exception:
+        log.exception("Failed to make thumbnail of %s", filename)
+
+
+def compact_text(html, max_chars):
+    """Returns a plain text rendering of html, truncated to max_chars."""
+    text = html_to_text(html)
+    if len(text) > max_chars:
+        text = (text[:max_chars] + "\n[... {:d} characters truncated."
+                " See HTML version of this email.]\n"
+                .format(len(text) - max_chars))
+    return text
+
+
+class LazyEmail(object):
+    """A multipart/related email (text, HTML and images) which is generated
+    piece by piece while it is being sent, so that only one block of one
+    image is held in memory at a time.
+
+    Attributes:
+        headers (list of (name, value) tuples)
+        text (str): plain text alternative.
+        html (str)
+        attachments (list of Attachment objects)
+    """
+
+    def __init__(self, headers, text, html, attachments=None):
+        self.headers = headers
+        self.text = text
+        self.html = html
+        self.attachments = attachments or []
+        unique = make_msgid().strip('<>').replace('@', '.')
+        self.related_boundary = '=====related.' + unique
+        self.alternative_boundary = '=====alternative.' + unique
+
+    def _text_part(self, text, subtype):
+        part = MIMEText(text, subtype)
+        del part['MIME-Version']
+        return part.as_string().replace('\n', '\r\n') + '\r\n'
+
+    def chunks(self):
+        """Generator yielding the whole message as strings with CRLF line
+        endings.  Every chunk ends with a complete line."""
+        header_lines = ['{}: {}'.format(name, Header(value).encode()
+                                                .replace('\n', '\r\n'))
+                        for name, value in self.headers]
+        header_lines += ['MIME-Version: 1.0',
+                         'Content-Type: multipart/related; type="multipart/alternative";'
+                         ' boundary="{}"'.format(self.related_boundary)]
+        yield '\r\n'.join(header_lines) + '\r\n\r\n'
+
+        yield ('--{}\r\nContent-Type: multipart/alternative; boundary="{}"\r\n\r\n'
+               .format(self.related_boundary, self.alternative_boundary))
+        yield '--{}\r\n'.format(self.alternative_boundary)
+        yield self._text_part(self.text, 'plain')
+        yield '--{}\r\n'.format(self.alternative_boundary)
+        yield self._text_part(self.html, 'html')
+        yield '--{}--\r\n'.format(self.alternative_boundary)
+
+        for attachment in self.attachments:
+            yield '--{}\r\n'.format(self.related_boundary)
+            for chunk in attachment.chunks():
+                yield chunk
+        yield '--{}--\r\n'.format(self.related_boundary)
+
+    def as_string(self):
+        return ''.join(self.chunks())
+
+
+class Transport(object):
+    """Abstract base class (ABC) for classes which deliver a fully-formed
+    email message to its recipients."""
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def send(self, from_addr, to_addrs, msg):
+        """
+        Args:
+            from_addr (str)
+            to_addrs (list of str)
+            msg (LazyEmail)
+        """
+        pass
+
+
+class SMTPTransport(Transport):
+    """Send email over plain SMTP, optionally upgraded using STARTTLS.
+
+    Attributes:
+        server (str): hostname of the SMTP server.  May include ':port'.
+        port (int): 0 means use `server`'s port or the protocol default.
+        username (str): if set then we log in before sending.
+        password (str)
+        starttls (bool): if True then issue STARTTLS before logging in.
+        timeout (float): socket timeout in seconds.
+    """
+
+    def __init__(self, server, port=0, username=None, password=None,
+                 starttls=False, timeout=60):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def _connect(self):
+        log.debug("SMTP %s", self.server)
+        s = smtplib.SMTP(timeout=self.timeout)
+        s.connect(self.server, self.port)
+        if self.starttls:
+            s.ehlo()
+            s.starttls()
+            s.ehlo()
+        return s
+
+    def send(self, from_addr, to_addrs, msg):
+        s = self._connect()
+        try:
+            if self.username:
+                log.debug("logging in as %s", self.username)
+                s.login(self.username, self.password)
+            log.debug("sendmail to %s", to_addrs)
+            self._sendmail_chunks(s, from_addr, to_addrs, msg.chunks())
+        except:
+            s.close()
+            raise
+        log.debug("quit")
+        s.quit()
+
+    def _sendmail_chunks(self, s, from_addr, to_addrs, chunks):
+        """Like smtplib.SMTP.sendmail() except the message is written to the
+        socket chunk by chunk, so the whole message is never held in memory.
+        Each chunk must end with a complete line."""
+        s.ehlo_or_helo_if_needed()
+        code, resp = s.mail(from_addr)
+        if code != 250:
+            s.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        refused = {}
+        for addr in to_addrs:
+            code, resp = s.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            s.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, resp = s.docmd("data")
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        for chunk in chunks:
+            s.send(smtplib.quotedata(chunk))
+        s.send(".\r\n")
+        code, resp = s.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+
+class SMTPSSLTransport(SMTPTransport):
+    """Send email over SMTP wrapped in SSL (usually port 465)."""
+
+    def _connect(self):
+        log.debug("SMPT_SSL %s", self.server)
+        s = smtplib.SMTP_SSL(timeout=self.timeout)
+        s.connect(self.server, self.port)
+        return s
+
+
+class MaildirTransport(Transport):
+    """Deliver email into a local Maildir.  Useful for testing and for
+    machines without network access.
+
+    Attributes:
+        directory (str): path of the Maildir.  Created if necessary.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def send(self, from_addr, to_addrs, msg):
+        maildir = mailbox.Maildir(self.directory, create=True)
+        key = maildir.add(msg.as_string())
+        log.debug("Delivered email to %s/%s", self.directory, key)
+
+
+class MemoryTransport(Transport):
+    """Keep every email in memory.  Intended for tests.
+
+    Attributes:
+        messages (list of (from_addr, to_addrs, msg_string) tuples)
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, from_addr, to_addrs, msg):
+        self.messages.append((from_addr, list(to_addrs), msg.as_string()))
+
+
+class Schedule(object):
+    """Abstract base class (ABC) for heartbeat schedules.  All times are UTC.
+
+    If the main loop is blocked past a due time then the heartbeat is
+    sent (late) on the next check.  Several missed times are caught up
+    with a single heartbeat.
+
+    Attributes:
+        full_report (bool): if True then run HeartBeat.cmds and attach
+            HeartBeat.html_file.  Else send a short summary.
+        last_run (datetime): when this schedule last fired (initially,
+            when it was created).
+        next_due (datetime): first due time after last_run.
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, full_report=True):
+        self.full_report = full_report
+        self.mark_run(datetime.datetime.utcnow())
+
+    @abstractmethod
+    def next_after(self, t):
+        """Returns the first due datetime strictly after datetime t."""
+        pass
+
+    def mark_run(self, t):
+        self.last_run = t
+        self.next_due = self.next_after(t)
+
+    def due(self, now):
+        return self.next_due <= now
+
+
+class IntervalSchedule(Schedule):
+    """Due every `seconds` seconds."""
+
+    def __init__(self, seconds, full_report=False):
+        self.seconds = seconds
+        super(IntervalSchedule, self).__init__(full_report)
+
+    def next_after(self, t):
+        return t + datetime.timedelta(seconds=self.seconds)
+
+    def __str__(self):
+        return "every {}s".format(self.seconds)
+
+
+class CronSchedule(Schedule):
+    """Due at times matching a cron expression of five fields:
+    minute, hour, day of month, month and day of week (0 or 7 is Sunday).
+    Each field may be '*', a number, a range 'a-b', a step '*/n' or
+    'a-b/n', or a comma-separated list of these.  As with cron, if both
+    day of month and day of week are restricted then a day matching
+    either is due.
+
+    Raises:
+        ValueError: if expression is invalid.
+    """
+
+    FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression, full_report=True):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("Cron expression '{}' must have 5 fields"
+                             .format(expression))
+        parsed = [self._parse_field(field, lo, hi) for field, (lo, hi)
+                  in zip(fields, CronSchedule.FIELD_RANGES)]
+        self.minutes, self.hours, self.days, self.months, self.weekdays = parsed
+        if 7 in self.weekdays:
+            self.weekdays.discard(7)
+            self.weekdays.add(0)
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+        self.minutes = sorted(self.minutes)
+        self.hours = sorted(self.hours)
+        super(CronSchedule, self).__init__(full_report)
+
+    @staticmethod
+    def _parse_field(field, lo, hi):
+        values = set()
+        for part in field.split(','):
+            rng, _, step = part.partition('/')
+            try:
+                step = int(step) if step else 1
+                if rng == '*':
+                    start, end = lo, hi
+                elif '-' in rng:
+                    start, end = [int(x) for x in rng.split('-')]
+                else:
+                    start = end = int(rng)
+            except ValueError:
+                raise ValueError("Invalid cron field '{}'".format(field))
+            if start < lo or end > hi or start > end or step < 1:
+                raise ValueError("Cron field '{}' out of range {}-{}"
+                                 .format(field, lo, hi))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, day):
+        if day.month not in self.months:
+            return False
+        day_ok = day.day in self.days
+        weekday_ok = (day.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, t):
+        t = t.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        day = t.date()
+        for _ in range(366 * 5):
+            if self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = datetime.datetime.combine(
+                                            day, datetime.time(hour, minute))
+                        if candidate >= t:
+                            return candidate
+            day += datetime.timedelta(days=1)
+        raise ValueError("Cron expression '{}' never matches"
+                         .format(self.expression))
+
+    def __str__(self):
+        return "cron '{}'".format(self.expression)
+
+
+class HeartBeat(object):
+    """
+    Attributes:
+        schedules (list of Schedule objects)
+        hour (int or None): shortcut for a daily full report at this hour
+            (UTC).  Setting it replaces the previous daily schedule.
+        cmds (list of commands): run for full reports.  See run_commands.
+        html_file (str): attached to full reports.
+    """
+
+    def __init__(self):
+        self.schedules = []
+        self.cmds = [] # list of commands
+        self.html_file = None
+        self._hour = None
+        self._hour_schedule = None
+
+    @property
+    def hour(self):
+        return self._hour
+
+    @hour.setter
+    def hour(self, hour):
+        if self._hour_schedule in self.schedules:
+            self.schedules.remove(self._hour_schedule)
+        self._hour = hour
+        self._hour_schedule = None
+        if hour is not None:
+            self._hour_schedule = CronSchedule("0 {:d} * * *".format(hour))
+            self.schedules.append(self._hour_schedule)
+
+    def due(self, now):
+        """Returns the schedules which are due at datetime now."""
+        return [schedule for schedule in self.schedules if schedule.due(now)]
+
+    def next_due(self):
+        """Returns the earliest next due datetime, or None."""
+        if self.schedules:
+            return min(schedule.next_due for schedule in self.schedules)
+
+    def next_full_due(self):
+        """Returns the earliest next due datetime of a full report, or None."""
+        full = [schedule for schedule in self.schedules if schedule.full_report]
+        if full:
+            return min(schedule.next_due for schedule in full)
+
+
+class Aggregator(object):
+    """Receives the per-tick snapshots which remote babysitters publish
+    (see Manager.publish_urls) so that one Manager can monitor a fleet of
+    hosts and send one consolidated email.  Set Manager.aggregator to an
+    Aggregator and the Manager adds a RemoteHost checker for each host.
+
+    Protocol (JSON over HTTP):
+        POST /snapshot   body is Manager.snapshot().  Returns {"accepted": bool}.
+        GET /snapshots   returns the latest snapshot from every host.
+
+    By default we only listen on the loopback interface.  Listening on any
+    other interface lets other hosts inject state, so it requires a shared
+    token, which every request must send as 'Authorization: Bearer <token>'
+    (see Manager.publish_token).  Requests without it get 401.
+
+    Snapshots are deduplicated per host: a snapshot is only accepted if it
+    comes from a newer babysitter run ('started') or has a higher 'seq'
+    than the latest snapshot from that run.
+
+    Attributes:
+        port (int): the port we're listening on.
+        token (str or None)
+    """
+
+    LOOPBACK_HOSTS = ['localhost', '::1']
+
+    def __init__(self, host='127.0.0.1', port=0, token=None):
+        """
+        Args:
+            host (str): interface to listen on.  '' means all interfaces.
+            port (int): 0 lets the OS pick a free port.
+            token (str or None): required unless host is a loopback address.
+
+        Raises:
+            ValueError: if host isn't a loopback address and there's no token.
+        """
+        if not token and not self.is_loopback(host):
+            raise ValueError("Listening on {} requires a token"
+                             .format(host or "all interfaces"))
+        self.token = token
+        self._snapshots = {} # host: snapshot
+        self._lock = threading.Lock()
+        self._server = _AggregatorHTTPServer((host, port), _AggregatorHandler)
+        self._server.aggregator = self
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    @classmethod
+    def is_loopback(cls, host):
+        return host in cls.LOOPBACK_HOSTS or host.startswith('127.')
+
+    def authorized(self, header):
+        """Returns True if header (the request's Authorization header, or
+        None) carries our token, or if we don't have one."""
+        if not self.token:
+            return True
+        return hmac.compare_digest(header or "", "Bearer " + self.token)
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.5})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def receive(self, snapshot):
+        """Store a snapshot unless it is a duplicate or out of date.
+
+        Returns:
+            True if the snapshot was accepted.
+
+        Raises:
+            ValueError: if snapshot is malformed (see validate_snapshot).
+        """
+        validate_snapshot(snapshot)
+        key = (snapshot['started'], snapshot['seq'])
+        with self._lock:
+            latest = self._snapshots.get(snapshot['host'])
+            if latest is not None and key <= (latest['started'], latest['seq']):
+                return False
+            snapshot['received'] = time.time()
+            self._snapshots[snapshot['host']] = snapshot
+        return True
+
+    def get(self, host):
+        """Returns the latest snapshot from host, or None."""
+        with self._lock:
+            return self._snapshots.get(host)
+
+    def hosts(self):
+        with self._lock:
+            return sorted(self._snapshots)
+
+    def all_snapshots(self):
+        with self._lock:
+            return dict(self._snapshots)
+
+
+def validate_snapshot(snapshot):
+    """Check that snapshot has the shape of Manager.snapshot(), because
+    any client which can reach an Aggregator can POST one.
+
+    Raises:
+        ValueError
+    """
+    if not isinstance(snapshot, dict):
+        raise ValueError("snapshot must be an object")
+    if not isinstance(snapshot.get('host'), basestring):
+        raise ValueError("'host' must be a string")
+    for key in ['started', 'seq']:
+        if (not isinstance(snapshot.get(key), (int, long, float)) or 
+            isinstance(snapshot[key], bool)):
+            raise ValueError("'{}' must be a number".format(key))
+    if not isinstance(snapshot.get('checkers'), list):
+        raise ValueError("'checkers' must be a list")
+    for checker in snapshot['checkers']:
+        if (not isinstance(checker, dict) or 
+            not isinstance(checker.get('name'), basestring) or
+            not isinstance(checker.get('text'), basestring) or
+            not isinstance(checker.get('state'), (int, long)) or
+            isinstance(checker['state'], bool)):
+            raise ValueError("each checker must have a str 'name', "
+                             "an int 'state' and a str 'text'")
+
+
+class _AggregatorHTTPServer(SocketServer.ThreadingMixIn, 
+                            BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _AggregatorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _authorized(self):
+        header = self.headers.getheader('Authorization')
+        if self.server.aggregator.authorized(header):
+            return True
+        log.warn("Aggregator: rejected request without a valid token from %s",
+                 self.client_address[0])
+        self.send_error(401)
+        return False
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path != '/snapshot':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.getheader('Content-Length'))
+            snapshot = json.loads(self.rfile.read(length))
+            accepted = self.server.aggregator.receive(snapshot)
+        except (TypeError, ValueError):
+            self.send_error(400)
+            return
+        self._send_json({'accepted': accepted})
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path != '/snapshots':
+            self.send_error(404)
+            return
+        self._send_json(self.server.aggregator.all_snapshots())
+
+    def _send_json(self, obj):
+        body = json.dumps(obj)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("Aggregator: " + format, *args)
+
+
+class RemoteHost(Checker):
+    """The state of a remote babysitter, from the snapshots it publishes
+    to an Aggregator.  State is FAIL if any of the remote checkers is FAIL
+    or if no snapshot has arrived for stale_after seconds.
+
+    Attributes:
+        aggregator (Aggregator)
+        stale_after (float): seconds
+    """
+
+    def __init__(self, aggregator, host, stale_after=60):
+        self.aggregator = aggregator
+        self.stale_after = stale_after
+        super(RemoteHost, self).__init__(host)
+
+    def state(self):
+        snapshot = self.aggregator.get(self.name)
+        if (snapshot is None or 
+            time.time() - snapshot['received'] > self.stale_after):
+            return FAIL
+        return all(checker.get('state') == OK 
+                   for checker in self._checkers(snapshot))
+
+    @staticmethod
+    def _checkers(snapshot):
+        """The well-formed checker entries of snapshot.  Aggregator
+        validates snapshots, but a bad entry mustn't stop the Manager."""
+        return [checker for checker in snapshot.get('checkers') or []
+                if isinstance(checker, dict)]
+
+    def extra_text(self):
+        snapshot = self.aggregator.get(self.name)
+        if snapshot is None:
+            return ", no snapshot received!"
+        checkers = self._checkers(snapshot)
+        msg = (", {:d} checkers, last snapshot {:.0f}s ago"
+               .format(len(checkers), time.time() - snapshot['received']))
+        failing = ["{}{}".format(unicode(checker.get('name')).rpartition('/')[2], 
+                                 unicode(checker.get('text', "")))
+                   for checker in checkers if checker.get('state') != OK]
+        if failing:
+            msg += ". FAILING: " + "; ".join(failing)
+        return msg
+
+
+def sd_notify(state, path=None):
+    """Send a state string such as "READY=1" or "WATCHDOG=1" to systemd
+    (see sd_notify(3)).
+
+    Args:
+        state (str)
+        path (str): the notify socket.  Defaults to $NOTIFY_SOCKET.  A
+            leading '@' means the abstract namespace.
+
+    Returns:
+        True if the state was sent.
+    """
+    path = path or os.environ.get('NOTIFY_SOCKET')
+    if not path:
+        return False
+    if path.startswith('@'):
+        path = '\0' + path[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(state, path)
+    except socket.error as e:
+        log.warn("sd_notify(%s) failed: %s", state, e)
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class Watchdog(object):
+    """Watches the main loop from a background thread, because if the
+    main loop hangs (e.g. in a blocked subprocess or SMTP connection) then
+    nothing else will notice.
+
+    The main loop calls tick_started() and tick_finished() around each
+    tick.  If a tick takes longer than budget seconds then the main
+    thread's stack is logged and on_stall is called, once per tick.
+
+    If systemd's watchdog is enabled (WATCHDOG_USEC is set for this pid)
+    then we send WATCHDOG=1 every WATCHDOG_USEC / 2, but only while the
+    main loop is within budget, so systemd restarts us if it stalls.
+
+    Attributes:
+        budget (float or None): seconds.  None disables stall detection.
+        on_stall (function): called with (seconds into the tick, stack
+            as a str) from the watchdog thread.
+        notify_socket (str or None): see sd_notify.
+        notify_interval (float or None): seconds between WATCHDOG=1 pings.
+        ticks (int): number of ticks finished.
+        last_latency, max_latency (float): seconds taken by the most recent
+            and the slowest tick.
+        stalls (int): number of ticks which exceeded budget.
+    """
+
+    def __init__(self, budget=300, on_stall=None, notify_socket=None,
+                 watchdog_usec=None):
+        """Must be constructed in the thread to be watched."""
+        self.budget = budget
+        self.on_stall = on_stall
+        self.notify_socket = notify_socket or os.environ.get('NOTIFY_SOCKET')
+        if (watchdog_usec is None and 
+            os.environ.get('WATCHDOG_PID', str(os.getpid())) == str(os.getpid())):
+            watchdog_usec = os.environ.get('WATCHDOG_USEC')
+        self.notify_interval = (int(watchdog_usec) / 2E6 
+                                if watchdog_usec and self.notify_socket else None)
+        self.ticks = 0
+        self.last_latency = None
+        self.max_latency = 0
+        self.stalls = 0
+        self._tick_start = None # None between ticks
+        self._reported = False
+        self._main_ident = threading.current_thread().ident
+        self._stop = threading.Event()
+        self._thread = None
+
+    def tick_started(self):
+        self._reported = False
+        self._tick_start = time.time()
+
+    def tick_finished(self):
+        latency = time.time() - self._tick_start
+        self._tick_start = None
+        self.ticks += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        if self._reported:
+            log.warn("Stalled tick finished after %.1f seconds", latency)
+
+    def check(self, now=None):
+        """Report the current tick if it has exceeded budget.  Called by
+        the watchdog thread.
+
+        Returns:
+            False if the main loop is stalled.
+        """
+        start = self._tick_start
+        if self.budget is None or start is None:
+            return True
+        elapsed = (now or time.time()) - start
+        if elapsed <= self.budget:
+            return True
+        if not self._reported:
+            self._reported = True
+            self.stalls += 1
+            stack = self.main_stack()
+            log.error("Main loop stalled: tick has taken %.0f seconds "
+                      "(budget %s seconds).  Main thread stack:\n%s",
+                      elapsed, self.budget, stack)
+            if self.on_stall is not None:
+                try:
+                    self.on_stall(elapsed, stack)
+                except Exception:
+                    log.exception("Failed to send stall alert")
+        return False
+
+    def main_stack(self):
+        """Returns the watched thread's current stack as a str."""
+        frame = sys._current_frames().get(self._main_ident)
+        if frame is None:
+            return ""
+        return "".join(traceback.format_stack(frame))
+
+    def start(self):
+        if self.budget is None and self.notify_interval is None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        periods = [p for p in (self.notify_interval, 
+                               self.budget and self.budget / 4) if p]
+        period = min(periods)
+        while not self._stop.wait(period):
+            if self.check() and self.notify_interval:
+                sd_notify("WATCHDOG=1", self.notify_socket)
+
+    def html(self):
+        if not self.ticks:
+            return ""
+        return ("<p>Main loop: {:d} ticks, last took {:.1f}s, slowest took "
+                "{:.1f}s, {:d} exceeded the {}s budget.</p>\n"
+                .format(self.ticks, self.last_latency, self.max_latency,
+                        self.stalls, self.budget))
+
+
+def read_pressure(resource, proc='/proc'):
+    """Read Linux pressure stall information (PSI) for one resource.
+
+    Args:
+        resource (str): 'cpu', 'memory' or 'io'
+
+    Returns:
+        dict mapping 'some' (and 'full', if the kernel reports it) to a
+        dict with keys 'avg10', 'avg60', 'avg300' (percentages of wall
+        time in which tasks stalled) and 'total' (microseconds).  None if
+        the kernel doesn't support PSI.
+    """
+    try:
+        with open(os.path.join(proc, 'pressure', resource)) as fh:
+            lines = fh.read().splitlines()
+    except (IOError, OSError):
+        return None
+    pressure = {}
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        pressure[fields[0]] = dict((key, float(value)) for key, value in 
+                                   (field.split('=') for field in fields[1:]))
+    return pressure
+
+
+class SystemPressure(object):
+    """Samples PSI (see read_pressure) and the load average, so that
+    Manager can back off when the machine is struggling rather than make
+    a resource incident worse.  Without PSI (kernels before 4.20, or
+    CONFIG_PSI disabled) only the load average is used.
+
+    Attributes:
+        max_avg10 (dict): resource: maximum 'some' avg10 percentage.
+        max_load_per_cpu (float): maximum 1-minute load average per CPU.
+        psi (dict): resource: read_pressure(resource), as of the last sample.
+        loadavg (tuple of 3 floats or None): as of the last sample.
+        reasons (list of str): why we're under pressure.  Empty if not.
         
+    Static attributes:
+        RESOURCES (list of str)
     """
-    msg = ""
-    for cmd, send_stdout in commands:        
-        msg += "<hr/>\n"
-        log.info("Attempting to run command {}".format(cmd))
+
+    RESOURCES = ['cpu', 'memory', 'io']
+
+    def __init__(self, max_avg10=None, max_load_per_cpu=2.0, proc='/proc'):
+        self.max_avg10 = ({'cpu': 80.0, 'memory': 10.0, 'io': 40.0}
+                          if max_avg10 is None else max_avg10)
+        self.max_load_per_cpu = max_load_per_cpu
+        self.proc = proc
+        self.psi = {}
+        self.loadavg = None
+        self.reasons = []
         try:
-            p = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            p.wait()
-        except Exception:
-            m = ("<h2 style=\"color:red\">Failed to run <code>{}</code></h2>\n"
-                 .format(escape(cmd)))
-            msg += m
-            log.exception(html_to_text(m).strip())
-        else:
-            if p.returncode == 0:
-                m = ("<h2>Successfully ran <code>{}</code></h2>\n"
-                     .format(escape(cmd)))
-                msg += m
-                log.info(html_to_text(m).strip())
-            else:
-                m = ("<h2 style=\"color:red\">Failed to run <code>{}</code>"
-                     "</h2>\n".format(escape(cmd)))
-                msg += m
-                log.warn(html_to_text(m).strip())
+            self.n_cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self.n_cpus = 1
+
+    def sample(self):
+        """Read PSI and the load average.
+
+        Returns:
+            self.reasons
+        """
+        self.psi = dict((resource, read_pressure(resource, self.proc))
+                        for resource in self.RESOURCES)
+        try:
+            with open(os.path.join(self.proc, 'loadavg')) as fh:
+                self.loadavg = tuple(float(x) for x in fh.read().split()[:3])
+        except (IOError, OSError, ValueError):
+            self.loadavg = None
+
+        reasons = []
+        for resource in self.RESOURCES:
+            psi = self.psi[resource]
+            limit = self.max_avg10.get(resource)
+            if psi and 'some' in psi and limit is not None:
+                avg10 = psi['some']['avg10']
+                if avg10 > limit:
+                    reasons.append("{} pressure {:.1f}% > {:.0f}%"
+                                   .format(resource, avg10, limit))
+        if self.loadavg is not None and self.max_load_per_cpu is not None:
+            load = self.loadavg[0] / self.n_cpus
+            if load > self.max_load_per_cpu:
+                reasons.append("load average {:.2f} per CPU > {:.2f}"
+                               .format(load, self.max_load_per_cpu))
+        self.reasons = reasons
+        return reasons
+
+    def html(self):
+        if self.loadavg is None and not any(self.psi.values()):
+            return ""
+        msg = "<p>System pressure"
+        if self.reasons:
+            msg += ' <span style="color:red">HIGH</span>'
+        msg += ":</p>\n<ul>\n"
+        if self.loadavg is not None:
+            msg += ("<li>load average {:.2f} {:.2f} {:.2f} ({:d} CPUs)</li>\n"
+                    .format(self.loadavg[0], self.loadavg[1], self.loadavg[2],
+                            self.n_cpus))
+        for resource in self.RESOURCES:
+            psi = self.psi.get(resource)
+            if not psi:
+                continue
+            msg += "<li>{} PSI (avg10/avg60/avg300 %):".format(resource)
+            for kind in ['some', 'full']:
+                if kind in psi:
+                    msg += " {} {:.1f}/{:.1f}/{:.1f}".format(
+                        kind, psi[kind]['avg10'], psi[kind]['avg60'], 
+                        psi[kind]['avg300'])
+            msg += "</li>\n"
+        return msg + "</ul>\n"
+
+
+class ConfigError(Exception):
+    """The config file is invalid."""
+    pass
+
+
+# Checker classes which can be created from a config file
+CHECKER_TYPES = {'File': File,
+                 'FileGlob': FileGlob,
+                 'FileSet': FileSet,
+                 'FileGrows': FileGrows,
+                 'Process': Process,
+                 'DiskSpaceRemaining': DiskSpaceRemaining,
+                 'ChannelData': ChannelData,
+                 'LogPattern': LogPattern,
+                 'TCPProbe': TCPProbe,
+                 'HTTPProbe': HTTPProbe}
+
+TRANSPORTS = ['smtp_ssl', 'smtp', 'maildir', 'memory']
+
+CONFIG_SECTIONS = {'email': dict, 'checkers': list, 'powerdata': dict,
+                   'heartbeat': dict, 'state_change_cmds': list,
+                   'shutdown_cmds': list, 'publish_urls': list,
+                   'publish_token': str, 'control_socket': str, 
+                   'watchdog': dict}
+
+HEARTBEAT_KEYS = ['hour', 'cmds', 'html_file', 'schedules']
+
 
-            stderr = p.stderr.read()
-            stdout = p.stdout.read()                
-            
-            if (send_stdout or stderr) and stdout:
-                msg += ("<h3>stdout</h3>\n <pre>{}</pre>\n"
-                        .format(escape(stdout)))
-                
-            if stderr:
-                msg += "<h3 style=\"color:red\">stderr</h3>\n"
-                msg += ("<pre style=\"color:red\">{}</pre>\n"
-                        .format(escape(stderr)))
+def load_config(filename):
+    """Load and validate a JSON config file in this format (every section
+    is optional):
 
-    return msg
+    {
+      "email": {"transport": "smtp_ssl", "server": "smtp.mydomain.com",
+                "from": "logger@mydomain.com", "to": ["me@me.com"],
+                "username": "smtp-username", "password": "let-me-in"},
+      "checkers": [
+        {"type": "DiskSpaceRemaining", "threshold": 5000, "path": "/data"},
+        {"type": "Process", "name": "rfm_ecomanager_logger.py",
+         "restart_command": "nohup /path/to/rfm_ecomanager_logger.py"},
+        {"type": "File", "name": "/path/to/file", "timeout": 120,
+         "depends_on": ["disk space"]}
+      ],
+      "powerdata": {"directory": "/data", "numeric_subdirs": true,
+                    "timeout": 500, "validate": true,
+                    "depends_on": ["rfm_ecomanager_logger.py", "disk space"]},
+      "heartbeat": {"hour": 6, "cmds": [["tail -n 50 /path/to/log", true]],
+                    "html_file": "/path/to/index.html",
+                    "schedules": [{"interval": 3600, "full_report": false},
+                                  {"cron": "0 18 * * 1-5"}]},
+      "state_change_cmds": [["tail -n 50 /path/to/log", true]],
+      "shutdown_cmds": [],
+      "publish_urls": ["http://aggregator.mydomain.com:8000/snapshot"],
+      "publish_token": "shared-secret",
+      "control_socket": "/home/logger/.babysitter.sock",
+      "watchdog": {"tick_budget": 300,
+                   "alert_email": {"transport": "smtp", "server": "backup-smtp"}}
+    }
 
+    "transport" is one of TRANSPORTS.  "maildir" takes a "directory".
+    "smtp" also takes "port" and "starttls".  "depends_on" lists the
+    names of checkers which must be OK for a checker to be checked (see
+    Manager._tick).  "critical": false lets Manager check a checker less
+    often while the system is under pressure.  "alert_email" takes the same
+    keys as "email" (except "from" and "to") and is used only for watchdog
+    alerts.  Each checker's "type" is a
+    key of CHECKER_TYPES; the other keys are passed to its constructor.
+    Each command is [shell command, send_stdout].
 
-def get_ip_address():
-    # from http://commandline.org.uk/python/how-to-find-out-ip-address-in-python/
+    Returns:
+        dict
+
+    Raises:
+        ConfigError
+    """
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(('google.com', 0))
-    except:
-        log.exception("Failed to get IP address.")
-        ip_address = 0
-    else:
-        ip_address = s.getsockname()[0]
-        
-    return ip_address
+        with open(filename) as fh:
+            config = _to_str(json.load(fh))
+    except (IOError, ValueError) as e:
+        raise ConfigError("Failed to load {}: {}".format(filename, e))
+    validate_config(config)
+    return config
 
 
-class HeartBeat(object):
-    def __init__(self):
-        self.hour = None
-        self.cmds = [] # list of commands
-        self.html_file = None
-        self.last_checked = datetime.datetime.utcnow().hour
+def _to_str(obj):
+    """json returns unicode strings.  Convert them to str."""
+    if isinstance(obj, dict):
+        return dict((_to_str(k), _to_str(v)) for k, v in obj.items())
+    elif isinstance(obj, list):
+        return [_to_str(item) for item in obj]
+    elif isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    return obj
+
+
+def validate_config(config):
+    """
+    Raises:
+        ConfigError: describing the first problem found.
+    """
+    if not isinstance(config, dict):
+        raise ConfigError("Config must be a JSON object")
+    for section, value in config.items():
+        if section not in CONFIG_SECTIONS:
+            raise ConfigError("Unknown config section '{}'".format(section))
+        if not isinstance(value, CONFIG_SECTIONS[section]):
+            raise ConfigError("'{}' must be a {}"
+                              .format(section, CONFIG_SECTIONS[section].__name__))
+
+    transport = config.get('email', {}).get('transport', 'smtp_ssl')
+    if transport not in TRANSPORTS:
+        raise ConfigError("Unknown email transport '{}'".format(transport))
+
+    if transport == 'maildir' and 'directory' not in config['email']:
+        raise ConfigError("The maildir transport requires 'directory'")
+
+    alert_email = config.get('watchdog', {}).get('alert_email', {})
+    if alert_email.get('transport', 'smtp_ssl') not in TRANSPORTS:
+        raise ConfigError("Unknown alert_email transport '{}'"
+                          .format(alert_email['transport']))
+
+    for i, spec in enumerate(config.get('checkers', [])):
+        if not isinstance(spec, dict) or spec.get('type') not in CHECKER_TYPES:
+            raise ConfigError("checkers[{:d}] must have a 'type' which is one "
+                              "of {}".format(i, ", ".join(sorted(CHECKER_TYPES))))
+        _check_args("checkers[{:d}]: {}".format(i, spec['type']),
+                    CHECKER_TYPES[spec['type']].__init__, spec, 
+                    ['type', 'depends_on', 'critical'])
+        _check_depends_on("checkers[{:d}]".format(i), spec)
+        if not isinstance(spec.get('critical', True), bool):
+            raise ConfigError("checkers[{:d}]: 'critical' must be true or "
+                              "false".format(i))
+        if spec['type'] == 'LogPattern':
+            try:
+                LogPattern.compile(spec['patterns'])
+            except (ValueError, TypeError) as e:
+                raise ConfigError("checkers[{:d}]: {}".format(i, e))
+
+    if 'powerdata' in config:
+        _check_args("powerdata", Manager.load_powerdata, config['powerdata'])
+        _check_depends_on("powerdata", config['powerdata'])
+
+    heartbeat = config.get('heartbeat', {})
+    for key in heartbeat:
+        if key not in HEARTBEAT_KEYS:
+            raise ConfigError("heartbeat has no key '{}'".format(key))
+    hour = heartbeat.get('hour')
+    if hour is not None and (not isinstance(hour, int) or 
+                             isinstance(hour, bool) or not 0 <= hour <= 23):
+        raise ConfigError("heartbeat.hour must be an integer from 0 to 23")
+    for i, spec in enumerate(heartbeat.get('schedules', [])):
+        try:
+            make_schedule(spec)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise ConfigError("heartbeat.schedules[{:d}]: {}".format(i, e))
+
+    cmd_lists = [('heartbeat.cmds', config.get('heartbeat', {}).get('cmds', [])),
+                 ('state_change_cmds', config.get('state_change_cmds', [])),
+                 ('shutdown_cmds', config.get('shutdown_cmds', []))]
+    for section, cmds in cmd_lists:
+        for cmd in cmds:
+            if (not isinstance(cmd, list) or len(cmd) != 2 or 
+                not isinstance(cmd[0], str) or not isinstance(cmd[1], bool)):
+                raise ConfigError("Each command in {} must be "
+                                  "[command, send_stdout]".format(section))
+
+
+def _check_args(where, func, kwargs, ignore=()):
+    """Check that func can be called with kwargs (ignoring keys in ignore).
+
+    Raises:
+        ConfigError
+    """
+    args, _, _, defaults = inspect.getargspec(func)
+    args = args[1:] # remove 'self'
+    required = args[:len(args) - len(defaults or [])]
+    for arg in kwargs:
+        if arg not in ignore and arg not in args:
+            raise ConfigError("{} has no argument '{}'".format(where, arg))
+    for arg in required:
+        if arg not in kwargs:
+            raise ConfigError("{} requires '{}'".format(where, arg))
+
+
+def _check_depends_on(where, spec):
+    depends_on = spec.get('depends_on', [])
+    if (not isinstance(depends_on, list) or 
+        not all(isinstance(name, str) for name in depends_on)):
+        raise ConfigError("{}: 'depends_on' must be a list of checker names"
+                          .format(where))
+
+
+def make_schedule(spec):
+    """Returns a Schedule for a dict with either an 'interval' (seconds) or
+    a 'cron' expression, and an optional 'full_report' (bool).
+
+    Raises:
+        ValueError
+    """
+    if ('interval' in spec) == ('cron' in spec):
+        raise ValueError("needs exactly one of 'interval' or 'cron'")
+    for key in spec:
+        if key not in ['interval', 'cron', 'full_report']:
+            raise ValueError("unknown key '{}'".format(key))
+    if 'interval' in spec:
+        return IntervalSchedule(float(spec['interval']),
+                                spec.get('full_report', False))
+    return CronSchedule(spec['cron'], spec.get('full_report', True))
+
+
+def make_transport(email, default_ssl=False):
+    """Returns a Transport for the 'email' section of a config, or None
+    to use SMTP over SSL with Manager.SMTP_SERVER (unless default_ssl is
+    True, in which case an SMTPSSLTransport is returned)."""
+    transport = email.get('transport', 'smtp_ssl')
+    if transport == 'smtp_ssl' and default_ssl:
+        return SMTPSSLTransport(email.get('server', ""), email.get('port', 0),
+                                email.get('username'), email.get('password'))
+    elif transport == 'smtp':
+        return SMTPTransport(email.get('server', ""), email.get('port', 0),
+                             email.get('username'), email.get('password'),
+                             email.get('starttls', False))
+    elif transport == 'maildir':
+        return MaildirTransport(email['directory'])
+    elif transport == 'memory':
+        return MemoryTransport()
 
 
 class NewDataDirError(Exception):
-    """Error raised when a new data directory has been found."""
+    """Error raised when a new data directory has been found.  No longer
+    raised by Manager, which now switches data directory in place; kept
+    for backwards compatibility."""
     pass
 
 
 class Manager(object):
-    """Manages multiple Checker objects."""
+    """Manages multiple Checker objects.
+    
+    Static attributes:
+        READY_POLL_INTERVAL (float): seconds between checks for data files
+            while waiting in load_powerdata, and for a heartbeat report
+            while a full heartbeat is waiting for one.
+        MAX_PROBE_THREADS (int): max number of NetworkProbes run at once.
+        REPORT_LEAD_TIME (int): seconds before a full heartbeat is due that
+            we start preparing its report in a worker process.
+        REPORT_DEADLINE (int): seconds a report may take to prepare before
+            we kill the worker and fall back to the last good report.
+        CONTROL_TIMEOUT (float): seconds a control socket client may take
+            to send its command.
+        CONTROL_COMMANDS (list of str): usage of each control command.
+        PRESSURE_BACKOFF_TICKS (int): while the system is under pressure,
+            checkers which aren't critical are checked once every this
+            many ticks.
+        MAX_HEARTBEAT_DEFERRAL (int): seconds a full heartbeat may be
+            deferred while the system is under pressure.
+        ALERT_TIMEOUT (float): socket timeout in seconds for stall alerts
+            sent without an alert_transport.
+    """
+
+    READY_POLL_INTERVAL = 0.5
+    MAX_PROBE_THREADS = 16
+    REPORT_LEAD_TIME = 300
+    REPORT_DEADLINE = 600
+    CONTROL_TIMEOUT = 1
+    CONTROL_COMMANDS = ['status', 'force-heartbeat', 'restart <process>',
+                        'mute <checker> <seconds>', 'reload']
+    PRESSURE_BACKOFF_TICKS = 6
+    MAX_HEARTBEAT_DEFERRAL = 60 * 60 * 3
+    ALERT_TIMEOUT = 20
 
     def __init__(self):
         self.checkers = []
         self.heartbeat = HeartBeat()
         self.base_data_dir = ""
         self.sub_data_dir = ""
+        self.powerdata_checkers = [] # checkers created by load_powerdata
+        self.new_data_dir_callbacks = [] # functions called with new data dir
+        self._powerdata_options = {}
+        self._base_data_dir_mtime = None
+        self._last_numeric_subdir = None
+        self._new_data_dir_seen = None # (subdir, unixtime labels.dat found)
         self.state_change_cmds = [] # Commands to run if state changes
         self.shutdown_cmds = []
         self.SMTP_SERVER = ""
@@ -534,7 +3223,44 @@ class Manager(object):
         self.EMAIL_TO    = ""
         self.USERNAME    = ""
         self.PASSWORD    = ""
+        self.transport = None # a Transport. Defaults to SMTP_SSL.
+        self.max_email_bytes = 8 * 1024**2
+        self.max_attachment_bytes = 1024**2
+        self.max_text_chars = 20000 # length of plain text alternative
         self.shutdown_reason = ""
+        self._wakeup_r = None # read end of the self-pipe written on signals
+        self.config_filename = None
+        self._reload_requested = False
+        self._config_checkers = {} # maps checker spec (JSON) to checker
+        self._config = {}
+        self.publish_urls = [] # Aggregator URLs to POST snapshots to
+        self.publish_token = None # the Aggregators' token, if they have one
+        self.aggregator = None # set to an Aggregator to monitor other hosts
+        self.remote_stale_after = 60 # seconds
+        self.last_snapshot = None # Manager.snapshot() as of the last tick
+        self._started = time.time()
+        self._snapshot_seq = 0
+        self._probe_pool = None
+        self.last_report = None # last heartbeat report prepared successfully
+        self._report_fresh = False # True if last_report hasn't been sent
+        self._report_error = "" # why the last preparation failed
+        self._report_pool = None
+        self._pending_report = None # AsyncResult from _report_pool
+        self._report_started = None
+        self._report_prepared_for = None # heartbeat due time
+        self._waiting_heartbeats = [] # full heartbeat HTML awaiting a report
+        self.control_socket = None # path of Unix socket for handle_command
+        self._control_sock = None
+        self.muted = {} # checker name: unixtime until which it's muted
+        self._force_heartbeat = False
+        self.tick_budget = 300 # seconds. See Watchdog. None to disable.
+        self.skipped = {} # checker: root cause checker, as of the last tick
+        self.settling = {} # skipped checker: unixtime it'll be checked again
+        self.alert_transport = None # Transport for watchdog alerts
+        self.watchdog = None # created by run()
+        self.pressure = SystemPressure()
+        self._ticks = 0
+        self._heartbeat_deferred_since = None # unixtime, while deferred
         
         # Python registers SIGINT but not SIGTERM. So use the same
         # sig handler for SIGINT for SIGTERM.  This allows us to 
@@ -543,91 +3269,852 @@ class Manager(object):
         
     def append(self, checker):
         self.checkers.append(checker)
-        log.info('Added {} to Manager: {}'.format(checker.__class__.__name__,
-                                                     self.checkers[-1]))
+        log.info('Added %s to Manager: %s', checker.__class__.__name__,
+                 self.checkers[-1])
         
     def run(self):
         """The main loop.  This continually checks the state of each checker
         and sends an email if any checker changes state.  Also sends hearbeat.
-        
-        Raises:
-            NewDataDirError: if a new data directory is identified.
+        If a new numeric data subdirectory appears then we switch to it
+        in place (see switch_data_dir).
         """
         
+        if self.control_socket and self._control_sock is None:
+            self.open_control_socket(self.control_socket)
+
+        # Launch the processes we own
+        if self._owned_processes():
+            self._watch_children()
+            for checker in self._owned_processes():
+                checker.start()
+
+        self.watchdog = Watchdog(self.tick_budget, self._send_stall_alert)
+        self.watchdog.start()
+        sd_notify("READY=1")
+
         # Loop through all checkers to do an initial state check
+        self.watchdog.tick_started()
+        self.pressure.sample()
         for checker in self.checkers:
             checker.update_last_state()
 
         # Send initial heartbeat
         self._send_heartbeat()
+        self.watchdog.tick_finished()
         
         # Main loop
         while True:       
-            html = ""
-            for checker in self.checkers:
-                if checker.just_changed_state():
-                    log.warn("Checker {} has changed state."
-                             .format(checker.name))
-                    html += "<li>" + checker.html() + "</li>\n"
-                    
-                if isinstance(checker, Process) and checker.state() == FAIL:
-                    log.warn("Process {} is not running."
-                             .format(checker.name))
-                    html += ("<li>Attempting to restart " + 
-                             escape(checker.name) + "...</li>\n")
-                    try:
-                        checker.restart()
-                    except MaxRetriesError, e:
-                        self.shutdown_reason = str(e)
-                        return
-                    time.sleep(5)
-                    html += ("<li>State after restart: " + 
-                             checker.html() + "</li>\n")
-
-            if html:
-                html = "<h2>STATE CHANGED:</h2>\n<ul>\n" + html + "</ul>\n" 
-                html += self.html()
-                html += run_commands(self.state_change_cmds)
-                self.send_email_with_time(html=html,
-                                          subject="Babysitter detected"
-                                                  " state change.")
-
-            if self._need_to_send_heartbeat():
-                self._send_heartbeat()
-
-            # Check if a new data subdir has been created
-            if self.base_data_dir and self.sub_data_dir:
-                if self._find_last_numeric_subdir() != self.sub_data_dir:
-                    self._send_heartbeat("<p>New subdir found so about to restart "
-                                         "babysitter. Below are the last stats "
-                                         "for the old data subdirectory.</p>\n")
-                    raise NewDataDirError()
-    
-            time.sleep(UPDATE_PERIOD)
+            self.watchdog.tick_started()
+            self._tick()
+            self.watchdog.tick_finished()
+            timeout = UPDATE_PERIOD
+            time_until_heartbeat = self._time_until_heartbeat()
+            if time_until_heartbeat is not None:
+                timeout = min(timeout, time_until_heartbeat)
+            self._wait(timeout)
+
+    def _owned_processes(self):
+        return [checker for checker in self.checkers
+                if isinstance(checker, Process) and checker.owns_child]
+
+    def _init_wakeup_fd(self):
+        """Create a self-pipe which the interpreter writes to whenever a
+        signal arrives, so signals can wake up _wait().  Must be called from
+        the main thread."""
+        if self._wakeup_r is not None:
+            return
+        r, w = os.pipe()
+        for fd in (r, w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._wakeup_r = r
+        signal.set_wakeup_fd(w)
+
+    def _watch_children(self):
+        """Arrange for SIGCHLD to wake up _wait().  Must be called from
+        the main thread."""
+        self._init_wakeup_fd()
+        # A Python-level handler is required for the wakeup fd to be
+        # written.  Restart interrupted system calls (except select).
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def _wait(self, timeout):
+        """Sleep for up to timeout seconds, answering any control socket
+        commands.  Returns early if a child process which we own exits, a
+        config reload or heartbeat is requested, or the report which a
+        full heartbeat is waiting for is ready."""
+        deadline = time.time() + timeout
+        running = [checker for checker in self._owned_processes()
+                   if checker.child is not None and checker.child.returncode is None]
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            if self._waiting_heartbeats:
+                if (self._report_fresh or self._pending_report is None or
+                    self._pending_report.ready()):
+                    return
+                remaining = min(remaining, self.READY_POLL_INTERVAL)
+            fds = [fd for fd in (self._wakeup_r, self._control_sock) 
+                   if fd is not None]
+            if not fds:
+                time.sleep(remaining)
+                continue
+            try:
+                readable = select.select(fds, [], [], remaining)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = [self._wakeup_r]
+            if self._control_sock is not None and self._control_sock in readable:
+                self._serve_control()
+                if self._reload_requested or self._force_heartbeat:
+                    return
+            if self._wakeup_r is not None and self._wakeup_r in readable:
+                try:
+                    while os.read(self._wakeup_r, 512):
+                        pass
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                # SIGCHLD is also raised by commands we run, so only
+                # wake up if one of our own children has exited.
+                if (self._reload_requested or 
+                    any(checker.child_exited() for checker in running)):
+                    return
+
+    def _tick(self):
+        """Check every checker once, supervise processes and send any
+        emails which are due."""
+        if self._reload_requested:
+            self._reload_requested = False
+            self.reload_config()
+
+        if self.aggregator is not None:
+            self._add_remote_hosts()
+
+        was_pressured = bool(self.pressure.reasons)
+        pressured = bool(self.pressure.sample())
+        if pressured and not was_pressured:
+            log.warn("System under pressure (%s). Backing off.", 
+                     "; ".join(self.pressure.reasons))
+        elif was_pressured and not pressured:
+            log.info("System no longer under pressure.")
+        for checker in self.checkers:
+            if isinstance(checker, Process):
+                checker.fork_free = pressured
+        backoff = pressured and self._ticks % self.PRESSURE_BACKOFF_TICKS != 0
+        self._ticks += 1
+
+        self._run_probes(backoff)
+
+        # Check parents before the checkers which depend on them, and skip
+        # dependents of failed parents, reporting only the root cause.
+        html = ""
+        skipped = {}
+        present = set(self.checkers)
+        now = time.time()
+        for checker in self._ordered_checkers():
+            root_cause = self._root_cause(checker, skipped, present)
+            if root_cause is None and checker in self.skipped:
+                # Its dependencies have recovered.  Re-baseline it quietly
+                # (e.g. ChannelData consumes the lines written during the
+                # outage) and keep skipping it for settle_time(), so that
+                # it's only reported if it's still FAIL after that.
+                if checker not in self.settling:
+                    checker.update_last_state()
+                    self.settling[checker] = now + checker.settle_time()
+                if now < self.settling[checker]:
+                    root_cause = self.skipped[checker]
+                else:
+                    del self.settling[checker]
+                    checker.last_state = OK
+            elif root_cause is not None:
+                self.settling.pop(checker, None)
+            if root_cause is not None:
+                skipped[checker] = root_cause
+                continue
+            if backoff and not checker.critical:
+                continue
+            changed = checker.changed_html()
+            if isinstance(checker, Process):
+                changed += checker.supervise()
+            if changed and self._is_muted(checker):
+                log.info("Not emailing about muted checker %s", checker.name)
+                changed = ""
+            html += changed
+
+        newly_skipped = collections.defaultdict(list)
+        for checker, root_cause in skipped.items():
+            if self.skipped.get(checker) is not root_cause:
+                newly_skipped[root_cause].append(checker)
+        for root_cause, checkers in newly_skipped.items():
+            log.info("Skipping %d checkers until %s is OK", 
+                     len(checkers), root_cause.name)
+            if not self._is_muted(root_cause):
+                html += ("<li>Skipping {:d} dependent checkers until {} is OK."
+                         "</li>\n".format(len(checkers), 
+                                          escape(root_cause.short_name())))
+        self.skipped = skipped
+        for checker in list(self.settling):
+            if checker not in skipped: # e.g. removed by a config reload
+                del self.settling[checker]
+
+        if html:
+            html = "<h2>STATE CHANGED:</h2>\n<ul>\n" + html + "</ul>\n" 
+            html += self.html()
+            html += run_commands(self.state_change_cmds)
+            self.send_email_with_time(html=html,
+                                      subject="Babysitter detected"
+                                              " state change.")
+
+        self._send_waiting_heartbeats()
+        next_full_due = self.heartbeat.next_full_due()
+        if (not pressured and next_full_due is not None and 
+            next_full_due != self._report_prepared_for and
+            (next_full_due - datetime.datetime.utcnow()).total_seconds() <= 
+            self.REPORT_LEAD_TIME):
+            self._report_prepared_for = next_full_due
+            self._prepare_report()
+
+        # Under pressure, send a summary in place of a full heartbeat and
+        # defer the full report (which runs heartbeat.cmds) until the
+        # pressure eases or MAX_HEARTBEAT_DEFERRAL has passed.
+        due = self._need_to_send_heartbeat()
+        full = self._force_heartbeat or any(schedule.full_report 
+                                            for schedule in due)
+        note = ""
+        if full and pressured and not self._force_heartbeat:
+            if self._heartbeat_deferred_since is None:
+                log.warn("Deferring full heartbeat because the system is "
+                         "under pressure.")
+                self._heartbeat_deferred_since = time.time()
+        if self._heartbeat_deferred_since is not None:
+            deferred_for = time.time() - self._heartbeat_deferred_since
+            if (self._force_heartbeat or not pressured or 
+                deferred_for > self.MAX_HEARTBEAT_DEFERRAL):
+                full = True
+                self._heartbeat_deferred_since = None
+                note = ("<p>This heartbeat was deferred for {:.0f} minutes "
+                        "because the system was under pressure.</p>\n"
+                        .format(deferred_for / 60))
+            else:
+                full = False
+                note = ("<p>Full heartbeat deferred because the system is "
+                        "under pressure: {}.</p>\n".format(
+                            escape("; ".join(self.pressure.reasons))))
+        if due or full:
+            self._force_heartbeat = False
+            self._send_heartbeat(additional_html=note, full=full)
+
+        # Check if a new data subdir has been created
+        if self.base_data_dir and self.sub_data_dir:
+            sub_data_dir = self._find_last_numeric_subdir()
+            if (sub_data_dir and sub_data_dir != self.sub_data_dir and
+                self._new_data_dir_ready(sub_data_dir)):
+                self._send_heartbeat("<p>New subdir {} found. Below are the "
+                                     "last stats for the old data "
+                                     "subdirectory.</p>\n"
+                                     .format(escape(sub_data_dir)))
+                self.switch_data_dir(sub_data_dir)
+
+        self.last_snapshot = self.snapshot()
+        for url in self.publish_urls:
+            self._publish(url, self.last_snapshot)
+
+    def _run_probes(self, backoff=False):
+        """Run every NetworkProbe concurrently and wait for them all.  Each
+        probe has its own timeout, so this takes about as long as the
+        slowest probe.  If backoff then probes which aren't critical are
+        left out."""
+        probes = [checker for checker in self.checkers
+                  if isinstance(checker, NetworkProbe) and 
+                  checker not in self.skipped and
+                  (checker.critical or not backoff)]
+        if not probes:
+            return
+        if self._probe_pool is None:
+            self._probe_pool = ThreadPool(self.MAX_PROBE_THREADS)
+        self._probe_pool.map(NetworkProbe.probe, probes)
+
+    def _ordered_checkers(self):
+        """Returns self.checkers in topological order: every checker comes
+        after the checkers it depends on.  Otherwise the order is kept."""
+        present = set(self.checkers)
+        ordered = []
+        done = set()
+        visiting = set()
+
+        def visit(checker):
+            if checker in done:
+                return
+            if checker in visiting:
+                log.warn("Dependency cycle involving %s", checker.name)
+                return
+            visiting.add(checker)
+            for parent in checker.depends_on:
+                if parent in present:
+                    visit(parent)
+            visiting.discard(checker)
+            done.add(checker)
+            ordered.append(checker)
+
+        for checker in self.checkers:
+            visit(checker)
+        return ordered
+
+    def _root_cause(self, checker, skipped, present):
+        """Returns the failed checker which checker should be skipped
+        because of, or None.  skipped maps each checker skipped so far this
+        tick to its root cause.  present is the set of our checkers."""
+        for parent in checker.depends_on:
+            if parent in skipped:
+                return skipped[parent]
+            if parent in present and parent.last_state == FAIL:
+                return parent
+
+    def _find_checker(self, name, cls=Checker):
+        """Returns the first checker of class cls whose name or short name
+        is name, or None."""
+        for checker in self.checkers:
+            if (isinstance(checker, cls) and 
+                name in (checker.name, checker.short_name())):
+                return checker
+
+    def _resolve_dependencies(self, depends_on):
+        """Returns a list of Checkers, given a list of Checkers or names."""
+        parents = []
+        for parent in depends_on or []:
+            if isinstance(parent, basestring):
+                name, parent = parent, self._find_checker(parent)
+                if parent is None:
+                    log.warn("Can't find checker %s to depend on", name)
+                    continue
+            parents.append(parent)
+        return parents
+
+    def snapshot(self):
+        """Returns a JSON-serialisable dict of the state of every checker as
+        of the last tick."""
+        self._snapshot_seq += 1
+        checkers = []
+        for checker in self.checkers:
+            if checker in self.skipped:
+                checkers.append({'type': checker.__class__.__name__,
+                                 'name': checker.name,
+                                 'state': int(checker.last_state),
+                                 'text': ", skipped until {} is OK"
+                                         .format(self.skipped[checker].name),
+                                 'skipped_because': self.skipped[checker].name})
+            else:
+                checkers.append(checker.snapshot())
+        return {'host': os.uname()[1],
+                'started': self._started,
+                'seq': self._snapshot_seq,
+                'time': time.time(),
+                'pressure': self.pressure.reasons,
+                'checkers': checkers}
+
+    def _publish(self, url, snapshot):
+        """POST snapshot to an Aggregator at url.  Errors are logged."""
+        headers = {'Content-Type': 'application/json'}
+        if self.publish_token:
+            headers['Authorization'] = "Bearer " + self.publish_token
+        request = urllib2.Request(url, json.dumps(snapshot), headers)
+        try:
+            urllib2.urlopen(request, timeout=5).close()
+        except (urllib2.URLError, socket.error) as e:
+            log.warn("Failed to publish snapshot to %s: %s", url, e)
+
+    def _add_remote_hosts(self):
+        """Add a RemoteHost checker for each host new to the aggregator."""
+        known = set(checker.name for checker in self.checkers
+                    if isinstance(checker, RemoteHost))
+        for host in self.aggregator.hosts():
+            if host not in known:
+                self.append(RemoteHost(self.aggregator, host,
+                                       self.remote_stale_after))
     
+    def _get_alert_transport(self):
+        """Returns alert_transport or, failing that, a copy of the normal
+        Transport with a short timeout, so a stall alert never uses the
+        object which the stalled main loop may be sending with."""
+        if self.alert_transport is not None:
+            return self.alert_transport
+        transport = self._get_transport()
+        if transport is None or transport is not self.transport:
+            return transport # None, or a new SMTPSSLTransport
+        transport = copy.copy(transport)
+        if hasattr(transport, 'timeout'):
+            transport.timeout = min(transport.timeout, self.ALERT_TIMEOUT)
+        return transport
+
+    def _send_stall_alert(self, elapsed, stack):
+        """Email the stack of a stalled main loop.  Called from the watchdog
+        thread, so this only sends one plain email over its own transport
+        (see _get_alert_transport) and doesn't touch the checkers, which
+        may be what's stuck."""
+        transport = self._get_alert_transport()
+        if transport is None:
+            return
+        text = ("Babysitter's main loop has been stuck in one tick for {:.0f}"
+                " seconds.  Main thread stack:\n\n{}".format(elapsed, stack))
+        headers = [('Subject', 'Babysitter main loop stalled'),
+                   ('From', self._email_from()),
+                   ('Date', formatdate(localtime=True)),
+                   ('To', ", ".join(self.EMAIL_TO))]
+        msg = LazyEmail(headers, text, "<pre>" + escape(text) + "</pre>\n")
+        transport.send(self._email_from(), self.EMAIL_TO, msg)
+
+    def _is_muted(self, checker):
+        until = self.muted.get(checker.name)
+        if until is None:
+            return False
+        if until <= time.time():
+            log.info("Unmuted %s", checker.name)
+            del self.muted[checker.name]
+            return False
+        return True
+
+    def open_control_socket(self, path):
+        """Listen for control commands (see handle_command) on a
+        Unix-domain socket at path.  ctl.py is the client.  Commands are
+        answered from _wait(), between ticks."""
+        self.close_control_socket()
+        self._control_sock = self._bind_control_socket(path)
+        self.control_socket = path
+        log.info("Listening for control commands on %s", path)
+
+    def _bind_control_socket(self, path):
+        """Returns a new non-blocking listening socket at path."""
+        try:
+            os.unlink(path) # left over from a previous run
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(path)
+            os.chmod(path, 0o600)
+            sock.listen(5)
+        except:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        return sock
+
+    def close_control_socket(self):
+        if self._control_sock is None:
+            return
+        self._control_sock.close()
+        self._control_sock = None
+        try:
+            os.unlink(self.control_socket)
+        except OSError:
+            pass
+
+    def _serve_control(self):
+        """Answer every client waiting on the control socket.  Each
+        client sends one command line and gets one JSON response."""
+        while True:
+            try:
+                conn = self._control_sock.accept()[0]
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            try:
+                conn.settimeout(self.CONTROL_TIMEOUT)
+                line = conn.makefile('rb').readline(4096)
+                conn.sendall(json.dumps(self.handle_command(line)) + "\n")
+            except socket.error as e:
+                log.warn("Control socket client error: %s", e)
+            finally:
+                conn.close()
+
+    def handle_command(self, line):
+        """Carry out a control command.  Never probes the system: status
+        is answered from last_snapshot.
+
+        Args:
+            line (str): one of CONTROL_COMMANDS, e.g. "mute channel_3.dat 600".
+                Zero seconds unmutes.
+
+        Returns:
+            dict with key 'ok' (bool) and either 'message' (str) or, for
+            status, 'status' (dict; last_snapshot plus 'muted').
+        """
+        words = line.split()
+        command, args = (words[0], words[1:]) if words else ("", [])
+        log.info("Control command: %s", line.strip())
+
+        def error(message):
+            return {'ok': False, 'message': message}
+
+        find = self._find_checker
+
+        if command == 'status' and not args:
+            status = dict(self.last_snapshot or {})
+            now = time.time()
+            status['muted'] = dict((name, until - now) for name, until 
+                                   in self.muted.items() if until > now)
+            return {'ok': True, 'status': status}
+        elif command == 'force-heartbeat' and not args:
+            self._force_heartbeat = True
+            return {'ok': True, 'message': "Heartbeat will be sent"}
+        elif command == 'restart' and len(args) == 1:
+            checker = find(args[0], Process)
+            if checker is None:
+                return error("No process called " + args[0])
+            if checker.restart_command is None:
+                return error(checker.name + " has no restart command")
+            # restart() always launches, so never start a second copy
+            if checker.child is not None and checker.running():
+                checker.stop_child()
+            elif checker.running():
+                return error("{} is running (pid {}) and babysitter doesn't "
+                             "own it, so stop it first".format(
+                                 checker.name, 
+                                 " ".join(str(pid) for pid in checker._pids)))
+            checker.given_up = False
+            checker.retries = 0
+            checker.restart()
+            return {'ok': True, 'message': "Restarting " + checker.name}
+        elif command == 'mute' and len(args) == 2:
+            checker = find(args[0])
+            if checker is None:
+                return error("No checker called " + args[0])
+            try:
+                seconds = float(args[1])
+            except ValueError:
+                return error("Duration must be a number of seconds")
+            if seconds <= 0:
+                self.muted.pop(checker.name, None)
+                return {'ok': True, 'message': "Unmuted " + checker.name}
+            self.muted[checker.name] = time.time() + seconds
+            return {'ok': True, 'message': "Muted {} for {:.0f} seconds"
+                                           .format(checker.name, seconds)}
+        elif command == 'reload' and not args:
+            if not self.config_filename:
+                return error("Not using a config file")
+            self._reload_requested = True
+            return {'ok': True, 'message': "Reloading " + self.config_filename}
+        return error("Unknown command. Commands are: " + 
+                     ", ".join(self.CONTROL_COMMANDS))
+
+    def load_config(self, filename):
+        """Load a JSON config file (see load_config()) into this Manager
+        and reload it whenever we receive SIGHUP.  Must be called from the
+        main thread.
+
+        Raises:
+            ConfigError
+        """
+        self.apply_config(load_config(filename))
+        self.config_filename = filename
+        self._init_wakeup_fd()
+        signal.signal(signal.SIGHUP, self._handle_sighup)
+        signal.siginterrupt(signal.SIGHUP, False)
+
+    def _handle_sighup(self, signum, frame):
+        self._reload_requested = True
+
+    def reload_config(self):
+        """Re-read config_filename.  If it is invalid then log an error and
+        keep the current config."""
+        log.info("Reloading config from %s", self.config_filename)
+        # A config which passes validation can still fail to apply (e.g.
+        # a path which doesn't exist) and apply_config changes nothing
+        # until everything has been built, so any error is safe to ignore.
+        try:
+            config = load_config(self.config_filename)
+            self.apply_config(config)
+        except Exception:
+            log.exception("Failed to reload config. Keeping old config.")
+
+    def apply_config(self, config):
+        """Apply a validated config dict.  Checkers whose spec hasn't changed
+        since the previous call are kept (along with their state), removed
+        ones are dropped and new ones are created.  Every checker which
+        depended on a replaced checker then depends on its replacement.
+
+        Every new object (transports, checkers, schedules and the control
+        socket) is built before the Manager is changed, so if building one
+        raises then the current config is left as it was."""
+        email = config.get('email', {})
+        transport = self.transport
+        if email != self._config.get('email'):
+            transport = make_transport(email)
+
+        new_config_checkers = {}
+        added = []
+        for spec in config.get('checkers', []):
+            key = json.dumps(spec, sort_keys=True)
+            if key in self._config_checkers:
+                new_config_checkers[key] = self._config_checkers[key]
+            elif key not in new_config_checkers:
+                kwargs = dict((k, v) for k, v in spec.items() 
+                              if k not in ('type', 'depends_on', 'critical'))
+                checker = CHECKER_TYPES[spec['type']](**kwargs)
+                new_config_checkers[key] = checker
+                added.append(checker)
+
+        heartbeat = config.get('heartbeat', {})
+        schedules = None # None means keep the current schedules
+        if heartbeat != self._config.get('heartbeat'):
+            schedules = [make_schedule(spec) 
+                         for spec in heartbeat.get('schedules', [])]
+
+        watchdog = config.get('watchdog', {})
+        alert_email = watchdog.get('alert_email')
+        alert_transport = self.alert_transport
+        if alert_email != self._config.get('watchdog', {}).get('alert_email'):
+            alert_transport = (make_transport(alert_email, default_ssl=True)
+                               if alert_email else None)
+
+        powerdata = config.get('powerdata')
+        powerdata_changed = powerdata and powerdata != self._config.get('powerdata')
+        if powerdata_changed and not os.path.isdir(powerdata['directory']):
+            raise ConfigError("powerdata directory {} not found"
+                              .format(powerdata['directory']))
+
+        # Bind last: nothing after this can fail.
+        control_socket = config.get('control_socket')
+        control_sock = None
+        if (control_socket and 
+            control_socket != self._config.get('control_socket') and
+            (control_socket != self.control_socket or 
+             self._control_sock is None)):
+            control_sock = self._bind_control_socket(control_socket)
+
+        # Now swap everything in.
+        self.SMTP_SERVER = email.get('server', "")
+        self.EMAIL_FROM = email.get('from', "")
+        self.EMAIL_TO = email.get('to', [])
+        self.USERNAME = email.get('username', "")
+        self.PASSWORD = email.get('password', "")
+        self.transport = transport
+
+        for checker in added:
+            self.append(checker)
+        for key, checker in self._config_checkers.items():
+            if key not in new_config_checkers:
+                log.info("Removing %s from Manager: %s",
+                         checker.__class__.__name__, checker.name)
+                self.checkers.remove(checker)
+        self._config_checkers = new_config_checkers
+        for key, checker in self._config_checkers.items():
+            spec = json.loads(key)
+            checker.depends_on = self._resolve_dependencies(
+                                     spec.get('depends_on'))
+            if 'critical' in spec:
+                checker.critical = spec['critical']
+        parents = self._resolve_dependencies(
+                      self._powerdata_options.get('depends_on'))
+        for checker in self.powerdata_checkers:
+            checker.depends_on = list(parents)
+        # Other checkers added from code (e.g. with append()) hold Checker
+        # objects, so point any which depend on a checker this reload
+        # replaced at its replacement, found by type and name.
+        present = set(self.checkers)
+        for checker in self.checkers:
+            checker.depends_on = [parent if parent in present else
+                                  self._find_checker(parent.name,
+                                                     parent.__class__) or parent
+                                  for parent in checker.depends_on]
+
+        if powerdata_changed:
+            if self.base_data_dir:
+                self.base_data_dir = os.path.realpath(powerdata['directory'])
+                self._powerdata_options = {
+                    'timeout': powerdata.get('timeout', 120),
+                    'validate': powerdata.get('validate', False),
+                    'max_wait': powerdata.get('max_wait', 65),
+                    'depends_on': powerdata.get('depends_on', [])}
+                self._base_data_dir_mtime = None
+                if powerdata.get('numeric_subdirs', True):
+                    sub_data_dir = self._find_last_numeric_subdir() or ""
+                else:
+                    sub_data_dir = ""
+                self.switch_data_dir(sub_data_dir)
+            else:
+                data_dir = self.load_powerdata(**powerdata)
+                for callback in self.new_data_dir_callbacks:
+                    callback(data_dir)
+
+        # Only replace schedules if they've changed, to keep their state
+        if schedules is not None:
+            self.heartbeat.schedules = schedules
+            self.heartbeat.hour = heartbeat.get('hour')
+        self.heartbeat.cmds = [tuple(cmd) for cmd in heartbeat.get('cmds', [])]
+        self.heartbeat.html_file = heartbeat.get('html_file')
+        self.state_change_cmds = [tuple(cmd) for cmd in 
+                                  config.get('state_change_cmds', [])]
+        self.shutdown_cmds = [tuple(cmd) for cmd in 
+                              config.get('shutdown_cmds', [])]
+        self.publish_urls = config.get('publish_urls', [])
+        self.publish_token = config.get('publish_token')
+        self.tick_budget = watchdog.get('tick_budget', 300)
+        if self.watchdog is not None:
+            self.watchdog.budget = self.tick_budget
+        self.alert_transport = alert_transport
+
+        if control_sock is not None:
+            self.close_control_socket()
+            self._control_sock = control_sock
+            self.control_socket = control_socket
+            log.info("Listening for control commands on %s", control_socket)
+        elif not control_socket and self._config.get('control_socket'):
+            self.close_control_socket()
+        self._config = config
+
     def _need_to_send_heartbeat(self):
+        """Returns the heartbeat schedules which are due (or overdue) and
+        marks them as run."""
         if not self.heartbeat:
-            return False
+            return []
         
-        now_hour = datetime.datetime.utcnow().hour
-        need_to_send = (now_hour == self.heartbeat.hour and
-                        self.heartbeat.last_checked != self.heartbeat.hour)
-        self.heartbeat.last_checked = now_hour
-        return need_to_send
+        now = datetime.datetime.utcnow()
+        due = self.heartbeat.due(now)
+        for schedule in due:
+            if now - schedule.next_due > datetime.timedelta(seconds=UPDATE_PERIOD * 2):
+                log.info("Catching up on missed heartbeat due at %s (%s)",
+                         schedule.next_due, schedule)
+            schedule.mark_run(now)
+        return due
+
+    def _time_until_heartbeat(self):
+        """Returns seconds until the next heartbeat is due, or None."""
+        next_due = self.heartbeat.next_due() if self.heartbeat else None
+        if next_due is not None:
+            return max((next_due - datetime.datetime.utcnow()).total_seconds(), 0)
     
-    def _send_heartbeat(self, additional_html=""):
+    def _send_heartbeat(self, additional_html="", full=True):
+        """Send a heartbeat email.  A full report also runs heartbeat.cmds
+        and attaches heartbeat.html_file; a summary doesn't.
+
+        The state of the checkers is captured now, but if no report has
+        been prepared ahead of time then a full heartbeat waits in
+        _waiting_heartbeats (without blocking the main loop) until a
+        worker has prepared one or given up."""
         msg = additional_html
         msg += self.html()
-        msg += run_commands(self.heartbeat.cmds)
+        msg += channel_stats_html(self.checkers)
+        if self.watchdog is not None:
+            msg += self.watchdog.html()
+        msg += self.pressure.html()
+        if not full:
+            self.send_email_with_time(html=msg, 
+                                      subject='Babysitter heartbeat summary')
+            return
+        self._waiting_heartbeats.append(msg)
+        self._poll_report()
+        if not self._report_fresh:
+            self._prepare_report()
+        self._send_waiting_heartbeats()
+
+    def _send_waiting_heartbeats(self):
+        """Send the full heartbeats in _waiting_heartbeats once there's a
+        fresh report, or none is being prepared (i.e. preparation failed)."""
+        self._poll_report()
+        if not self._waiting_heartbeats:
+            return
+        if not self._report_fresh and self._pending_report is not None:
+            return
+        report, note = self._get_report()
+        waiting, self._waiting_heartbeats = self._waiting_heartbeats, []
+        for msg in waiting:
+            self._send_full_heartbeat(msg + note, report)
+
+    def _send_full_heartbeat(self, msg, report):
+        if report is None:
+            self.send_email(subject='Babysitter heartbeat', html=msg)
+            return
+        msg += report['cmds_html']
         msg += "<hr/>\n"
-        self._email_html_file(subject='Babysitter heartbeat', 
-                              filename=self.heartbeat.html_file,
-                              extra_text=msg)    
+        if report['html'] is None:
+            msg += ("<p><span style=\"color:red\">" + report['error'] + 
+                    "</span></p>")
+            self.send_email('Babysitter heartbeat', msg)
+            return
+        msg += "<p>HTML file below = " + self.heartbeat.html_file + "</p>\n"
+        html = report['html'].replace("<body>", "<body>\n{}".format(msg))
+        self.send_email('Babysitter heartbeat', html, report['img_files'])
+
+    def _prepare_report(self):
+        """Start preparing a heartbeat report (see prepare_report) in a
+        worker process, unless one is already being prepared."""
+        if self._pending_report is not None:
+            return
+        if self._report_pool is None:
+            self._report_pool = multiprocessing.Pool(1, _init_report_worker)
+        log.info("Preparing heartbeat report")
+        self._report_started = time.time()
+        self._pending_report = self._report_pool.apply_async(
+            _worker_prepare_report, 
+            (self.heartbeat.cmds, self.heartbeat.html_file))
+
+    def _poll_report(self):
+        """Collect the report being prepared, if it's ready.  If it has
+        taken longer than REPORT_DEADLINE then kill the worker."""
+        if self._pending_report is None:
+            return
+        if self._pending_report.ready():
+            try:
+                report = self._pending_report.get()
+            except Exception as e:
+                log.exception("Failed to prepare heartbeat report")
+                self._report_error = "exception = '{}'".format(e)
+            else:
+                for record in report.pop('log_records', []):
+                    logging.getLogger(record.name).handle(record)
+                log.info("Heartbeat report prepared in %.1f seconds",
+                         report['prepared'] - self._report_started)
+                self.last_report = report
+                self._report_fresh = True
+                self._report_error = ""
+            self._pending_report = None
+        elif time.time() - self._report_started > self.REPORT_DEADLINE:
+            self._report_error = ("timed out after {:.0f} seconds"
+                                  .format(time.time() - self._report_started))
+            log.warn("Heartbeat report %s", self._report_error)
+            self._terminate_report_pool()
+
+    def _terminate_report_pool(self):
+        if self._report_pool is not None:
+            self._report_pool.terminate()
+            self._report_pool.join()
+        self._report_pool = None
+        self._pending_report = None
+
+    def _get_report(self):
+        """Returns (report, note) for a full heartbeat, once no report is
+        being prepared.  If preparation failed or timed out, report is the
+        last good report (or None) and note is HTML explaining what went
+        wrong."""
+        if self._report_fresh:
+            self._report_fresh = False
+            return self.last_report, ""
+
+        note = ("<p><span style=\"color:red\">Failed to prepare heartbeat "
+                "report: {}.".format(escape(self._report_error)))
+        if self.last_report is not None:
+            note += (" Below is the last good report, prepared at {} UTC."
+                     .format(datetime.datetime.utcfromtimestamp(
+                             self.last_report['prepared']).replace(microsecond=0)))
+        note += "</span></p>\n"
+        return self.last_report, note
     
-    def load_powerdata(self, directory, numeric_subdirs, timeout):
+    def load_powerdata(self, directory, numeric_subdirs, timeout,
+                       validate=False, max_wait=65, depends_on=None):
         """
         Process a REDD-formatted power data directory (such as recorded by
         rfm_ecomanager_logger).
+
+        Returns as soon as labels.dat and every channel_N.dat file it lists
+        exist and are non-empty (immediately if they already are), or after
+        max_wait seconds, whichever is sooner.
         
         Parameters:
             - directory (str): if numeric_subdirs==True then directory is the
@@ -638,6 +4125,15 @@ class Manager(object):
             
             - timeout (int)
 
+            - validate (bool): if True then also add a ChannelData checker
+              per channel to validate the contents of each channel file.
+
+            - max_wait (float): max seconds to wait for the data files.
+
+            - depends_on (list of Checkers or checker names): e.g. the
+              logger Process and the DiskSpaceRemaining checker.  The
+              channel checkers are skipped while any of these is FAIL.
+
         Returns the full data directory
         """
                 
@@ -652,10 +4148,14 @@ class Manager(object):
 
         self.base_data_dir = os.path.realpath(directory)
         
-        # Wait 5 seconds for logger to init Nanode and create data dir
-        log.info("Waiting 5 seconds for logger to init Nanode...")
-        time.sleep(5)
-        log.info("Done waiting.")
+        deadline = time.time() + max_wait
+        while True:
+            full_data_dir, lines, missing = self._powerdata_ready(numeric_subdirs)
+            if lines is not None and not missing:
+                break
+            if time.time() > deadline:
+                break
+            time.sleep(Manager.READY_POLL_INTERVAL)
 
         # Check if the directory exists.
         if not os.path.isdir(self.base_data_dir):
@@ -664,158 +4164,278 @@ class Manager(object):
             self.shutdown()
             sys.exit(1)
         
-        # process numeric_subdirs
-        if numeric_subdirs:
+        log.info("full_data_dir = %s", full_data_dir)
+        
+        labels_filename = full_data_dir + "/labels.dat"
+        if lines is None:
+            self.shutdown_reason = "Failed to open " + labels_filename
+            self.shutdown()
+            sys.exit(1)
+
+        if missing:
+            log.warn("Gave up waiting after %ss for data files to populate: %s",
+                     max_wait, ", ".join(missing))
+        
+        self._powerdata_options = {
+            'timeout': timeout, 'validate': validate, 'max_wait': max_wait,
+            'depends_on': [getattr(parent, 'name', parent) 
+                           for parent in depends_on or []]}
+        self.powerdata_checkers = self._channel_checkers(full_data_dir, lines)
+        for checker in self.powerdata_checkers:
+            self.append(checker)
+
+        return full_data_dir
+
+    def _powerdata_ready(self, numeric_subdirs):
+        """Sets self.sub_data_dir and checks whether the data files exist yet.
+
+        Returns:
+            full_data_dir (str),
+            lines of labels.dat (list of str, or None if it can't be read),
+            channel files which don't exist or are empty (list of str)
+        """
+        if numeric_subdirs and os.path.isdir(self.base_data_dir):
             self.sub_data_dir = self._find_last_numeric_subdir()
                 
         full_data_dir = self.base_data_dir
         if self.sub_data_dir:
-            full_data_dir += "/" + self.sub_data_dir            
-                
-        log.info("full_data_dir = {}".format(full_data_dir))
-        
-        # load labels
-        labels_filename = full_data_dir + "/labels.dat"
-        log.info("Opening {} file".format(labels_filename))
+            full_data_dir += "/" + self.sub_data_dir
+
+        lines, missing = self._missing_channel_files(full_data_dir)
+        return full_data_dir, lines, missing
+
+    def _missing_channel_files(self, full_data_dir):
+        """Returns the lines of full_data_dir's labels.dat (or None if it
+        can't be read) and the channel files it lists which don't exist
+        or are empty."""
         try:
-            labels_file = open(labels_filename)
-        except IOError as e: # file not found
-            self.shutdown_reason = ("Failed to open " + labels_filename +
-                                    " " + str(e))
-            self.shutdown()
-            sys.exit(1)
-            
-        lines = labels_file.readlines()
-        labels_file.close()
-        
-        # Before instantiating File objects for each channel listed
-        # in labels.dat, wait until WAIT secs has passed since
-        # labels.dat was created.
-        labels_age = time.time() - os.path.getmtime(labels_filename)
-        WAIT = 60 # seconds
-        if labels_age < WAIT:
-            time_to_wait = WAIT - labels_age
-            log.info("Waiting {:.0f} seconds for data files to populate"
-                     .format(time_to_wait))
-            time.sleep(time_to_wait)
-        
-        # Instantiate one File object per line in labels.dat
+            with open(full_data_dir + "/labels.dat") as fh:
+                lines = fh.readlines()
+        except IOError: # file not found
+            return None, []
+
+        missing = []
+        for line in lines:
+            if not line.strip():
+                continue
+            file_name = full_data_dir + "/channel_{:d}.dat".format(int(line.split()[0]))
+            try:
+                if os.path.getsize(file_name):
+                    continue
+            except OSError:
+                pass
+            missing.append(file_name)
+        return lines, missing
+
+    def _new_data_dir_ready(self, sub_data_dir):
+        """Returns True once sub_data_dir's labels.dat and every channel file
+        it lists exist, or max_wait seconds after labels.dat was first
+        found.  Switching any earlier would create channel checkers which
+        start off FAIL and then report every channel as recovered."""
+        full_data_dir = os.path.join(self.base_data_dir, sub_data_dir)
+        lines, missing = self._missing_channel_files(full_data_dir)
+        if lines is None:
+            return False
+        now = time.time()
+        if (self._new_data_dir_seen is None or
+            self._new_data_dir_seen[0] != sub_data_dir):
+            self._new_data_dir_seen = (sub_data_dir, now)
+        if not missing:
+            return True
+        max_wait = self._powerdata_options.get('max_wait', 65)
+        if now - self._new_data_dir_seen[1] < max_wait:
+            return False
+        log.warn("Gave up waiting after %ss for data files to populate: %s",
+                 max_wait, ", ".join(missing))
+        return True
+
+    def _channel_checkers(self, full_data_dir, lines):
+        """Returns a list of checkers for the channels listed in the lines
+        of a labels.dat file."""
+        checkers = []
         for line in lines:
             line = line.split()
+            if not line:
+                continue
             chan = int(line[0])
             label = line[1]
             file_name = full_data_dir + "/channel_{:d}.dat".format(chan)
-            self.append(File(file_name, timeout, label))
+            timeout = self._powerdata_options['timeout']
+            checkers.append(File(file_name, timeout, label))
+            if self._powerdata_options['validate']:
+                checkers.append(ChannelData(file_name, label, max_gap=timeout))
+        # Resolve names every time, in case a reload replaced a parent
+        parents = self._resolve_dependencies(
+                      self._powerdata_options.get('depends_on'))
+        for checker in checkers:
+            checker.depends_on = list(parents)
+        return checkers
 
-        return full_data_dir
+    def switch_data_dir(self, sub_data_dir):
+        """Swap the checkers created by load_powerdata for checkers of the
+        channels in sub_data_dir, without touching any other checkers.
+        Calls each function in new_data_dir_callbacks with the new full
+        data directory.
+
+        Returns:
+            False if sub_data_dir's labels.dat can't be read yet.
+        """
+        full_data_dir = os.path.join(self.base_data_dir, sub_data_dir)
+        try:
+            with open(os.path.join(full_data_dir, "labels.dat")) as fh:
+                lines = fh.readlines()
+        except IOError:
+            return False
+
+        log.info("Switching to new data directory %s", full_data_dir)
+        new_checkers = self._channel_checkers(full_data_dir, lines)
+        old_checkers = self.powerdata_checkers
+        if old_checkers and old_checkers[0] in self.checkers:
+            i = self.checkers.index(old_checkers[0])
+        else:
+            i = len(self.checkers)
+        self.checkers = [checker for checker in self.checkers
+                         if checker not in old_checkers]
+        self.checkers[i:i] = new_checkers
+        self.powerdata_checkers = new_checkers
+        self.sub_data_dir = sub_data_dir
+        self._new_data_dir_seen = None
+        for callback in self.new_data_dir_callbacks:
+            callback(full_data_dir)
+        return True
     
     def _find_last_numeric_subdir(self):
-        """Find the highest number self.base_data_dir
+        """Find the highest numbered subdirectory of self.base_data_dir.
+        The directory is only listed if its mtime has changed (i.e. an entry
+        has been added, removed or renamed) since the previous call.
         
         Returns:
             String containing highest number subdir.
         """
-        existing_subdirs = os.walk(self.base_data_dir).next()[1]
-        
-        # Remove any subdirs which contain alphabetic characters
-        numeric_subdirs = [subdir for subdir in existing_subdirs 
-                           if not any(char.isalpha() for char in subdir)]
-
-        if numeric_subdirs:
-            numeric_subdirs.sort()
-            return numeric_subdirs[-1]
-        
-        
-    def _email_html_file(self, subject, filename, extra_text=""):
-            
-        # Load the HTML filename as an ElementTree so we can extract
-        # all images and modify the src to include "cid:"
         try:
-            tree = ET.parse(filename)
-        except Exception as e:
-            msg = ("Failed to open filename {}; exception = '{}'"
-                   .format(filename, str(e)))
-            log.warn(msg)
-            extra_text += "<p><span style=\"color:red\">" + msg + "</span></p>"
-            self.send_email(subject, extra_text) 
-            return
+            mtime = os.stat(self.base_data_dir).st_mtime
+        except OSError:
+            return self._last_numeric_subdir
         
-        # Extract images
-        directory = os.path.dirname(filename)        
-        img_files = []
-        for img in tree.getiterator('img'):
-            img_file = os.path.join(directory, img.get('src'))
-            img_files.append(img_file)
-            img.set('src', "cid:"+img.get('src'))
+        # Don't trust mtimes from the last couple of seconds because some
+        # filesystems only store mtimes to the nearest second.
+        if mtime == self._base_data_dir_mtime and mtime < time.time() - 2:
+            return self._last_numeric_subdir
+        self._base_data_dir_mtime = mtime
 
-        html = ET.tostring(tree.getroot())
-        
-        extra_text += "<p>HTML file below = " + filename + "</p>\n"
-        
-        html = html.replace("<body>", "<body>\n{}".format(extra_text))
+        numeric_subdirs = [subdir for subdir in os.listdir(self.base_data_dir)
+                           if subdir.isdigit() and 
+                           os.path.isdir(os.path.join(self.base_data_dir, subdir))]
+
+        if numeric_subdirs:
+            self._last_numeric_subdir = max(numeric_subdirs, key=int)
+        else:
+            self._last_numeric_subdir = None
+        return self._last_numeric_subdir
         
-        self.send_email(subject, html, img_files)
         
     def send_email_with_time(self, subject, html):
         html += '<p>Unixtime = {}</p>\n'.format(time.time())       
         html = "<html>\n<head></head>\n<body>" + html + "</body>\n</html>\n"
         self.send_email(subject, html)        
 
+    def _get_transport(self):
+        """Returns the configured Transport, or a new SMTPSSLTransport built
+        from SMTP_SERVER, USERNAME and PASSWORD, or None if email is not
+        configured."""
+        if self.transport is not None:
+            return self.transport
+        if self.SMTP_SERVER:
+            return SMTPSSLTransport(self.SMTP_SERVER, username=self.USERNAME,
+                                    password=self.PASSWORD)
+
+    def _email_from(self):
+        hostname = os.uname()[1]
+        return hostname + '<' + self.EMAIL_FROM + '>'
+
+    def build_email(self, subject, html, img_files=None):
+        """Returns a LazyEmail ready to hand to a Transport.
+
+        Images larger than max_attachment_bytes, or which would push the
+        email over max_email_bytes, are thumbnailed (if PIL is installed)
+        or omitted, so that the whole email is at most max_email_bytes
+        (unless the text alone is larger).
+        """
+        html = (html + "<hr/>\n<p>Local IP address: " + 
+                str(get_ip_address()) + "</p>\n")    
+        text = compact_text(html, self.max_text_chars)
+
+        headers = [('Subject', subject),
+                   ('From', self._email_from()),
+                   ('Date', formatdate(localtime=True)),
+                   ('To', ", ".join(self.EMAIL_TO))]
+        msg = LazyEmail(headers, text, html)
+
+        candidates = []
+        for img_filename in (img_files or []):
+            try:
+                candidates.append(Attachment(img_filename))
+            except OSError:
+                log.warn("Can't open image file %s", img_filename)
+        omitted_html = ("<p>Images omitted to keep email under {:d} bytes:</p>\n"
+                        "<ul>\n{}</ul>\n")
+        notes = ["<li>{} ({:d} bytes)</li>\n"
+                 .format(escape(attachment.basename), attachment.size)
+                 for attachment in candidates]
+
+        # The budget counts every byte of the final message (base64 lines
+        # and MIME headers included, with CRLF line endings) and keeps back
+        # room for the note about each image until it's been attached.
+        def crlf_len(part):
+            return len(part) + part.count('\n')
+        separator = len('--{}\r\n'.format(msg.related_boundary))
+        budget = (self.max_email_bytes - len(msg.as_string()) - 
+                  crlf_len(omitted_html.format(self.max_email_bytes, "")) -
+                  sum(crlf_len(note) for note in notes))
+        attachments = []
+        omitted = ""
+        for attachment, note in zip(candidates, notes):
+            budget += crlf_len(note)
+            if (attachment.size > self.max_attachment_bytes or
+                attachment.encoded_size() + separator > budget):
+                max_bytes = min(self.max_attachment_bytes,
+                                attachment.max_size(budget - separator))
+                thumb = (make_thumbnail(attachment.filename, max_bytes) 
+                         if max_bytes > 0 else None)
+                if thumb is None:
+                    omitted += note
+                    budget -= crlf_len(note)
+                    continue
+                attachment = Attachment(attachment.filename, data=thumb)
+
+            budget -= attachment.encoded_size() + separator
+            attachments.append(attachment)
+
+        if omitted:
+            log.info("Omitted images to keep email under size caps")
+            msg.html += omitted_html.format(self.max_email_bytes, omitted)
+        msg.attachments = attachments
+        return msg
+
     def send_email(self, subject, html, img_files=None):
-        if not self.SMTP_SERVER:
+        transport = self._get_transport()
+        if transport is None:
             log.info("Not sending email because no SMTP server configured")
             return
                 
-        html = (html + "<hr/>\n<p>Local IP address: " + 
-                str(get_ip_address()) + "</p>\n")    
-            
-        hostname = os.uname()[1]
-        me = hostname + '<' + self.EMAIL_FROM + '>'
-        
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = subject
-        msg['From'] =  me
-        msg['Date'] = formatdate(localtime=True)
-        msg['To'] = ", ".join(self.EMAIL_TO)
-        
-        msg.attach(MIMEText(html_to_text(html), 'plain'))        
-        msg.attach(MIMEText(html, 'html'))        
+        msg = self.build_email(subject, html, img_files)
     
-        # Attach image files
-        if img_files:
-            for img_filename in img_files:
-                try:
-                    fp = open(img_filename, 'rb')
-                except:
-                    log.warn("Can't open image file {}".format(img_filename))
-                else:
-                    mime_img = MIMEImage(fp.read())
-                    fp.close()
-                    basename = os.path.basename(img_filename)
-                    mime_img.add_header('Content-Disposition', 'attachment',
-                                        filename=basename)
-                    mime_img.add_header('Content-ID', '<' + basename + '>')
-                    msg.attach(mime_img)
-    
-        # Send email to SMTP server. Retry if server disconnects.
+        # Send email. Retry if server disconnects.
         retries = 5
         while retries > 0:
             retries -= 1
             try:
-                log.debug("SMPT_SSL {}".format(self.SMTP_SERVER))
-                s = smtplib.SMTP_SSL()
-                s.connect(self.SMTP_SERVER)
-                log.debug("logging in as {}".format(self.USERNAME))
-                s.login(self.USERNAME, self.PASSWORD)
-                log.debug("sendmail to {}".format(self.EMAIL_TO))
-                s.sendmail(me, self.EMAIL_TO, msg.as_string())
-                log.debug("quit")
-                s.quit()
+                transport.send(self._email_from(), self.EMAIL_TO, msg)
             except (smtplib.SMTPServerDisconnected,
                     smtplib.SMTPConnectError,
                     socket.error): # usually socket.errno.ETIMEDOUT or .ECONNREFUSED
                 log.exception("Exception caught while trying to send email."
-                              " Retries left={}".format(retries))
+                              " Retries left=%d", retries)
                 time.sleep(2)
             except smtplib.SMTPAuthenticationError:
                 log.exception("SMTP authentication error. Please check "
@@ -843,22 +4463,33 @@ class Manager(object):
             msg += "</p>\n"
         msg += "<ul>\n"
         for checker in self.checkers:
-            msg += '  <li>{}</li>\n'.format(checker.html())
+            if checker in self.skipped:
+                msg += '  <li>{}</li>\n'.format(
+                    checker.skipped_html(self.skipped[checker]))
+            else:
+                msg += checker.rows_html()
         msg += "</ul>\n"
         return msg
     
     def shutdown(self):
-        if self.__dict__.get("SMTP_SERVER"):
+        if self.__dict__.get("SMTP_SERVER") or self.__dict__.get("transport"):
             log.info("Sending shutdown email...")
             html = "<p>Babysitter SHUTTING DOWN.</p>\n"
             if self.shutdown_reason:
-                log.info("Shutdown reason: {}".format(self.shutdown_reason))
+                log.info("Shutdown reason: %s", self.shutdown_reason)
                 html += "<p>Reason for shutdown: "
                 html += self.shutdown_reason + "</p>\n"
             html += self.html()
             html += run_commands(self.state_change_cmds)
             html += run_commands(self.shutdown_cmds)
             self.send_email_with_time(html=html, subject="babysitter.py shutting down")
+        if self.__dict__.get("_report_pool") is not None:
+            self._terminate_report_pool()
+        if self.__dict__.get("_control_sock") is not None:
+            self.close_control_socket()
+        if self.__dict__.get("watchdog") is not None:
+            sd_notify("STOPPING=1")
+            self.watchdog.stop()
         log.info("Shutting down!\n")
         logging.shutdown() 
                   
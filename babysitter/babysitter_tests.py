@@ -1,8 +1,24 @@
-from __future__ import print_function
+from __future__ import print_function, division
 import babysitter
 import unittest
 import StringIO
 import datetime
+import time
+import signal
+import tempfile
+import shutil
+import os
+import email
+import json
+import urllib2
+import threading
+import socket
+import array
+import subprocess
+import BaseHTTPServer
+import SocketServer
+import local_smtpd
+import ctl
 
 class TestLoadConfig(unittest.TestCase):
 
@@ -53,7 +69,7 @@ class TestLoadConfig(unittest.TestCase):
         self.assertEqual(self.manager.heartbeat.hour, 8)
         self.assertEqual(self.manager.heartbeat.cmd, "ls")
         self.assertEqual(self.manager.heartbeat.html_file, "index.html")
-        self.assertEqual(self.manager.heartbeat.last_checked, datetime.datetime.now().hour)
+        self.assertEqual(len(self.manager.heartbeat.schedules), 1)
         
         self._run_heartbeat_tests()
         
@@ -65,8 +81,9 @@ class TestLoadConfig(unittest.TestCase):
     
     def _run_heartbeat_tests(self):
         # test need_to_send by mocking up times
-        self.manager.heartbeat.hour = datetime.datetime.now().hour
-        self.manager.heartbeat.last_checked = datetime.datetime.now().hour-1
+        now = datetime.datetime.utcnow()
+        self.manager.heartbeat.hour = now.hour
+        self.manager.heartbeat.schedules[0].mark_run(now - datetime.timedelta(hours=1))
         self.assertTrue( self.manager._need_to_send_heartbeat() )
         self.assertFalse( self.manager._need_to_send_heartbeat() )
         
@@ -76,5 +93,1413 @@ class TestLoadConfig(unittest.TestCase):
     def test_none(self):
         self.assertFalse( self.manager._need_to_send_heartbeat() )        
 
+class TestProcessSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = babysitter.Manager()
+        self.process = babysitter.Process(name="no_such_babysitter_process",
+                                          restart_command="false")
+        self.process.MAX_RESTART_RETRIES = 2
+        self.manager.append(self.process)
+
+    def _wait_for_reap(self):
+        for _ in range(100):
+            if not any(p.poll() is None for p, _ in self.process._popens):
+                return
+            time.sleep(0.01)
+
+    def test_backoff(self):
+        self.assertIn("Attempting to restart", self.process.supervise())
+        self.assertTrue(self.process.restart_pending)
+        self.assertGreater(self.process.next_restart_time, time.time())
+        self._wait_for_reap()
+        self.assertIn("Failed to restart", self.process.supervise())
+        self.assertEqual(self.process._popens, [])
+        # Backing off, so don't restart yet
+        self.assertEqual(self.process.supervise(), "")
+        
+    def test_give_up(self):
+        for _ in range(self.process.MAX_RESTART_RETRIES):
+            self.process.next_restart_time = 0
+            self.process.supervise()
+            self._wait_for_reap()
+            self.process.supervise()
+        self.process.next_restart_time = 0
+        self.assertIn("Giving up", self.process.supervise())
+        self.assertTrue(self.process.given_up)
+        self.assertEqual(self.process.supervise(), "")
+        self.manager._tick() # must not raise
+
+class TestOwnedChild(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = babysitter.Manager()
+        self.process = babysitter.Process(name="no_such_babysitter_process",
+                                          restart_command="sleep 0.3",
+                                          owns_child=True)
+        self.manager.append(self.process)
+        self.manager._watch_children()
+
+    def tearDown(self):
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    def test_crash_detected_immediately(self):
+        self.process.start()
+        self.assertEqual(self.process.state(), babysitter.OK)
+        t0 = time.time()
+        self.manager._wait(10)
+        self.assertLess(time.time() - t0, 5)
+        self.assertEqual(self.process.state(), babysitter.FAIL)
+        self.assertIn("Attempting to restart", self.process.supervise())
+        self.assertEqual(self.process.state(), babysitter.OK)
+
+    def test_restart_command_while_running(self):
+        self.process.restart_command = "sleep 30"
+        self.process.start()
+        first = self.process.child
+        response = self.manager.handle_command("restart " + self.process.name)
+        self.assertTrue(response['ok'])
+        self.assertIsNotNone(first.returncode) # stopped and reaped
+        self.assertIsNot(self.process.child, first)
+        self.assertEqual(self.process.state(), babysitter.OK)
+        self.process.stop_child()
+        self.assertIsNotNone(self.process.child.returncode)
+
+    def test_restart_command_not_owned(self):
+        external = subprocess.Popen(["sleep", "30"])
+        try:
+            process = babysitter.Process(name="sleep", restart_command="sleep 30")
+            self.manager.append(process)
+            response = self.manager.handle_command("restart sleep")
+            self.assertFalse(response['ok'])
+            self.assertIn("stop it first", response['message'])
+            self.assertEqual(process._popens, [])
+        finally:
+            external.kill()
+            external.wait()
+
+class TestProcessResources(unittest.TestCase):
+
+    def setUp(self):
+        self.process = babysitter.Process(name="no_such_babysitter_process",
+                                          max_rss_mb=1E6, max_fds=1E6)
+        # Monitor ourselves
+        self.process._pids = [os.getpid()]
+        self.process.running = lambda: True
+
+    def test_sample(self):
+        self.assertEqual(self.process.state(), babysitter.OK)
+        resources = self.process.resources
+        self.assertGreater(resources['rss_mb'], 1)
+        self.assertGreater(resources['fds'], 0)
+        self.assertGreaterEqual(resources['threads'], 1)
+        self.assertIsNone(resources['cpu_percent'])
+        self.process._prev_sample_time -= 1
+        self.process.sample_resources()
+        self.assertGreaterEqual(self.process.resources['cpu_percent'], 0)
+        self.assertIn("rss=", self.process.extra_text())
+
+    def test_limit_exceeded(self):
+        self.process.max_fds = 0
+        self.assertEqual(self.process.state(), babysitter.FAIL)
+        self.assertIn("Exceeded: fds=", self.process.extra_text())
+
+class TestChannelData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "channel_1.dat")
+        # Created by the logger after we start, so it's read from the start
+        self.checker = babysitter.ChannelData(self.filename, "fridge",
+                                              max_gap=60, max_repeats=3)
+        self._append("1000 10\n1006 20\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _append(self, text):
+        with open(self.filename, 'a') as fh:
+            fh.write(text)
+
+    def test_incremental(self):
+        self.assertEqual(self.checker.state(), babysitter.OK)
+        self.assertEqual(self.checker.stats['samples'], 2)
+        self._append("1012 30\n1018 4") # partial last line
+        self.assertEqual(self.checker.state(), babysitter.OK)
+        self.assertEqual(self.checker.stats['samples'], 3)
+        self._append("0\n")
+        self.checker.state()
+        self.assertEqual(self.checker.stats['samples'], 4)
+        self.assertEqual(self.checker._last_value, 40)
+
+    def test_problems(self):
+        self._append("1001 30\n")
+        self.assertEqual(self.checker.state(), babysitter.FAIL)
+        self.assertEqual(self.checker.stats['non_monotonic'], 1)
+        self._append("1200 -5\ngarbage\n")
+        self.assertEqual(self.checker.state(), babysitter.FAIL)
+        self.assertEqual(self.checker.stats['gaps'], 1)
+        self.assertEqual(self.checker.stats['out_of_range'], 1)
+        self.assertEqual(self.checker.stats['malformed'], 1)
+        self._append("1206 5\n")
+        self.assertEqual(self.checker.state(), babysitter.OK)
+
+    def test_parse_misaligned_fields(self):
+        parse = babysitter.parse_channel_data
+        timestamps, values, malformed = parse('1000 10\n1006 20\n')
+        self.assertEqual((list(timestamps), list(values), malformed), 
+                         ([1000, 1006], [10, 20], 0))
+        # A line broken across two lines mustn't be "repaired"
+        timestamps, values, malformed = parse('1000 10 1006\n20\n1012 30\n')
+        self.assertEqual((list(timestamps), list(values), malformed), 
+                         ([1012], [30], 2))
+        timestamps, values, malformed = parse('1000 10\n\n1006 20 99 1012\n')
+        self.assertEqual((list(timestamps), list(values), malformed), 
+                         ([1000], [10], 2))
+        self._append("1012 30 1018\n40\n") # only malformed lines
+        self.assertEqual(self.checker.state(), babysitter.FAIL)
+        self.assertEqual(self.checker.stats['malformed'], 2)
+        self.assertEqual(self.checker.stats['samples'], 2)
+
+    def test_frozen_values(self):
+        self._append("".join("{} 20\n".format(1012 + 6 * i) for i in range(4)))
+        self.assertEqual(self.checker.state(), babysitter.FAIL)
+        self.assertIn("repeated 4 times", self.checker.extra_text())
+
+    def test_running_stats(self):
+        self._append("1100 10\n1106 10\n")
+        self.checker.state()
+        self.assertEqual(self.checker.longest_gap, 94)
+        self.assertAlmostEqual(self.checker.uptime_percent(), 100 * 12 / 106)
+        self.assertAlmostEqual(self.checker.sample_rate(), 3 / 106)
+        html = babysitter.channel_stats_html([self.checker])
+        self.assertIn("<td>channel_1.dat</td><td>fridge</td><td>4</td>", html)
+
+    def test_existing_file(self):
+        # Only the last complete line of a file which already exists is read
+        self._append("".join("{:d} 10\n".format(1012 + 6 * i) 
+                             for i in range(100000)) + "1000 ")
+        checker = babysitter.ChannelData(self.filename, max_gap=60)
+        self.assertEqual(checker.stats['samples'], 1)
+        self.assertEqual(checker._last_timestamp, 1012 + 6 * 99999)
+        self._append("5\n")
+        self.assertEqual(checker.state(), babysitter.FAIL)
+        self.assertEqual(checker.stats['non_monotonic'], 1)
+
+        babysitter.TailReader.LAST_LINE_BLOCK_SIZE = 4
+        try:
+            self.assertEqual(babysitter.ChannelData(self.filename)._last_value, 
+                             5)
+        finally:
+            babysitter.TailReader.LAST_LINE_BLOCK_SIZE = 4096
+
+    def test_truncated(self):
+        self.checker.state()
+        with open(self.filename, 'w') as fh:
+            fh.write("2000 1\n")
+        self.checker.state()
+        self.assertEqual(self.checker.stats['samples'], 3)
+
+class TestLogPattern(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "logger.log")
+        self._write("old CRC error before we started\n")
+        self.checker = babysitter.LogPattern(self.filename, [
+            {"name": "CRC", "regex": "CRC error", "max_count": 2, "window": 60},
+            "(?i)timeout"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, text, mode='a'):
+        with open(self.filename, mode) as fh:
+            fh.write(text)
+
+    def test_counts(self):
+        self.assertEqual(self.checker.state(), babysitter.OK)
+        self.assertEqual(self.checker.totals, [0, 0])
+        self._write("CRC error\nTIMEOUT\nok\nCRC error; Timeout\nCRC err")
+        self.assertEqual(self.checker.state(), babysitter.OK)
+        self.assertEqual(self.checker.totals, [2, 2])
+        self._write("or\n") # completes the partial line
+        self.assertEqual(self.checker.state(), babysitter.FAIL)
+        self.assertEqual(self.checker.window_count(0), 3)
+        self.assertAlmostEqual(self.checker.rate(0), 3)
+        self.assertIn("'CRC' 3 times in last 60s (max 2)", 
+                      self.checker.extra_text())
+
+        # The window slides past the errors
+        self.checker.update(time.time() + 61)
+        self.assertEqual(self.checker.window_count(0), 0)
+        self.assertEqual(self.checker.totals, [3, 2])
+
+    def test_rotation(self):
+        self.checker.state()
+        os.rename(self.filename, self.filename + ".1")
+        self._write("CRC error\nCRC error\nCRC error\n", 'w')
+        self.assertEqual(self.checker.state(), babysitter.FAIL)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, babysitter.LogPattern, self.filename, [])
+        self.assertRaises(ValueError, babysitter.LogPattern, self.filename, ["("])
+        self.assertRaises(ValueError, babysitter.LogPattern, self.filename,
+                          [{"regex": "x", "limit": 3}])
+
+class TestDataDir(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = babysitter.Manager()
+        self.manager.append(babysitter.DiskSpaceRemaining(threshold=1))
+        self.tmp_dir = tempfile.mkdtemp()
+        for subdir in ["2", "9"]:
+            self._make_data_dir(subdir, ["1 mains", "2 fridge"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_data_dir(self, subdir, labels):
+        os.mkdir(os.path.join(self.tmp_dir, subdir))
+        with open(os.path.join(self.tmp_dir, subdir, "labels.dat"), 'w') as fh:
+            fh.write("\n".join(labels) + "\n")
+
+    def _touch_channels(self, subdir, chans):
+        for chan in chans:
+            filename = os.path.join(self.tmp_dir, subdir,
+                                    "channel_{:d}.dat".format(chan))
+            with open(filename, 'w') as fh:
+                fh.write("1000 10\n")
+
+    def test_load_powerdata_ready(self):
+        self._touch_channels("9", [1, 2])
+        t0 = time.time()
+        data_dir = self.manager.load_powerdata(self.tmp_dir, True, 100)
+        self.assertLess(time.time() - t0, 1)
+        self.assertEqual(data_dir, os.path.join(os.path.realpath(self.tmp_dir), "9"))
+        self.assertEqual(len(self.manager.powerdata_checkers), 2)
+
+    def test_load_powerdata_max_wait(self):
+        self._touch_channels("9", [1])
+        t0 = time.time()
+        self.manager.load_powerdata(self.tmp_dir, True, 100, max_wait=0.6)
+        self.assertGreater(time.time() - t0, 0.6)
+        self.assertEqual(len(self.manager.powerdata_checkers), 2)
+
+    def test_numeric_order(self):
+        self.manager.base_data_dir = self.tmp_dir
+        self.assertEqual(self.manager._find_last_numeric_subdir(), "9")
+        os.mkdir(os.path.join(self.tmp_dir, "10"))
+        os.mkdir(os.path.join(self.tmp_dir, "abc"))
+        self.assertEqual(self.manager._find_last_numeric_subdir(), "10")
+
+    def test_switch_in_place(self):
+        self.manager.base_data_dir = self.tmp_dir
+        self.manager.sub_data_dir = "9"
+        self.manager._powerdata_options = {'timeout': 100, 'validate': True}
+        new_dirs = []
+        self.manager.new_data_dir_callbacks.append(new_dirs.append)
+        disk = self.manager.checkers[0]
+        self.manager.switch_data_dir("9")
+        self.assertEqual(len(self.manager.checkers), 5)
+
+        # New subdir without labels.dat isn't switched to yet
+        os.mkdir(os.path.join(self.tmp_dir, "10"))
+        self.manager._tick()
+        self.assertEqual(self.manager.sub_data_dir, "9")
+
+        with open(os.path.join(self.tmp_dir, "10", "labels.dat"), 'w') as fh:
+            fh.write("1 mains\n")
+        self._touch_channels("10", [1])
+        self.manager._tick()
+        self.assertEqual(self.manager.sub_data_dir, "10")
+        self.assertEqual(new_dirs, [os.path.join(self.tmp_dir, "9"),
+                                    os.path.join(self.tmp_dir, "10")])
+        self.assertIs(self.manager.checkers[0], disk)
+        self.assertEqual(len(self.manager.checkers), 3)
+        self.assertTrue(self.manager.checkers[1].name.endswith("10/channel_1.dat"))
+
+    def test_switch_waits_for_channels(self):
+        self.manager.transport = babysitter.MemoryTransport()
+        self.manager.base_data_dir = self.tmp_dir
+        self.manager.sub_data_dir = "9"
+        self.manager._powerdata_options = {'timeout': 100, 'validate': True,
+                                           'max_wait': 60}
+        self._touch_channels("9", [1, 2])
+        self.manager.switch_data_dir("9")
+        self._make_data_dir("10", ["1 mains", "2 fridge"])
+        try:
+            # labels.dat is written before the logger creates channel files
+            self.manager._tick()
+            self.assertEqual(self.manager.sub_data_dir, "9")
+            self._touch_channels("10", [1])
+            self.manager._tick()
+            self.assertEqual(self.manager.sub_data_dir, "9")
+            self._touch_channels("10", [2])
+            self.manager._tick()
+            self.assertEqual(self.manager.sub_data_dir, "10")
+            self.manager._pending_report.wait(10)
+            self.manager._tick()
+        finally:
+            self.manager._terminate_report_pool()
+        subjects = [email.message_from_string(msg)['Subject'] 
+                    for _, _, msg in self.manager.transport.messages]
+        self.assertEqual(subjects, ["Babysitter heartbeat"])
+
+    def test_switch_max_wait(self):
+        self.manager.base_data_dir = self.tmp_dir
+        self.manager.sub_data_dir = "9"
+        self.manager._powerdata_options = {'timeout': 100, 'validate': False,
+                                           'max_wait': 0.2}
+        self._make_data_dir("10", ["1 mains"])
+        self.assertFalse(self.manager._new_data_dir_ready("10"))
+        time.sleep(0.3)
+        self.assertTrue(self.manager._new_data_dir_ready("10"))
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = babysitter.Manager()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "config.json")
+        self.config = {
+            "email": {"transport": "memory", "to": ["me@localhost"]},
+            "checkers": [
+                {"type": "DiskSpaceRemaining", "threshold": 1, "path": "/"},
+                {"type": "File", "name": "/tmp", "timeout": 1000000}],
+            "heartbeat": {"hour": 6, "cmds": [["ls", True]]}}
+        self._write()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+
+    def _write(self):
+        with open(self.filename, 'w') as fh:
+            json.dump(self.config, fh)
+
+    def test_load(self):
+        self.manager.load_config(self.filename)
+        self.assertEqual(len(self.manager.checkers), 2)
+        self.assertIsInstance(self.manager.transport, babysitter.MemoryTransport)
+        self.assertEqual(self.manager.heartbeat.cmds, [("ls", True)])
+
+    def test_invalid(self):
+        for bad in [{"checkers": [{"type": "Nonsense"}]},
+                    {"checkers": [{"type": "File", "nme": "/tmp"}]},
+                    {"checkers": [{"type": "DiskSpaceRemaining"}]},
+                    {"email": {"transport": "pigeon"}},
+                    {"heartbeat": {"cmds": ["ls"]}},
+                    {"heartbeat": {"hour": 25}},
+                    {"heartbeat": {"html": "/path/to/index.html"}},
+                    {"colour": "blue"}]:
+            self.config = bad
+            self._write()
+            self.assertRaises(babysitter.ConfigError, babysitter.load_config,
+                              self.filename)
+
+    def test_sighup_reload(self):
+        self.manager.load_config(self.filename)
+        disk, f = self.manager.checkers
+        transport = self.manager.transport
+        self.config["checkers"][1]["timeout"] = 10
+        self.config["checkers"].append({"type": "FileGrows", "name": "/tmp"})
+        self._write()
+        os.kill(os.getpid(), signal.SIGHUP)
+        self.assertTrue(self.manager._reload_requested)
+        self.manager._tick()
+        self.assertEqual(len(self.manager.checkers), 3)
+        self.assertIs(self.manager.checkers[0], disk)
+        self.assertNotIn(f, self.manager.checkers)
+        self.assertEqual(self.manager.checkers[1].timeout, 10)
+        self.assertIs(self.manager.transport, transport)
+
+        # An invalid config is ignored
+        with open(self.filename, 'w') as fh:
+            fh.write("{")
+        self.manager.reload_config()
+        self.assertEqual(len(self.manager.checkers), 3)
+
+    def test_reload_relinks_dependencies(self):
+        # A checker added from code follows its parent when a reload
+        # replaces the parent
+        self.manager.load_config(self.filename)
+        child = babysitter.FileGrows("/tmp")
+        child.depends_on = [self.manager.checkers[1]]
+        self.manager.append(child)
+        self.config["checkers"][1]["timeout"] = 10
+        self._write()
+        self.manager.reload_config()
+        parent = self.manager._find_checker("/tmp", babysitter.File)
+        self.assertEqual(parent.timeout, 10)
+        self.assertEqual(child.depends_on, [parent])
+
+    def test_reload_failure(self):
+        # Valid configs which fail to apply leave the old config in place
+        self.manager.load_config(self.filename)
+        checkers = list(self.manager.checkers)
+        schedules = list(self.manager.heartbeat.schedules)
+        missing = os.path.join(self.tmp_dir, "missing")
+        for checker in [{"type": "FileGlob", "pattern": "/tmp/*", "mode": "bogus"},
+                        {"type": "DiskSpaceRemaining", "threshold": 1, 
+                         "path": missing}]:
+            self.config["checkers"] = [checker]
+            self.config["heartbeat"] = {"hour": 7}
+            self.config["control_socket"] = os.path.join(self.tmp_dir, "sock")
+            self._write()
+            self.manager.reload_config()
+            self.assertEqual(self.manager.checkers, checkers)
+            self.assertEqual(self.manager.heartbeat.schedules, schedules)
+            self.assertEqual(self.manager.heartbeat.hour, 6)
+            self.assertIsNone(self.manager._control_sock)
+            self.assertFalse(os.path.exists(self.config["control_socket"]))
+
+class TestFileGlob(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        now = time.time()
+        for i, age in enumerate([1000, 500, 5]):
+            self._make_file("mains-{:d}.dat".format(i), now - age)
+        self._make_file("other.txt", now)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_file(self, name, mtime):
+        filename = os.path.join(self.tmp_dir, name)
+        open(filename, 'w').close()
+        os.utime(filename, (mtime, mtime))
+
+    def test_newest(self):
+        checker = babysitter.FileGlob(os.path.join(self.tmp_dir, "mains-*.dat"),
+                                      timeout=60)
+        self.assertEqual(checker.state(), babysitter.OK)
+        self.assertEqual(len(checker.index), 3)
+        self.assertIn("newest mains-2.dat", checker.extra_text())
+
+        # Rotation
+        self._make_file("mains-3.dat", time.time())
+        self.assertEqual(checker.state(), babysitter.OK)
+        self.assertIn("newest mains-3.dat", checker.extra_text())
+
+        # Stale
+        self._make_file("mains-3.dat", time.time() - 100)
+        self._make_file("mains-2.dat", time.time() - 100)
+        self.assertEqual(checker.state(), babysitter.FAIL)
+
+    def test_all(self):
+        checker = babysitter.FileGlob(os.path.join(self.tmp_dir, "mains-*.dat"),
+                                      timeout=600, mode='all')
+        self.assertEqual(checker.state(), babysitter.FAIL)
+        self.assertIn("oldest mains-0.dat", checker.extra_text())
+        os.remove(os.path.join(self.tmp_dir, "mains-0.dat"))
+        self.assertEqual(checker.state(), babysitter.OK)
+
+    def test_no_matches(self):
+        checker = babysitter.FileGlob(os.path.join(self.tmp_dir, "*.none"))
+        self.assertEqual(checker.state(), babysitter.FAIL)
+        self.assertIn("no matching files", checker.extra_text())
+
+class TestFileSet(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filenames = []
+        for i in range(3):
+            self.filenames.append(os.path.join(self.tmp_dir, "chan{:d}.dat".format(i)))
+            open(self.filenames[-1], 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_changed_rows(self):
+        fileset = babysitter.FileSet(timeout=60, files=self.filenames[:2] + 
+                                     [[self.filenames[2], 10, "fridge"]])
+        manager = babysitter.Manager()
+        manager.append(fileset)
+        self.assertEqual(fileset.state(), babysitter.OK)
+        self.assertEqual(fileset.update(), [])
+        
+        old = time.time() - 30
+        os.utime(self.filenames[2], (old, old))
+        self.assertEqual(fileset.update(), [2])
+        self.assertEqual(fileset.state(), babysitter.FAIL)
+        self.assertEqual(fileset.update(), [])
+
+        os.utime(self.filenames[2], None)
+        html = fileset.changed_html()
+        self.assertEqual(html.count("<li>"), 1)
+        self.assertIn("chan2.dat", html)
+        self.assertIn("Was dead for", html)
+        self.assertEqual(manager.html().count("<li>"), 3)
+
+    def test_state_updates(self):
+        fileset = babysitter.FileSet(timeout=10, files=self.filenames)
+        self.assertEqual(fileset.state(), babysitter.OK)
+        old = time.time() - 30
+        os.utime(self.filenames[1], (old, old))
+        self.assertEqual(fileset.state(), babysitter.FAIL)
+        # The change found by state() is still reported once
+        html = fileset.changed_html()
+        self.assertEqual(html.count("<li>"), 1)
+        self.assertIn("chan1.dat", html)
+        self.assertEqual(fileset.changed_html(), "")
+
+    def test_update_speed(self):
+        names = [os.path.join(self.tmp_dir, "file{:d}.dat".format(i)) 
+                 for i in range(10000)]
+        fileset = babysitter.FileSet(files=names)
+        mtimes = dict.fromkeys(names, time.time())
+        mtimes[names[5]] = 0 # a dead channel
+        fileset._mtime = mtimes.__getitem__ # exclude stat cost
+        self.assertEqual(len(fileset.update()), 9999)
+        durations = []
+        stat_durations = [] # the cost of collecting mtimes alone
+        for _ in range(5):
+            t0 = time.time()
+            self.assertEqual(fileset.update(), [])
+            t1 = time.time()
+            array.array('d', map(fileset._mtime, names))
+            durations.append(t1 - t0)
+            stat_durations.append(time.time() - t1)
+        self.assertEqual(fileset.n_failing, 1)
+        self.assertLess(min(durations) - min(stat_durations), 0.0005)
+
+class TestAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = babysitter.Aggregator('127.0.0.1')
+        self.aggregator.start()
+        self.url = "http://127.0.0.1:{:d}/snapshot".format(self.aggregator.port)
+        self.central = babysitter.Manager()
+        self.central.aggregator = self.aggregator
+        self.central.transport = babysitter.MemoryTransport()
+        self.remote = babysitter.Manager()
+        self.remote.publish_urls = [self.url]
+        self.remote.append(babysitter.DiskSpaceRemaining(threshold=1))
+
+    def tearDown(self):
+        self.aggregator.stop()
+
+    def test_publish(self):
+        self.remote._tick()
+        self.central._tick()
+        self.assertEqual(len(self.central.checkers), 1)
+        host = self.central.checkers[0]
+        self.assertIsInstance(host, babysitter.RemoteHost)
+        self.assertEqual(host.state(), babysitter.OK)
+        self.assertIn("1 checkers", host.extra_text())
+
+        # Remote checker fails
+        self.remote.checkers[0].threshold = 1E12
+        self.remote._tick()
+        self.assertEqual(host.state(), babysitter.FAIL)
+        self.assertIn("FAILING: disk space", host.extra_text())
+        self.central._tick()
+        self.assertEqual(len(self.central.transport.messages), 1)
+
+    def test_deduplicate(self):
+        snapshot = self.remote.snapshot()
+        self.assertTrue(self.aggregator.receive(dict(snapshot)))
+        self.assertFalse(self.aggregator.receive(dict(snapshot)))
+        old = dict(snapshot, seq=snapshot['seq'] - 1)
+        self.assertFalse(self.aggregator.receive(old))
+        restarted = dict(snapshot, started=snapshot['started'] + 1, seq=1)
+        self.assertTrue(self.aggregator.receive(restarted))
+
+    def test_stale(self):
+        self.remote._tick()
+        self.central._tick()
+        self.central.checkers[0].stale_after = -1
+        self.assertEqual(self.central.checkers[0].state(), babysitter.FAIL)
+
+    def test_malformed(self):
+        good = {"host": "x", "started": 0, "seq": 1, 
+                "checkers": [{"name": "x", "state": 1, "text": ""}]}
+        for bad in [dict(good, checkers=[{"name": "x"}]),
+                    dict(good, checkers=["x"]),
+                    dict(good, checkers={"name": "x"}),
+                    dict(good, seq="1"),
+                    [good]]:
+            request = urllib2.Request(self.url, json.dumps(bad),
+                                      {'Content-Type': 'application/json'})
+            with self.assertRaises(urllib2.HTTPError) as cm:
+                urllib2.urlopen(request)
+            self.assertEqual(cm.exception.code, 400)
+        self.assertEqual(self.aggregator.hosts(), [])
+
+        # RemoteHost tolerates bad entries which bypassed validation
+        self.aggregator._snapshots["x"] = dict(good, received=time.time(), 
+                                               checkers=[{"name": "x"}, "y"])
+        self.central._tick()
+        host = self.central.checkers[0]
+        self.assertEqual(host.state(), babysitter.FAIL)
+        self.assertIn("FAILING: x", host.extra_text())
+
+    def test_token(self):
+        self.assertRaises(ValueError, babysitter.Aggregator, '')
+        aggregator = babysitter.Aggregator('', token="secret")
+        aggregator.start()
+        try:
+            url = "http://127.0.0.1:{:d}/snapshot".format(aggregator.port)
+            self.remote.publish_urls = [url]
+            self.remote._tick() # rejected
+            self.assertEqual(aggregator.hosts(), [])
+            with self.assertRaises(urllib2.HTTPError) as cm:
+                urllib2.urlopen(url + "s")
+            self.assertEqual(cm.exception.code, 401)
+
+            self.remote.publish_token = "secret"
+            self.remote._tick()
+            self.assertEqual(aggregator.hosts(), [os.uname()[1]])
+            request = urllib2.Request(url + "s", 
+                                      headers={'Authorization': "Bearer secret"})
+            self.assertEqual(len(json.loads(urllib2.urlopen(request).read())), 1)
+        finally:
+            aggregator.stop()
+
+    def test_pull(self):
+        self.remote._tick()
+        url = "http://127.0.0.1:{:d}/snapshots".format(self.aggregator.port)
+        snapshots = json.loads(urllib2.urlopen(url).read())
+        self.assertEqual(len(snapshots), 1)
+
+class _HealthHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        body = "healthy" if self.path == '/health' else "missing"
+        self.send_response(200 if self.path == '/health' else 404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class _ShortKeepAliveHandler(_HealthHandler):
+    timeout = 0.2 # like a short KeepAliveTimeout
+
+class TestNetworkProbes(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0),
+                                                      _HealthHandler)
+        self.server.daemon_threads = True
+        self.server.connections = set()
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.base_url = "http://127.0.0.1:{:d}".format(self.port)
+        self.manager = babysitter.Manager()
+        self.probes = [] # not in self.manager
+
+    def tearDown(self):
+        for probe in self.probes + self.manager.checkers:
+            probe.close() # so no handler thread is left waiting
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_tcp(self):
+        probe = babysitter.TCPProbe('127.0.0.1', self.port)
+        self.assertEqual(probe.state(), babysitter.OK)
+        self.server.shutdown()
+        self.server.server_close()
+        probe.probe()
+        self.assertEqual(probe.state(), babysitter.FAIL)
+        self.assertIn("refused", probe.extra_text())
+
+    def test_http_keep_alive(self):
+        probe = babysitter.HTTPProbe(self.base_url + "/health",
+                                     expected_body="healthy")
+        self.manager.append(probe)
+        for _ in range(3):
+            self.manager._tick()
+        self.assertEqual(probe.state(), babysitter.OK)
+        self.assertEqual(len(probe.latencies), 4)
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertIn("p95=", probe.extra_text())
+
+    def test_http_server_closes_idle(self):
+        # The server closes kept-alive connections after 0.2s idle
+        self.server.RequestHandlerClass = _ShortKeepAliveHandler
+        probe = babysitter.HTTPProbe(self.base_url + "/health")
+        self.probes.append(probe)
+        for _ in range(3):
+            probe.probe()
+            self.assertEqual(probe.state(), babysitter.OK)
+            time.sleep(0.4)
+        self.assertEqual(len(self.server.connections), 3)
+
+    def test_http_unexpected(self):
+        probes = [babysitter.HTTPProbe(self.base_url + "/nope"),
+                  babysitter.HTTPProbe(self.base_url + "/health",
+                                       expected_body="sick")]
+        for probe in probes:
+            self.manager.append(probe)
+        self.manager._run_probes()
+        self.assertEqual([probe.state() for probe in probes], 
+                         [babysitter.FAIL, babysitter.FAIL])
+        self.assertIn("HTTP status 404", probes[0].extra_text())
+        self.assertIn("sick", probes[1].extra_text())
+
+class TestSchedules(unittest.TestCase):
+
+    def test_cron(self):
+        t = datetime.datetime(2014, 3, 14, 12, 30) # a Friday
+        schedule = babysitter.CronSchedule("0 6 * * *")
+        self.assertEqual(schedule.next_after(t), datetime.datetime(2014, 3, 15, 6, 0))
+        schedule = babysitter.CronSchedule("*/15 9-17 * * 1-5")
+        self.assertEqual(schedule.next_after(t), datetime.datetime(2014, 3, 14, 12, 45))
+        self.assertEqual(schedule.next_after(datetime.datetime(2014, 3, 14, 17, 50)),
+                         datetime.datetime(2014, 3, 17, 9, 0))
+        schedule = babysitter.CronSchedule("0 0 1 * 0") # 1st of month OR Sunday
+        self.assertEqual(schedule.next_after(t), datetime.datetime(2014, 3, 16, 0, 0))
+        self.assertRaises(ValueError, babysitter.CronSchedule, "61 * * * *")
+        self.assertRaises(ValueError, babysitter.CronSchedule, "* * *")
+
+    def test_catch_up(self):
+        manager = babysitter.Manager()
+        schedule = babysitter.IntervalSchedule(60)
+        manager.heartbeat.schedules.append(schedule)
+        self.assertEqual(manager._need_to_send_heartbeat(), [])
+        # Main loop was blocked for several intervals
+        schedule.mark_run(datetime.datetime.utcnow() - datetime.timedelta(minutes=5))
+        self.assertEqual(manager._need_to_send_heartbeat(), [schedule])
+        self.assertEqual(manager._need_to_send_heartbeat(), [])
+        self.assertAlmostEqual(manager._time_until_heartbeat(), 60, delta=1)
+
+    def test_summary(self):
+        manager = babysitter.Manager()
+        manager.transport = babysitter.MemoryTransport()
+        manager.heartbeat.cmds = [("no_such_command", True)]
+        manager.heartbeat.schedules.append(babysitter.IntervalSchedule(0))
+        manager._tick()
+        data = manager.transport.messages[0][2]
+        self.assertIn("heartbeat summary", data)
+        self.assertNotIn("no_such_command", data)
+
+class TestHeartbeatReport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        local_smtpd.make_fake_images(self.tmp_dir, 1, 100)
+        self.html_file = os.path.join(self.tmp_dir, "index.html")
+        with open(self.html_file, 'w') as fh:
+            fh.write('<html><body><img src="graph0.png"/></body></html>')
+        self.manager = babysitter.Manager()
+        self.manager.transport = babysitter.MemoryTransport()
+        self.manager.heartbeat.html_file = self.html_file
+
+    def tearDown(self):
+        self.manager._terminate_report_pool()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_prepared_ahead(self):
+        self.manager.heartbeat.cmds = [("echo prepared-ahead", True)]
+        schedule = babysitter.IntervalSchedule(60, full_report=True)
+        self.manager.heartbeat.schedules.append(schedule)
+        self.manager._tick()
+        self.assertEqual(self.manager.transport.messages, [])
+        self.manager._pending_report.wait(10)
+        self.manager._tick()
+        self.assertTrue(self.manager._report_fresh)
+
+        schedule.mark_run(datetime.datetime.utcnow() - datetime.timedelta(minutes=1))
+        t0 = time.time()
+        self.manager._tick()
+        self.assertLess(time.time() - t0, 1)
+        data = self.manager.transport.messages[0][2]
+        self.assertIn("prepared-ahead", data)
+        self.assertIn("Content-ID: <graph0.png>", data)
+
+    def test_worker_logging(self):
+        # The worker can't use the Manager's handlers (here a QueueHandler
+        # whose listener thread only exists in this process)
+        logger = babysitter.logging.getLogger("babysitter")
+        stream = StringIO.StringIO()
+        queue = babysitter.Queue.Queue(100)
+        listener = babysitter.QueueListener(
+                       queue, babysitter.logging.StreamHandler(stream))
+        handler = babysitter.QueueHandler(queue, listener)
+        old_level = logger.level
+        logger.setLevel(babysitter.logging.DEBUG)
+        logger.addHandler(handler)
+        listener.start()
+        try:
+            self.manager.heartbeat.cmds = [("no_such_command", True)]
+            self.manager.heartbeat.html_file = "/no/such/index.html"
+            self.manager._prepare_report()
+            self.manager._pending_report.wait(10)
+            self.manager._poll_report()
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(old_level)
+            handler.close()
+        self.assertTrue(self.manager._report_fresh)
+        logged = stream.getvalue()
+        self.assertIn("Attempting to run command no_such_command", logged)
+        self.assertIn("Traceback", logged)
+        self.assertIn("Failed to open filename /no/such/index.html", logged)
+
+    def test_timeout_fallback(self):
+        self.manager.REPORT_DEADLINE = 0.5
+        self.manager.heartbeat.cmds = [("echo last-good", True)]
+        self.manager._send_heartbeat()
+        self.manager._pending_report.wait(10)
+        self.manager._tick()
+        self.manager.heartbeat.cmds = [("sleep 30", False)]
+        t0 = time.time()
+        self.manager._send_heartbeat()
+        self.assertEqual(len(self.manager.transport.messages), 1)
+        time.sleep(0.6)
+        self.manager._tick()
+        self.assertLess(time.time() - t0, 5)
+        data = self.manager.transport.messages[1][2]
+        self.assertIn("timed out", data)
+        self.assertIn("last-good", data)
+
+class TestControlSocket(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "babysitter.sock")
+        self.manager = babysitter.Manager()
+        self.manager.transport = babysitter.MemoryTransport()
+        self.filename = os.path.join(self.tmp_dir, "channel_1.dat")
+        open(self.filename, 'w').close()
+        self.manager.append(babysitter.File(self.filename, timeout=10))
+        self.manager.open_control_socket(self.path)
+        self.manager._tick()
+
+    def tearDown(self):
+        self.manager.close_control_socket()
+        shutil.rmtree(self.tmp_dir)
+
+    def _command(self, command):
+        """Send command from another thread while the main loop waits."""
+        responses = []
+        client = threading.Thread(target=lambda: responses.append(
+                                  ctl.send_command(command, self.path)))
+        client.start()
+        t0 = time.time()
+        self.manager._wait(1)
+        self.elapsed = time.time() - t0
+        client.join()
+        return responses[0]
+
+    def test_status(self):
+        response = self._command("status")
+        self.assertTrue(response['ok'])
+        checkers = response['status']['checkers']
+        self.assertEqual(checkers[0]['name'], self.filename)
+        self.assertIn("channel_1.dat=OK", ctl.format_status(response['status']))
+        self.assertFalse(self._command("bogus")['ok'])
+
+    def test_force_heartbeat(self):
+        response = self._command("force-heartbeat")
+        self.assertTrue(response['ok'])
+        self.assertLess(self.elapsed, 0.5)
+        self.manager._tick()
+        try:
+            self.manager._pending_report.wait(10)
+            self.manager._tick()
+        finally:
+            self.manager._terminate_report_pool()
+        self.assertIn("Babysitter heartbeat", 
+                      self.manager.transport.messages[0][2])
+
+    def test_mute(self):
+        response = self._command("mute channel_1.dat 600")
+        self.assertTrue(response['ok'])
+        old = time.time() - 60
+        os.utime(self.filename, (old, old))
+        self.manager._tick()
+        self.assertEqual(self.manager.transport.messages, [])
+        self.assertFalse(self._command("mute nothing 600")['ok'])
+        self.assertFalse(self._command("reload")['ok'])
+
+class TestWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.notify_path = os.path.join(self.tmp_dir, "notify")
+        self.notify_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.notify_sock.bind(self.notify_path)
+        self.notify_sock.setblocking(False)
+
+    def tearDown(self):
+        self.notify_sock.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _notifications(self):
+        notifications = []
+        while True:
+            try:
+                notifications.append(self.notify_sock.recv(1024))
+            except socket.error:
+                return notifications
+
+    def test_stall(self):
+        stalls = []
+        watchdog = babysitter.Watchdog(budget=0.2, 
+                                       on_stall=lambda *args: stalls.append(args),
+                                       notify_socket=self.notify_path,
+                                       watchdog_usec=100000)
+        watchdog.start()
+        try:
+            watchdog.tick_started()
+            watchdog.tick_finished()
+            time.sleep(0.3)
+            self.assertIn("WATCHDOG=1", self._notifications())
+
+            watchdog.tick_started()
+            time.sleep(0.6) # a stalled tick
+            self.assertEqual(len(stalls), 1)
+            self.assertIn("test_stall", stalls[0][1])
+            self._notifications()
+            time.sleep(0.2)
+            self.assertEqual(self._notifications(), [])
+            watchdog.tick_finished()
+        finally:
+            watchdog.stop()
+        self.assertEqual(watchdog.stalls, 1)
+        self.assertEqual(watchdog.ticks, 2)
+        self.assertGreater(watchdog.max_latency, 0.5)
+
+    def test_report_wait_off_tick(self):
+        # A full heartbeat waits for its report between ticks, so a slow
+        # report doesn't stall the main loop
+        manager = babysitter.Manager()
+        manager.transport = babysitter.MemoryTransport()
+        manager.heartbeat.cmds = [("sleep 0.5", False)]
+        manager.watchdog = babysitter.Watchdog(budget=0.2)
+        try:
+            manager.watchdog.tick_started()
+            manager._send_heartbeat()
+            manager.watchdog.tick_finished()
+            self.assertEqual(manager.transport.messages, [])
+            t0 = time.time()
+            manager._wait(10) # returns as soon as the report is ready
+            self.assertLess(time.time() - t0, 5)
+            manager.watchdog.tick_started()
+            manager._tick()
+            manager.watchdog.tick_finished()
+        finally:
+            manager._terminate_report_pool()
+        self.assertEqual(len(manager.transport.messages), 1)
+        self.assertEqual(manager.watchdog.stalls, 0)
+        self.assertLess(manager.watchdog.max_latency, 0.2)
+
+    def test_sd_notify(self):
+        self.assertTrue(babysitter.sd_notify("READY=1", self.notify_path))
+        self.assertEqual(self._notifications(), ["READY=1"])
+        self.assertFalse(babysitter.sd_notify("READY=1", 
+                                              os.path.join(self.tmp_dir, "none")))
+
+    def test_stall_alert(self):
+        manager = babysitter.Manager()
+        manager.transport = babysitter.MemoryTransport()
+        manager.alert_transport = babysitter.MemoryTransport()
+        manager._send_stall_alert(400, "File \"babysitter.py\", in run_commands")
+        self.assertEqual(manager.transport.messages, [])
+        data = manager.alert_transport.messages[0][2]
+        self.assertIn("main loop stalled", data)
+        self.assertIn("run_commands", data)
+
+        # Without an alert transport, a copy of the normal one is used
+        manager.alert_transport = None
+        manager.transport = babysitter.SMTPTransport("localhost", timeout=60)
+        alert_transport = manager._get_alert_transport()
+        self.assertIsInstance(alert_transport, babysitter.SMTPTransport)
+        self.assertIsNot(alert_transport, manager.transport)
+        self.assertEqual(alert_transport.timeout, manager.ALERT_TIMEOUT)
+        self.assertEqual(manager.transport.timeout, 60)
+
+class TestDependencies(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manager = babysitter.Manager()
+        self.manager.transport = babysitter.MemoryTransport()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _file(self, name):
+        filename = os.path.join(self.tmp_dir, name)
+        open(filename, 'w').close()
+        return babysitter.File(filename, timeout=10)
+
+    def _age(self, checker):
+        old = time.time() - 60
+        os.utime(checker.name, (old, old))
+
+    def test_root_cause(self):
+        children = [self._file("channel_{:d}.dat".format(i)) for i in range(5)]
+        parent = self._file("logger.log")
+        grandchild = babysitter.ChannelData(children[0].name)
+        for child in children:
+            child.depends_on = [parent]
+            self.manager.append(child)
+        grandchild.depends_on = [children[0]]
+        self.manager.append(grandchild)
+        self.manager.append(parent) # appended after its dependents
+        self.manager._tick()
+        self.assertEqual(self.manager.transport.messages, [])
+
+        for checker in children + [parent]:
+            self._age(checker)
+        self.manager._tick()
+        data = self.manager.transport.messages[0][2]
+        self.assertIn("logger.log=", data)
+        self.assertIn("Skipping 6 dependent checkers until logger.log", data)
+        self.assertNotIn("channel_1.dat=", data.partition("CURRENT STATE")[0])
+        self.assertEqual(len(self.manager.skipped), 6)
+        self.assertEqual(self.manager.html().count("SKIPPED"), 6)
+        snapshot = self.manager.snapshot()['checkers'][0]
+        self.assertEqual(snapshot['skipped_because'], parent.name)
+
+        # No more emails while the parent stays FAIL
+        self.manager._tick()
+        self.assertEqual(len(self.manager.transport.messages), 1)
+
+        # Parent recovers.  Its dependents are given one timeout to
+        # recover too before they're reported.
+        os.utime(parent.name, None)
+        self.manager._tick()
+        data = self.manager.transport.messages[1][2]
+        self.assertIn("logger.log=", data)
+        self.assertNotIn("channel_1.dat=", data.partition("CURRENT STATE")[0])
+        self.assertEqual(len(self.manager.skipped), 6)
+        self.assertEqual(len(self.manager.settling), 5)
+        for checker in self.manager.settling:
+            self.manager.settling[checker] = 0 # timeout has passed
+        self.manager._tick()
+        self.assertEqual(self.manager.skipped, {grandchild: children[0]})
+        data = self.manager.transport.messages[2][2]
+        self.assertIn("channel_1.dat=", data)
+        self.assertIn("Skipping 1 dependent checkers until channel_0.dat", data)
+
+    def test_settle_after_recovery(self):
+        # The logger comes back and writes to every channel within one
+        # timeout, so nothing is reported
+        children = [self._file("channel_{:d}.dat".format(i)) for i in range(5)]
+        parent = self._file("logger.log")
+        for child in children:
+            child.depends_on = [parent]
+            self.manager.append(child)
+        self.manager.append(parent)
+        self.manager._tick()
+        for checker in children + [parent]:
+            self._age(checker)
+        self.manager._tick()
+        self.assertEqual(len(self.manager.transport.messages), 1)
+
+        os.utime(parent.name, None)
+        self.manager._tick() # emails that the parent is OK
+        self.assertEqual(len(self.manager.transport.messages), 2)
+        for child in children:
+            os.utime(child.name, None)
+            self.manager.settling[child] = 0
+        self.manager._tick()
+        self.assertEqual(len(self.manager.transport.messages), 2)
+        self.assertEqual(self.manager.skipped, {})
+        self.assertEqual(self.manager.settling, {})
+
+    def test_powerdata_reload(self):
+        # Editing the parent's spec replaces it, and the channel checkers
+        # must follow it rather than keep depending on the removed one
+        data_dir = os.path.join(self.tmp_dir, "data")
+        os.mkdir(data_dir)
+        with open(os.path.join(data_dir, "labels.dat"), 'w') as fh:
+            fh.write("1 mains\n")
+        channel = self._file("data/channel_1.dat")
+        with open(channel.name, 'w') as fh:
+            fh.write("1000 10\n")
+        parent = self._file("logger.log")
+        config = {"email": {"transport": "memory"},
+                  "checkers": [{"type": "File", "name": parent.name, 
+                                "timeout": 10}],
+                  "powerdata": {"directory": data_dir, "numeric_subdirs": False,
+                                "timeout": 10, "depends_on": ["logger.log"]}}
+        self.manager.apply_config(config)
+        config = json.loads(json.dumps(config))
+        config["checkers"][0]["timeout"] = 20
+        self.manager.apply_config(config)
+        logger = self.manager._find_checker("logger.log")
+        self.assertEqual(logger.timeout, 20)
+        self.assertEqual(self.manager.powerdata_checkers[0].depends_on, [logger])
+
+        self.manager._tick()
+        self._age(parent)
+        self._age(channel)
+        self.manager._tick()
+        data = self.manager.transport.messages[-1][2]
+        self.assertIn("Skipping 1 dependent checkers until logger.log", data)
+
+    def test_config(self):
+        parent = os.path.join(self.tmp_dir, "logger.log")
+        self.manager.apply_config({"checkers": [
+            {"type": "File", "name": "/tmp", "depends_on": ["logger.log"]},
+            {"type": "File", "name": parent}]})
+        self.assertEqual(self.manager.checkers[0].depends_on, 
+                         [self.manager.checkers[1]])
+        self.assertRaises(babysitter.ConfigError, babysitter.validate_config,
+                          {"checkers": [{"type": "File", "name": "/tmp",
+                                         "depends_on": "logger.log"}]})
+
+class TestPressure(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.proc, "pressure"))
+        self._write_pressure(memory=0.5)
+        self.manager = babysitter.Manager()
+        self.manager.transport = babysitter.MemoryTransport()
+        self.manager.pressure = babysitter.SystemPressure(proc=self.proc)
+
+    def tearDown(self):
+        self.manager._terminate_report_pool()
+        shutil.rmtree(self.proc)
+
+    def _write_pressure(self, memory, loadavg=0.1):
+        for resource, avg10 in [('cpu', 2.0), ('memory', memory)]:
+            with open(os.path.join(self.proc, "pressure", resource), 'w') as fh:
+                fh.write("some avg10={:.2f} avg60=1.00 avg300=0.50 total=1234\n"
+                         "full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n"
+                         .format(avg10))
+        with open(os.path.join(self.proc, "loadavg"), 'w') as fh:
+            fh.write("{:.2f} 0.20 0.30 1/100 4242\n".format(loadavg))
+
+    def test_sample(self):
+        pressure = self.manager.pressure
+        self.assertEqual(pressure.sample(), [])
+        self.assertEqual(pressure.psi['cpu']['some']['avg60'], 1.0)
+        self.assertIsNone(pressure.psi['io']) # no PSI for io
+        self._write_pressure(memory=25, loadavg=100 * pressure.n_cpus)
+        reasons = pressure.sample()
+        self.assertEqual(len(reasons), 2)
+        self.assertIn("memory pressure 25.0%", reasons[0])
+        self.assertIn("memory PSI", pressure.html())
+        self.assertEqual(babysitter.read_pressure("cpu", "/no/such/proc"), None)
+
+    def test_config(self):
+        self.manager.apply_config({"checkers": [
+            {"type": "File", "name": "/tmp", "critical": False}]})
+        self.assertFalse(self.manager.checkers[0].critical)
+        self.assertFalse(babysitter.ChannelData("/tmp/channel_1.dat").critical)
+        self.assertRaises(babysitter.ConfigError, babysitter.validate_config,
+                          {"checkers": [{"type": "File", "name": "/tmp",
+                                         "critical": "no"}]})
+
+    def test_backoff(self):
+        checked = []
+        for critical in [True, False]:
+            checker = babysitter.DiskSpaceRemaining(threshold=0, path=self.proc)
+            checker.critical = critical
+            checker.changed_html = (lambda critical=critical: 
+                                    checked.append(critical) or "")
+            self.manager.append(checker)
+        process = babysitter.Process("no_such_process_name")
+        self.manager.append(process)
+        self._write_pressure(memory=25)
+        for _ in range(self.manager.PRESSURE_BACKOFF_TICKS * 2):
+            self.manager._tick()
+        self.assertEqual(checked.count(True), self.manager.PRESSURE_BACKOFF_TICKS * 2)
+        self.assertEqual(checked.count(False), 2)
+        self.assertTrue(process.fork_free)
+        self.assertIn("memory pressure", self.manager.snapshot()['pressure'][0])
+
+        self._write_pressure(memory=0.5)
+        self.manager._tick()
+        self.assertFalse(process.fork_free)
+        self.assertEqual(self.manager.snapshot()['pressure'], [])
+
+    def test_deferred_heartbeat(self):
+        self.manager.heartbeat.cmds = [("echo full-report", True)]
+        schedule = babysitter.IntervalSchedule(3600, full_report=True)
+        self.manager.heartbeat.schedules.append(schedule)
+        self._write_pressure(memory=25)
+        schedule.mark_run(datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        self.manager._tick()
+        self.assertIsNone(self.manager._pending_report) # not prepared ahead
+        data = self.manager.transport.messages[0][2]
+        self.assertIn("heartbeat summary", data)
+        self.assertIn("Full heartbeat deferred", data)
+        self.assertIn("memory PSI", data)
+        self.assertNotIn("full-report", data)
+
+        self.manager._tick() # still under pressure
+        self.assertEqual(len(self.manager.transport.messages), 1)
+        self._write_pressure(memory=0.5)
+        self.manager._tick()
+        self.manager._pending_report.wait(10)
+        self.manager._tick()
+        data = self.manager.transport.messages[1][2]
+        self.assertIn("was deferred", data)
+        self.assertIn("full-report", data)
+
+    def test_find_pids(self):
+        child = subprocess.Popen(["sleep", "30"])
+        try:
+            self.assertIn(child.pid, babysitter.find_pids("sleep"))
+            process = babysitter.Process("sleep")
+            process.fork_free = True
+            self.assertIn(child.pid, process._pids if process.running() else [])
+        finally:
+            child.kill()
+            child.wait()
+        self.assertNotIn(os.getpid(), babysitter.find_pids("python"))
+
+class TestQueueLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = babysitter.logging.getLogger("babysitter.test_queue")
+        self.logger.propagate = False
+        self.logger.setLevel(babysitter.logging.DEBUG)
+        self.stream = StringIO.StringIO()
+        self.stream_handler = babysitter.logging.StreamHandler(self.stream)
+        self.stream_handler.setLevel(babysitter.logging.INFO)
+
+    def tearDown(self):
+        for handler in self.logger.handlers[:]:
+            self.logger.removeHandler(handler)
+
+    def test_listener(self):
+        queue = babysitter.Queue.Queue(100)
+        listener = babysitter.QueueListener(queue, self.stream_handler,
+                                            batch_size=10)
+        handler = babysitter.QueueHandler(queue, listener)
+        self.logger.addHandler(handler)
+        listener.start()
+        checker = babysitter.File("/tmp")
+        for i in range(50):
+            self.logger.info("record %d of %s", i, checker)
+        self.logger.debug("filtered out")
+        handler.close()
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 50)
+        self.assertEqual(lines[-1], "record 49 of " + str(checker))
+
+    def test_drops(self):
+        queue = babysitter.Queue.Queue(3)
+        handler = babysitter.QueueHandler(queue)
+        self.logger.addHandler(handler)
+        for i in range(10):
+            self.logger.info("record %d", i)
+        self.assertEqual(handler.dropped, 7)
+        listener = babysitter.QueueListener(queue, self.stream_handler)
+        listener.handle([queue.get_nowait() for i in range(3)])
+        self.logger.info("after")
+        listener.start()
+        listener.stop()
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(lines[-2:], ["Log queue full. Dropped 7 records so far.",
+                                      "after"])
+
+class TestEmail(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = babysitter.Manager()
+        self.manager.EMAIL_FROM = "babysitter@localhost"
+        self.manager.EMAIL_TO = ["me@localhost"]
+        self.tmp_dir = tempfile.mkdtemp()
+        self.img_files = local_smtpd.make_fake_images(self.tmp_dir, 3, 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_memory_transport(self):
+        self.manager.transport = babysitter.MemoryTransport()
+        self.manager.send_email("test", "<p>hello</p>", self.img_files)
+        self.assertEqual(len(self.manager.transport.messages), 1)
+        from_addr, to_addrs, data = self.manager.transport.messages[0]
+        self.assertEqual(to_addrs, ["me@localhost"])
+        self.assertIn("graph2.png", data)
+
+    def test_maildir_transport(self):
+        maildir = os.path.join(self.tmp_dir, "Maildir")
+        self.manager.transport = babysitter.MaildirTransport(maildir)
+        self.manager.send_email("test", "<p>hello</p>")
+        self.assertEqual(len(os.listdir(os.path.join(maildir, "new"))), 1)
+
+    def test_smtp_transport(self):
+        server = local_smtpd.LocalSMTPServer()
+        server.start()
+        try:
+            self.manager.transport = babysitter.SMTPTransport('127.0.0.1',
+                                                              server.port)
+            self.manager._send_heartbeat()
+            self.manager._pending_report.wait(10)
+            self.manager._tick()
+            self.manager.send_email("test", "<p>hello</p>", self.img_files)
+        finally:
+            self.manager._terminate_report_pool()
+            server.stop()
+        self.assertEqual(len(server.messages), 2)
+        self.assertIn("Babysitter heartbeat", server.messages[0][2])
+        self.assertIn("graph0.png", server.messages[1][2])
+
+    def test_size_caps(self):
+        self.manager.transport = babysitter.MemoryTransport()
+        self.manager.max_attachment_bytes = 500
+        self.manager.max_text_chars = 100
+        self.manager.send_email("test", "<p>" + "x" * 1000 + "</p>",
+                                self.img_files)
+        data = self.manager.transport.messages[0][2]
+        self.assertIn("Images omitted", data)
+        self.assertIn("characters truncated", data)
+        if babysitter.Image is None:
+            self.assertNotIn("Content-ID: <graph0.png>", data)
+
+    def test_total_size_cap(self):
+        # The cap counts base64 and MIME overhead, so thumbnails must be
+        # sized to fit once encoded
+        thumbnail_sizes = []
+        def make_thumbnail(filename, max_bytes):
+            thumbnail_sizes.append(max_bytes)
+            return "x" * max_bytes
+        original = babysitter.make_thumbnail
+        babysitter.make_thumbnail = make_thumbnail
+        try:
+            for cap in [3000, 4000, 6000]:
+                self.manager.max_email_bytes = cap
+                msg = self.manager.build_email("test", "<p>hello</p>\n" * 20,
+                                               self.img_files)
+                self.assertLessEqual(len(msg.as_string()), cap)
+        finally:
+            babysitter.make_thumbnail = original
+        self.assertTrue(thumbnail_sizes)
+
+        # Without thumbnails, images which don't fit are omitted
+        self.manager.max_email_bytes = 4000
+        msg = self.manager.build_email("test", "<p>hello</p>", self.img_files)
+        data = msg.as_string()
+        self.assertLessEqual(len(data), 4000)
+        self.assertIn("Images omitted", data)
+        self.assertIn("Content-ID: <graph0.png>", data)
+
+    def test_attachment_round_trip(self):
+        msg = self.manager.build_email("test", "<p>hello</p>", self.img_files)
+        parsed = email.message_from_string(msg.as_string())
+        images = [part for part in parsed.walk() 
+                  if part.get_content_maintype() == 'image']
+        self.assertEqual(len(images), 3)
+        with open(self.img_files[0], 'rb') as fh:
+            self.assertEqual(images[0].get_payload(decode=True), fh.read())
+
+    def test_benchmark(self):
+        results = local_smtpd.benchmark(n_emails=2, n_images=5,
+                                        image_size=1000)
+        self.assertEqual(len(results['send_times']), 2)
+        self.assertGreater(results['bytes'], 2 * 5 * 1000)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,89 @@
+#! /usr/bin/python
+from __future__ import print_function
+import socket
+import json
+import os
+import time
+import sys
+import argparse
+
+"""
+Command line client for the control socket served by a babysitter
+Manager (see Manager.open_control_socket).  For example:
+
+    babysitter-ctl status
+    babysitter-ctl force-heartbeat
+    babysitter-ctl restart rfm_ecomanager_logger.py
+    babysitter-ctl mute channel_3.dat 3600
+    babysitter-ctl reload
+
+Status is answered from the Manager's last tick, so it's cheap to query
+however often you like.
+
+"""
+
+DEFAULT_SOCKET = os.environ.get("BABYSITTER_SOCKET",
+                                os.path.expanduser("~/.babysitter.sock"))
+
+
+def send_command(command, path=DEFAULT_SOCKET, timeout=30):
+    """Send one command line to the Manager listening on path.
+
+    Returns:
+        dict: the decoded response (see Manager.handle_command).
+
+    Raises:
+        socket.error if the Manager isn't listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(command.strip() + "\n")
+        response = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    return json.loads(response)
+
+
+def format_status(status):
+    """Returns a plain text rendering of a status response."""
+    if not status.get('checkers'):
+        return "No status yet."
+    lines = ["{} (as of {:.0f}s ago)".format(
+             status['host'], max(time.time() - status['time'], 0))]
+    for checker in status['checkers']:
+        muted = status['muted'].get(checker['name'])
+        lines.append("  {}={}{}{}".format(
+            checker['name'], "OK" if checker['state'] else "FAIL",
+            checker['text'],
+            " [muted for {:.0f}s]".format(muted) if muted else ""))
+    if status.get('pressure'):
+        lines.append("  Under pressure: " + "; ".join(status['pressure']))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query or control a "
+                                     "running babysitter.")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help="control socket path (default: %(default)s)")
+    parser.add_argument('command', nargs='+',
+                        help="status | force-heartbeat | restart <process> | "
+                             "mute <checker> <seconds> | reload")
+    args = parser.parse_args()
+
+    try:
+        response = send_command(" ".join(args.command), args.socket)
+    except socket.error as e:
+        sys.exit("Can't talk to babysitter on {}: {}".format(args.socket, e))
+
+    if 'status' in response:
+        print(format_status(response['status']))
+    else:
+        print(response['message'])
+    sys.exit(0 if response['ok'] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#! /usr/bin/python
+from __future__ import print_function, division
+import asyncore
+import smtpd
+import threading
+import tempfile
+import shutil
+import time
+import os
+import argparse
+import babysitter
+
+"""
+A local stand-in SMTP server, so that babysitter's real email sending
+path can be exercised without a real mail server, plus a benchmark of
+the MIME build and send path.
+
+Run as a script to benchmark sending heartbeats with many images:
+
+    python local_smtpd.py --emails 20 --images 30 --image-size 100000
+
+"""
+
+# Minimal PNG signature so that MIMEImage can guess the subtype.
+PNG_HEADER = b'\x89PNG\r\n\x1a\n'
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """An SMTP server which listens on localhost and keeps every message
+    it receives in memory.  Does not support AUTH or STARTTLS.
+
+    Attributes:
+        port (int): the port we're listening on.  Pass port=0 to the
+            constructor to let the OS pick a free port.
+        messages (list of (mailfrom, rcpttos, data) tuples)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self._running = False
+        self._thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        self.close()
+
+
+def make_fake_images(directory, n_images, image_size):
+    """Writes n_images files of image_size bytes each into directory.
+
+    Returns:
+        list of filenames
+    """
+    filenames = []
+    for i in range(n_images):
+        filename = os.path.join(directory, "graph{:d}.png".format(i))
+        with open(filename, 'wb') as fh:
+            fh.write(PNG_HEADER)
+            fh.write(os.urandom(max(image_size - len(PNG_HEADER), 0)))
+        filenames.append(filename)
+    return filenames
+
+
+def benchmark(n_emails=10, n_images=20, image_size=100000):
+    """Time building and sending heartbeat-sized emails to a
+    LocalSMTPServer.  The IP address in each email is looked up once,
+    before timing starts.
+
+    Returns:
+        dict with keys 'build_times' and 'send_times' (lists of seconds per
+        email) and 'bytes' (total bytes received by the server).
+    """
+    server = LocalSMTPServer()
+    server.start()
+    tmp_dir = tempfile.mkdtemp()
+    # Look up our IP address (which needs DNS) once, outside the timed
+    # region, so build times only measure building the email.
+    get_ip_address = babysitter.get_ip_address
+    ip_address = get_ip_address()
+    babysitter.get_ip_address = lambda: ip_address
+    try:
+        img_files = make_fake_images(tmp_dir, n_images, image_size)
+        manager = babysitter.Manager()
+        manager.transport = babysitter.SMTPTransport('127.0.0.1', server.port)
+        manager.EMAIL_FROM = 'babysitter@localhost'
+        manager.EMAIL_TO = ['me@localhost']
+        html = "<html>\n<head></head>\n<body>" + manager.html() + "</body>\n</html>\n"
+        build_times = []
+        send_times = []
+        for _ in range(n_emails):
+            t0 = time.time()
+            msg = manager.build_email("Babysitter benchmark", html, img_files)
+            t1 = time.time()
+            manager.transport.send(manager._email_from(), manager.EMAIL_TO, msg)
+            t2 = time.time()
+            build_times.append(t1 - t0)
+            send_times.append(t2 - t1)
+    finally:
+        babysitter.get_ip_address = get_ip_address
+        server.stop()
+        shutil.rmtree(tmp_dir)
+
+    return {'build_times': build_times,
+            'send_times': send_times,
+            'bytes': sum(len(data) for _, _, data in server.messages)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark babysitter's "
+                                     "email build and send path against a "
+                                     "local SMTP server.")
+    parser.add_argument('--emails', type=int, default=10)
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--image-size', type=int, default=100000,
+                        help='bytes per image')
+    args = parser.parse_args()
+
+    results = benchmark(args.emails, args.images, args.image_size)
+    total = sum(results['build_times']) + sum(results['send_times'])
+    for key in ['build_times', 'send_times']:
+        times = results[key]
+        print("{:<12} mean={:.1f}ms max={:.1f}ms".format(
+              key, 1000 * sum(times) / len(times), 1000 * max(times)))
+    print("throughput   {:.1f} emails/s, {:.1f} MB/s".format(
+          args.emails / total, results['bytes'] / total / 1024**2))
+
+
+if __name__ == "__main__":
+    main()
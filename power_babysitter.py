@@ -2,9 +2,10 @@
 from __future__ import print_function, division
 import logging.handlers
 log = logging.getLogger("babysitter")
-from babysitter import Manager, DiskSpaceRemaining, Process, NewDataDirError, File
-import time, sys, inspect, os
-import email_config
+from babysitter import (Manager, DiskSpaceRemaining, Process, NewDataDirError,
+                        File, FileGlob, LogPattern, QueueHandler, QueueListener)
+from babysitter.ctl import DEFAULT_SOCKET
+import time, sys, inspect, os, Queue
 
 """
 This script is both an example of how to use babysitter
@@ -33,11 +34,22 @@ The following environment variables must be set:
    DATA_DIR
    LOGGER_BASE_DIR
 
+Alternatively, set BABYSITTER_CONFIG to the filename of a JSON config
+file (see babysitter.load_config for the format) to use instead of
+_set_config.  Send SIGHUP to reload the config file without restarting.
+
+BABYSITTER_SOCKET optionally sets the path of the control socket used by
+babysitter-ctl (default ~/.babysitter.sock).
+
 """
 
 FILE_PATH = os.path.dirname(inspect.getfile(inspect.currentframe()))
 
-def init_logger():
+def init_logger(use_queue=False, queue_size=10000):
+    """If use_queue is True then the console and file handlers are run
+    from a background thread, fed through a queue of up to queue_size
+    records, so that logging never blocks the monitoring loop.  Records
+    are dropped (and counted) if the queue is full."""
     # create logger
     logger = logging.getLogger("babysitter")
     logger.setLevel(logging.DEBUG)
@@ -51,7 +63,6 @@ def init_logger():
     ch_formatter = logging.Formatter('%(asctime)s %(levelname)s '
                         '%(message)s', datefmt=datefmt)
     ch.setFormatter(ch_formatter)
-    logger.addHandler(ch)
     
     # create file handler (fh) for babysitter.log
     logfile = os.path.join(FILE_PATH, "babysitter.log")
@@ -61,9 +72,18 @@ def init_logger():
                                      " %(funcName)s %(message)s",
                                      datefmt=datefmt)
     fh.setFormatter(fh_formatter)    
-    logger.addHandler(fh)
+
+    if use_queue:
+        queue = Queue.Queue(queue_size)
+        listener = QueueListener(queue, ch, fh)
+        logger.addHandler(QueueHandler(queue, listener))
+        listener.start()
+    else:
+        logger.addHandler(ch)
+        logger.addHandler(fh)
 
 def _set_config(manager):
+    import email_config
     ########### EMAIL CONFIG ############################################
     manager.SMTP_SERVER = email_config.SMTP_SERVER
     manager.EMAIL_FROM  = email_config.EMAIL_FROM
@@ -71,6 +91,10 @@ def _set_config(manager):
     manager.USERNAME    = email_config.USERNAME
     manager.PASSWORD    = email_config.PASSWORD
 
+    ########### CONTROL SOCKET ##########################################
+    # Query or control the running babysitter with babysitter-ctl
+    manager.control_socket = DEFAULT_SOCKET
+
     ########### FILES ###################################################
     # manager.append(File(name="/path/to/file", timeout=120))
         
@@ -81,7 +105,8 @@ def _set_config(manager):
         sys.exit(1)
         
     ########### DISK SPACE CHECKER ######################################
-    manager.append(DiskSpaceRemaining(threshold=5000, path=base_data_dir))
+    disk_space = DiskSpaceRemaining(threshold=5000, path=base_data_dir)
+    manager.append(disk_space)
 
     ########### PROCESSES ###############################################
     # Each process will be monitored.  If it dies then babysitter will attempt
@@ -98,8 +123,16 @@ def _set_config(manager):
                        "/rfm_ecomanager_logger/rfm_ecomanager_logger/"
                        "rfm_ecomanager_logger.py")
     
-    manager.append(Process(name="rfm_ecomanager_logger.py",
-                        restart_command=restart_command))
+    logger_process = Process(name="rfm_ecomanager_logger.py",
+                             restart_command=restart_command)
+    manager.append(logger_process)
+
+    # Alert if the radio link gets noisy
+    manager.append(LogPattern(logger_base_dir + "/rfm_ecomanager_logger/"
+                              "rfm_ecomanager_logger.log",
+                              [{"name": "CRC error", "regex": "CRC error",
+                                "max_count": 5, "window": 60}],
+                              label="rfm_ecomanager_logger"))
     
     # Check if /flac directory exists.  If it does then snd_card_power_meter
     # is assumed to be installed.
@@ -109,13 +142,8 @@ def _set_config(manager):
                                restart_command='nohup ' + logger_base_dir +
                                '/snd_card_power_meter/scripts/record.py'))
         
-        scpm_dat_dir = base_data_dir + '/high-freq-mains'
-        scpm_datfiles = os.listdir(scpm_dat_dir)
-        scpm_datfiles = [f for f in scpm_datfiles 
-                         if f.startswith('mains-') and f.endswith('.dat')]
-        scpm_datfiles.sort()
-        last_datfile = os.path.join(scpm_dat_dir, scpm_datfiles[-1])
-        manager.append(File(last_datfile))
+        # Follows the newest mains-*.dat as record.py rotates files
+        manager.append(FileGlob(base_data_dir + '/high-freq-mains/mains-*.dat'))
 
     ########### FILEGROWS ###############################################
     # manager.append(FileGrows("cron.log"))
@@ -133,9 +161,13 @@ def _set_config(manager):
                   True))
 
     ########### LOAD POWER DATA ########################################
+    # The channel checkers are skipped while the logger or disk is FAIL,
+    # so an outage is reported once rather than once per channel.
     data_dir = manager.load_powerdata(directory=base_data_dir,
                                       numeric_subdirs=True,
-                                      timeout=500)
+                                      timeout=500,
+                                      validate=True,
+                                      depends_on=[logger_process, disk_space])
     
     ########### HEARTBEAT ###############################################
     manager.heartbeat.hour = 6 # Hour of each day to send heartbeat (24hr clock)
@@ -158,20 +190,26 @@ def _set_config(manager):
     # to work this out for itself) so we guarantee that powerstats
     # will always produce data for the same data dir that babysitter
     # is looking at.  Especially important if babysitter spots a new data
-    # subdir whilst running.
-    manager.heartbeat.cmds.append((logger_base_dir +
+    # subdir whilst running, in which case set_data_dir is called again.
+    powerstats_index = len(manager.heartbeat.cmds)
+    manager.heartbeat.cmds.append(None)
+
+    def set_data_dir(data_dir):
+        manager.heartbeat.cmds[powerstats_index] = (logger_base_dir +
                       "/powerstats/powerstats/powerstats.py"
                       " --data-dir " + data_dir + " --html --cache"
                       " --high-freq-data-dir " + base_data_dir + "/high-freq-mains",
-                      True)) # second argument switches output of stdout
+                      True) # second argument switches output of stdout
     
-    manager.heartbeat.html_file = (data_dir + "/html/index.html")
+        manager.heartbeat.html_file = (data_dir + "/html/index.html")
+
+    set_data_dir(data_dir)
+    manager.new_data_dir_callbacks.append(set_data_dir)
     
 
 def main():
-    init_logger()
-    log.debug('\nMAIN: babysitter.py starting up. Unixtime = {:.0f}'
-                  .format(time.time()))
+    init_logger(use_queue=True)
+    log.debug('\nMAIN: babysitter.py starting up. Unixtime = %.0f', time.time())
 
     # Load Manager in a loop so we can reload Manager
     # if we get a NewDataDirError.
@@ -187,7 +225,11 @@ def main():
             retries += 1
             
         manager = Manager()
-        _set_config(manager)
+        config_filename = os.environ.get("BABYSITTER_CONFIG")
+        if config_filename:
+            manager.load_config(config_filename)
+        else:
+            _set_config(manager)
 
         try:
             previous_loop_time = time.time()            
@@ -5,6 +5,9 @@ setup(
     version = "0.1",
     packages = find_packages(),
     install_requires = [],
+    entry_points = {
+        'console_scripts': ['babysitter-ctl = babysitter.ctl:main']
+    },
     author = "Jack Kelly",
     author_email = "jack-list@xlk.org.uk",
     description = "Monitor files and processes and email heart beat",